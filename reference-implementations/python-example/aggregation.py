@@ -0,0 +1,387 @@
+# Cell method aggregation of received series
+#
+# Computes the CF cell methods of firstmile.proto (POINT, SUM, MAXIMUM, MEDIAN, MEAN, STANDARD_DEVIATION, ...)
+# over fixed windows (e.g. hourly or daily products) with NumPy, one vectorised pass over all points of any number
+# of series: the points are sorted once by (series, window, time) and every statistic is a reduceat over the
+# group boundaries. Order statistics (MEDIAN, MODE, MEAN_OF_UPPER_DECILE) use a second sort by value.
+#
+# Windows are [origin + k * window, origin + (k + 1) * window) in epoch nanoseconds. NaN values (emptyValue) are
+# ignored; POINT is the value of the last point of the window.
+#
+# For continuous products, RollingAggregator keeps mergeable partial aggregates (count, sums, mean/M2, min/max,
+# last point) of the windows that are still open and folds each new batch of points into them, so an update costs
+# the size of the batch, not of the window. Windows are completed once points newer than `lateness` windows arrive.
+#
+# aggregate_stations() runs the batch aggregation over the stations of an IngestWorker and returns a pandas
+# DataFrame, using by default the cell method each parameter declares in its Metadata.
+
+import numpy as np
+
+from protospy import firstmile_pb2 as pb2
+
+METHODS = [name for name in pb2.CellMethod.keys() if name != "CELL_METHOD_UNSPECIFIED"]
+ORDER_METHODS = {"MEDIAN", "MODE", "MEAN_OF_UPPER_DECILE"}
+NUMERIC_KINDS = {"floatValue", "doubleValue", "intValue", "unsignedIntValue", "int64Value", "unsignedInt64Value",
+                 "boolValue"}
+NANOS = 1_000_000_000
+
+
+def window_index(times, window_ns, origin_ns=0):
+    return (np.asarray(times, dtype=np.int64) - origin_ns) // window_ns
+
+
+def _group_codes(keys):
+    """One int64 per point that orders like the tuple of keys."""
+    codes = np.zeros(len(keys[0]), dtype=np.int64)
+    largest = 0
+    for k in keys:
+        if not len(k):
+            break
+        low = int(k.min())
+        span = int(k.max()) - low + 1
+        largest = (largest + 1) * span - 1
+        if largest >= 1 << 62:
+            # key ranges too wide to pack into one integer
+            return np.unique(np.stack(keys, axis=1), axis=0, return_inverse=True)[1].reshape(-1)
+        codes = codes * span + (k - low)
+    return codes
+
+
+def _sorted_groups(keys, times, values):
+    """Sort the points by (keys..., time); returns the sort order, the start index of every group and the sorted keys."""
+    codes = _group_codes(keys)
+    n = len(codes)
+    # series are usually stored in time order, then there is nothing to sort
+    if n < 2 or np.all((codes[1:] > codes[:-1]) | ((codes[1:] == codes[:-1]) & (times[1:] >= times[:-1]))):
+        order = np.arange(n)
+    elif int(codes.max()) < (1 << 62) // n:
+        # one integer sort of (group, rank of time) instead of a lexsort
+        rank = np.empty(n, dtype=np.int64)
+        rank[np.argsort(times)] = np.arange(n)
+        order = np.argsort(codes * n + rank)
+    else:
+        order = np.argsort(times, kind="stable")
+        order = order[np.argsort(codes[order], kind="stable")]
+    sorted_codes = codes[order]
+    change = np.ones(n, dtype=bool)
+    change[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    return order, np.flatnonzero(change), [k[order] for k in keys]
+
+
+def partials(keys, times, values):
+    """Mergeable partial aggregates per group of equal keys.
+
+    keys is a tuple of int64 arrays aligned with times/values (e.g. (series, window index)). Returns the keys of
+    every group and a dict of per-group arrays; NaN values are dropped.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    keep = ~np.isnan(values)
+    if not keep.all():
+        times, values, keys = times[keep], values[keep], tuple(k[keep] for k in keys)
+    order, starts, sorted_keys = _sorted_groups(keys, times, values)
+    if not len(order):
+        return tuple(np.zeros(0, dtype=np.int64) for _ in keys), empty_partials()
+
+    t = times[order]
+    v = values[order]
+    counts = np.diff(np.append(starts, len(v)))
+    ends = starts + counts - 1
+    sums = np.add.reduceat(v, starts)
+    means = sums / counts
+    deviations = v - np.repeat(means, counts)
+    absolute = np.abs(v)
+    result = {
+        "count": counts.astype(np.int64),
+        "sum": sums,
+        "sumsq": np.add.reduceat(v * v, starts),
+        "mean": means,
+        "m2": np.add.reduceat(deviations * deviations, starts),
+        "min": np.minimum.reduceat(v, starts),
+        "max": np.maximum.reduceat(v, starts),
+        "absmin": np.minimum.reduceat(absolute, starts),
+        "absmax": np.maximum.reduceat(absolute, starts),
+        "abssum": np.add.reduceat(absolute, starts),
+        "last_time": t[ends],
+        "last_value": v[ends],
+    }
+    return tuple(k[starts] for k in sorted_keys), result
+
+
+def empty_partials():
+    result = {name: np.zeros(0) for name in ("sum", "sumsq", "mean", "m2", "min", "max", "absmin", "absmax",
+                                             "abssum", "last_value")}
+    result["count"] = np.zeros(0, dtype=np.int64)
+    result["last_time"] = np.zeros(0, dtype=np.int64)
+    return result
+
+
+def merge(a, b):
+    """Elementwise combination of two aligned sets of partial aggregates (Chan et al. for mean and M2)."""
+    n = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    later = b["last_time"] >= a["last_time"]
+    return {
+        "count": n,
+        "sum": a["sum"] + b["sum"],
+        "sumsq": a["sumsq"] + b["sumsq"],
+        "mean": a["mean"] + delta * b["count"] / n,
+        "m2": a["m2"] + b["m2"] + delta * delta * a["count"] * b["count"] / n,
+        "min": np.minimum(a["min"], b["min"]),
+        "max": np.maximum(a["max"], b["max"]),
+        "absmin": np.minimum(a["absmin"], b["absmin"]),
+        "absmax": np.maximum(a["absmax"], b["absmax"]),
+        "abssum": a["abssum"] + b["abssum"],
+        "last_time": np.where(later, b["last_time"], a["last_time"]),
+        "last_value": np.where(later, b["last_value"], a["last_value"]),
+    }
+
+
+def finalize(p, methods):
+    """Cell method values from partial aggregates, for the methods that do not need the individual values."""
+    n = p["count"]
+    out = {}
+    for method in methods:
+        if method == "POINT":
+            out[method] = p["last_value"]
+        elif method == "SUM":
+            out[method] = p["sum"]
+        elif method == "MAXIMUM":
+            out[method] = p["max"]
+        elif method == "MINIMUM":
+            out[method] = p["min"]
+        elif method == "MAXIMUM_ABSOLUTE_VALUE":
+            out[method] = p["absmax"]
+        elif method == "MINIMUM_ABSOLUTE_VALUE":
+            out[method] = p["absmin"]
+        elif method == "MID_RANGE":
+            out[method] = (p["max"] + p["min"]) / 2
+        elif method == "RANGE":
+            out[method] = p["max"] - p["min"]
+        elif method == "MEAN":
+            out[method] = p["mean"]
+        elif method == "MEAN_ABSOLUTE_VALUE":
+            out[method] = p["abssum"] / n
+        elif method == "ROOT_MEAN_SQUARE":
+            out[method] = np.sqrt(p["sumsq"] / n)
+        elif method == "SUM_OF_SQUARES":
+            out[method] = p["sumsq"]
+        elif method == "VARIANCE":
+            out[method] = p["m2"] / n
+        elif method == "STANDARD_DEVIATION":
+            out[method] = np.sqrt(p["m2"] / n)
+    return out
+
+
+def order_statistics(keys, values, methods):
+    """MEDIAN, MODE and MEAN_OF_UPPER_DECILE per group of equal keys; returns (group keys, {method: array})."""
+    values = np.asarray(values, dtype=np.float64)
+    keep = ~np.isnan(values)
+    if not keep.all():
+        values, keys = values[keep], tuple(k[keep] for k in keys)
+    # sorted by value within each group
+    order, starts, sorted_keys = _sorted_groups(keys, values, values)
+    group_keys = tuple(k[starts] for k in sorted_keys)
+    out = {}
+    if not len(order):
+        return group_keys, {method: np.zeros(0) for method in methods if method in ORDER_METHODS}
+
+    v = values[order]
+    counts = np.diff(np.append(starts, len(v)))
+    if "MEDIAN" in methods:
+        out["MEDIAN"] = (v[starts + (counts - 1) // 2] + v[starts + counts // 2]) / 2
+    if "MEAN_OF_UPPER_DECILE" in methods:
+        # mean of the largest tenth of the values (at least one)
+        k = np.maximum(1, np.ceil(counts / 10).astype(np.int64))
+        cumulative = np.concatenate(([0.0], np.cumsum(v)))
+        ends = starts + counts
+        out["MEAN_OF_UPPER_DECILE"] = (cumulative[ends] - cumulative[ends - k]) / k
+    if "MODE" in methods:
+        # longest run of equal values in each group, the smallest value on ties (runs are in value order)
+        group = np.repeat(np.arange(len(starts)), counts)
+        run_start = np.ones(len(v), dtype=bool)
+        run_start[1:] = (v[1:] != v[:-1]) | (group[1:] != group[:-1])
+        runs = np.flatnonzero(run_start)
+        lengths = np.diff(np.append(runs, len(v)))
+        run_group = group[runs]
+        group_runs = np.flatnonzero(np.diff(run_group, prepend=-1))
+        longest = np.maximum.reduceat(lengths, group_runs)
+        candidates = np.flatnonzero(lengths == longest[run_group])
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = run_group[candidates][1:] != run_group[candidates][:-1]
+        out["MODE"] = v[runs[candidates[first]]]
+    return group_keys, out
+
+
+def aggregate(series, window_seconds, methods=METHODS, origin_ns=0):
+    """Aggregate many series at once.
+
+    series is a list of (times_ns, values) pairs. Returns (series number, window start ns, count, {method: array}),
+    one entry per series and window that has at least one valid value, sorted by series and window.
+    """
+    window_ns = int(window_seconds * NANOS)
+    lengths = [len(times) for times, _ in series]
+    if not sum(lengths):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                {method: np.zeros(0) for method in methods})
+    series_ids = np.repeat(np.arange(len(series), dtype=np.int64), lengths)
+    times = np.concatenate([np.asarray(times, dtype=np.int64) for times, _ in series])
+    values = np.concatenate([np.asarray(values, dtype=np.float64) for _, values in series])
+    windows = window_index(times, window_ns, origin_ns)
+
+    (ids, wins), p = partials((series_ids, windows), times, values)
+    out = finalize(p, methods)
+    if ORDER_METHODS.intersection(methods):
+        # same groups in the same order: both are sorted by (series, window)
+        out.update(order_statistics((series_ids, windows), values, methods)[1])
+    return ids, wins * window_ns + origin_ns, p["count"], {method: out[method] for method in methods}
+
+
+class RollingAggregator:
+    """Incrementally maintained cell method aggregates of one series over consecutive windows."""
+
+    def __init__(self, window_seconds, methods=METHODS, origin_ns=0, lateness=1):
+        self.window_ns = int(window_seconds * NANOS)
+        self.methods = list(methods)
+        self.origin_ns = origin_ns
+        self.lateness = lateness
+        self.order_methods = ORDER_METHODS.intersection(self.methods)
+        self.windows = np.zeros(0, dtype=np.int64)  # open windows, ascending
+        self.state = empty_partials()
+        self.values = {}  # open window -> values, only kept for order statistics
+        self.completed = []  # (window start ns, count, {method: value}) not yet taken by pop_completed()
+        self.late = 0
+        self._closed = None  # highest completed window
+        self.seq = 0  # RingBuffer sequence number consumed by poll()
+
+    def update(self, times, values):
+        """Fold a batch of points into the open windows and complete the windows that are now closed."""
+        times = np.asarray(times, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if not len(times):
+            return
+        windows = window_index(times, self.window_ns, self.origin_ns)
+        if self._closed is not None:
+            # points for windows that were already completed are counted and dropped
+            on_time = windows > self._closed
+            if not on_time.all():
+                self.late += int((~on_time).sum())
+                times, values, windows = times[on_time], values[on_time], windows[on_time]
+
+        (wins,), batch = partials((windows,), times, values)
+        if len(wins):
+            self._fold(wins, batch)
+        if self.order_methods:
+            for w in np.unique(windows[~np.isnan(values)]):
+                chunk = values[(windows == w) & ~np.isnan(values)]
+                previous = self.values.get(int(w))
+                self.values[int(w)] = chunk if previous is None else np.concatenate((previous, chunk))
+
+        if len(self.windows):
+            self._complete(self.windows < self.windows[-1] - self.lateness)
+
+    def _fold(self, wins, batch):
+        position = np.searchsorted(self.windows, wins)
+        existing = position < len(self.windows)
+        existing[existing] = self.windows[position[existing]] == wins[existing]
+        if existing.any():
+            idx = position[existing]
+            current = {name: array[idx] for name, array in self.state.items()}
+            merged = merge(current, {name: array[existing] for name, array in batch.items()})
+            for name, array in merged.items():
+                self.state[name][idx] = array
+        if not existing.all():
+            new = ~existing
+            windows = np.concatenate((self.windows, wins[new]))
+            order = np.argsort(windows, kind="stable")
+            self.windows = windows[order]
+            self.state = {name: np.concatenate((array, batch[name][new]))[order]
+                          for name, array in self.state.items()}
+
+    def _results(self, mask):
+        windows = self.windows[mask]
+        state = {name: array[mask] for name, array in self.state.items()}
+        out = finalize(state, self.methods)
+        for method in self.order_methods:
+            out[method] = np.empty(len(windows))
+        for i, w in enumerate(windows.tolist()):
+            if self.order_methods:
+                values = self.values.get(w, np.zeros(0))
+                _, stats = order_statistics((np.zeros(len(values), dtype=np.int64),), values, self.order_methods)
+                for method in self.order_methods:
+                    out[method][i] = stats[method][0] if len(stats[method]) else np.nan
+        return [(int(w) * self.window_ns + self.origin_ns, int(state["count"][i]),
+                 {method: float(out[method][i]) for method in self.methods})
+                for i, w in enumerate(windows.tolist())]
+
+    def _complete(self, mask):
+        if not mask.any():
+            return
+        self.completed.extend(self._results(mask))
+        self._closed = int(self.windows[mask].max())
+        for w in self.windows[mask].tolist():
+            self.values.pop(w, None)
+        keep = ~mask
+        self.windows = self.windows[keep]
+        self.state = {name: array[keep] for name, array in self.state.items()}
+
+    def current(self):
+        """Results of the open windows so far, [(window start ns, count, {method: value})]."""
+        return self._results(np.ones(len(self.windows), dtype=bool))
+
+    def pop_completed(self):
+        completed, self.completed = self.completed, []
+        return completed
+
+    def flush(self):
+        """Complete all open windows (end of input)."""
+        self._complete(np.ones(len(self.windows), dtype=bool))
+        return self.pop_completed()
+
+    def poll(self, buffer):
+        """Fold the points appended to a series_store.RingBuffer since the previous poll."""
+        times, values, self.seq = buffer.since(self.seq)
+        self.update(times, values.astype(np.float64))
+
+
+def aggregate_stations(ingest, window_seconds, methods=None, origin_ns=0):
+    """pandas DataFrame of the aggregates of all numeric series of all stations of an IngestWorker.
+
+    With methods=None every series is aggregated with the cell method declared for it in the station's Metadata
+    (MEAN when none is declared) and the result is in the "value" column; otherwise there is one column per method.
+    """
+    import pandas as pd
+
+    keys, series, declared = [], [], []
+    with ingest.lock:
+        for station_key, station in ingest.stations.items():
+            for key, buf in station.series.buffers.items():
+                if key[2] not in NUMERIC_KINDS or not len(buf):
+                    continue
+                descriptor = station.metadata.descriptor(key[0], key[1]) if station.metadata is not None else None
+                method = descriptor.cell_method if descriptor is not None else "CELL_METHOD_UNSPECIFIED"
+                keys.append((station_key,) + key)
+                series.append(buf.arrays())
+                declared.append(method if method in METHODS else "MEAN")
+
+    wanted = sorted(set(declared)) if methods is None else list(methods)
+    ids, starts, counts, out = aggregate(series, window_seconds, wanted, origin_ns)
+    frame = pd.DataFrame({
+        "station": [keys[i][0] for i in ids.tolist()],
+        "parameterDefinitionId": [keys[i][1] for i in ids.tolist()],
+        "index": [keys[i][2] for i in ids.tolist()],
+        "window_start": pd.to_datetime(starts, unit="ns", utc=True),
+        "count": counts,
+    })
+    if methods is None:
+        cell_methods = np.array(declared + [""], dtype=object)[ids]
+        value = np.full(len(ids), np.nan)
+        for method in wanted:
+            selected = cell_methods == method
+            value[selected] = out[method][selected]
+        frame["cell_method"] = cell_methods
+        frame["value"] = value
+    else:
+        for method in methods:
+            frame[method] = out[method]
+    return frame
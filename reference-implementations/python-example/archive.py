@@ -0,0 +1,290 @@
+# Durable archive of received FirstMileMessage payloads
+#
+# Clause 10 of the guide requires Data messages and their Metadata to be archived together with the NodeID
+# from the topic. The archive stores the raw serialized payloads exactly as received, so nothing is lost in
+# decoding, in append-only segment files:
+#
+#   segment-NNNNNNNN.fma   SEGMENT_MAGIC, then records of
+#                          RECORD_HEADER (payload length, payload crc32, receive time ns, topic length,
+#                          first 8 bytes of the metadata hash in force) + topic + payload
+#   segment-NNNNNNNN.idx   one INDEX_RECORD per record: (receive time ns, offset in the segment, crc32 of the
+#                          vendor/nodeid station key)
+#   manifest.json          time range and record count of every closed segment
+#
+# Writes are buffered and fsync'ed in batches (every fsync_records records or fsync_interval seconds);
+# segments are rotated at segment_bytes. A time range for one node is found from the manifest and the small
+# sidecar indexes without reading the payload files. A writer never appends to an existing segment, so a
+# crash can at most leave a truncated last record, which readers skip.
+#
+# Usage:
+#   python3 archive.py list ./archive
+#   python3 archive.py dump ./archive --node geolux/AWS123 --start 2026-03-11T00:00:00Z --end 2026-03-12T00:00:00Z
+
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+from google.protobuf.timestamp_pb2 import Timestamp
+
+SEGMENT_MAGIC = b"FMARCH1\n"
+RECORD_HEADER = struct.Struct("<IIqH8s")
+INDEX_RECORD = struct.Struct("<qQI")
+INDEX_DTYPE = np.dtype([("time", "<i8"), ("offset", "<u8"), ("node", "<u4")])
+MANIFEST = "manifest.json"
+
+
+def node_hash(key):
+    return zlib.crc32(key.encode("utf-8"))
+
+
+def station_key(topic):
+    # firstmile/{version}/{vendor}/{nodeid} -> vendor/nodeid
+    parts = topic.split("/")
+    return "/".join(parts[2:4]) if len(parts) >= 4 else topic
+
+
+def segment_name(number, ext):
+    return f"segment-{number:08d}.{ext}"
+
+
+class ArchiveWriter:
+    """Append-only, segmented writer; not thread-safe, used from the ingest worker thread."""
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync_records=1000, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.manifest = load_manifest(directory)
+        existing = [int(name[8:16]) for name in os.listdir(directory)
+                    if name.startswith("segment-") and name.endswith(".fma")]
+        # segments left open by a previous run are closed into the manifest, a new one is always started
+        for number in sorted(existing):
+            if str(number) not in self.manifest:
+                self.manifest[str(number)] = summarize_index(os.path.join(directory, segment_name(number, "idx")))
+        self.number = max(existing, default=0)
+        self.records = 0
+        self.bytes = 0
+        self.syncs = 0
+        self._data = None
+        self._index = None
+        self._open_next()
+
+    def _open_next(self):
+        self.number += 1
+        self._data = open(os.path.join(self.directory, segment_name(self.number, "fma")), "wb")
+        self._index = open(os.path.join(self.directory, segment_name(self.number, "idx")), "wb")
+        self._data.write(SEGMENT_MAGIC)
+        self._offset = len(SEGMENT_MAGIC)
+        self._first = None
+        self._last = None
+        self._segment_records = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, topic, payload, received_ns=None, metadata_hash=None):
+        if received_ns is None:
+            received_ns = time.time_ns()
+        topic_bytes = topic.encode("utf-8")
+        digest = bytes.fromhex(metadata_hash[:16]) if metadata_hash else bytes(8)
+
+        self._data.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), received_ns, len(topic_bytes), digest))
+        self._data.write(topic_bytes)
+        self._data.write(payload)
+        self._index.write(INDEX_RECORD.pack(received_ns, self._offset, node_hash(station_key(topic))))
+
+        self._offset += RECORD_HEADER.size + len(topic_bytes) + len(payload)
+        self._first = received_ns if self._first is None else min(self._first, received_ns)
+        self._last = received_ns if self._last is None else max(self._last, received_ns)
+        self._segment_records += 1
+        self._unsynced += 1
+        self.records += 1
+        self.bytes += len(payload)
+
+        if self._offset >= self.segment_bytes:
+            self.rotate()
+        elif self._unsynced >= self.fsync_records or time.monotonic() - self._last_sync >= self.fsync_interval:
+            # checked on every append, not only when the queue is idle, so steady traffic is synced in time too
+            self.sync()
+
+    def sync_if_due(self):
+        """Sync the records appended since the last sync once fsync_interval has passed without a new one."""
+        if self._unsynced and time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        # payloads first, so an index entry never points past the durable end of the segment
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.syncs += 1
+
+    def rotate(self):
+        self.close()
+        self._open_next()
+
+    def close(self):
+        if self._data is None:
+            return
+        self.sync()
+        self._data.close()
+        self._index.close()
+        self._data = None
+        self.manifest[str(self.number)] = {"first": self._first, "last": self._last, "records": self._segment_records}
+        save_manifest(self.directory, self.manifest)
+
+
+def load_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def read_index(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    # a crash may leave a partial index entry at the end
+    usable = len(raw) - len(raw) % INDEX_DTYPE.itemsize
+    return np.frombuffer(raw[:usable], dtype=INDEX_DTYPE)
+
+
+def summarize_index(path):
+    index = read_index(path) if os.path.exists(path) else np.zeros(0, dtype=INDEX_DTYPE)
+    if not len(index):
+        return {"first": None, "last": None, "records": 0}
+    return {"first": int(index["time"].min()), "last": int(index["time"].max()), "records": len(index)}
+
+
+class ArchiveReader:
+    """Time range / node queries over an archive directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        manifest = load_manifest(self.directory)
+        numbers = sorted(int(name[8:16]) for name in os.listdir(self.directory)
+                         if name.startswith("segment-") and name.endswith(".fma"))
+        for number in numbers:
+            # the active (or crashed) segment is not in the manifest yet
+            info = manifest.get(str(number)) or summarize_index(
+                os.path.join(self.directory, segment_name(number, "idx")))
+            yield number, info
+
+    def query(self, node=None, start_ns=None, end_ns=None):
+        """Yield (receive time ns, topic, payload, metadata hash prefix) in archive order."""
+        node_id = node_hash(node) if node else None
+        for number, info in self.segments():
+            if not info["records"]:
+                continue
+            if start_ns is not None and info["last"] < start_ns:
+                continue
+            if end_ns is not None and info["first"] > end_ns:
+                continue
+
+            index = read_index(os.path.join(self.directory, segment_name(number, "idx")))
+            mask = np.ones(len(index), dtype=bool)
+            if start_ns is not None:
+                mask &= index["time"] >= start_ns
+            if end_ns is not None:
+                mask &= index["time"] <= end_ns
+            if node_id is not None:
+                mask &= index["node"] == node_id
+            offsets = index["offset"][mask]
+            if not len(offsets):
+                continue
+
+            with open(os.path.join(self.directory, segment_name(number, "fma")), "rb") as f:
+                # read sequentially when most of the segment is selected, seek otherwise
+                sequential = len(offsets) > len(index) // 4
+                data = f.read() if sequential else None
+                for offset in offsets.tolist():
+                    record = read_record(data, offset) if sequential else read_record_at(f, offset)
+                    if record is None:
+                        break
+                    received_ns, topic, payload, digest = record
+                    if node and station_key(topic) != node:
+                        continue  # crc32 collision
+                    yield received_ns, topic, payload, digest
+
+    def scan(self):
+        return self.query()
+
+
+def _decode_record(header, body):
+    length, crc, received_ns, topic_len, digest = header
+    topic = body[:topic_len].decode("utf-8")
+    payload = body[topic_len:topic_len + length]
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        return None
+    return received_ns, topic, payload, digest.hex()
+
+
+def read_record(data, offset):
+    if offset + RECORD_HEADER.size > len(data):
+        return None
+    header = RECORD_HEADER.unpack_from(data, offset)
+    start = offset + RECORD_HEADER.size
+    return _decode_record(header, data[start:start + header[3] + header[0]])
+
+
+def read_record_at(f, offset):
+    f.seek(offset)
+    raw = f.read(RECORD_HEADER.size)
+    if len(raw) < RECORD_HEADER.size:
+        return None
+    header = RECORD_HEADER.unpack(raw)
+    return _decode_record(header, f.read(header[3] + header[0]))
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    ts = Timestamp()
+    ts.FromJsonString(value)
+    return ts.seconds * 1_000_000_000 + ts.nanos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="First mile payload archive tool")
+    parser.add_argument("command", choices=["list", "dump"], help="list segments or dump matching records")
+    parser.add_argument("directory", help="Archive directory")
+    parser.add_argument("--node", help="Station key vendor/nodeid")
+    parser.add_argument("--start", help="Start of the receive time range (RFC 3339)")
+    parser.add_argument("--end", help="End of the receive time range (RFC 3339)")
+    args = parser.parse_args()
+
+    reader = ArchiveReader(args.directory)
+    if args.command == "list":
+        for number, info in reader.segments():
+            print(segment_name(number, "fma"), info)
+        return
+
+    for received_ns, topic, payload, digest in reader.query(args.node, parse_time(args.start), parse_time(args.end)):
+        ts = Timestamp()
+        ts.FromNanoseconds(received_ns)
+        print(f"{ts.ToJsonString()} {topic} {len(payload)} bytes metadata={digest}")
+
+
+if __name__ == "__main__":
+    main()
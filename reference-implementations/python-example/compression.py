@@ -0,0 +1,206 @@
+# Optional zstd compression of FirstMileMessage payloads
+#
+# Metadata messages repeat long strings (longName, units, standard name URIs) and Data batches repeat the same
+# field layout, so both compress well, in particular with a zstd dictionary trained on typical payloads: even a
+# single small Data message then shrinks, which plain compression cannot do.
+#
+# Signalling: a compressed payload is a zstd frame, which starts with the zstd magic number 28 B5 2F FD, while a
+# serialized FirstMileMessage starts with the tag of its metadata (0x0A) or data (0x12) field. The receiver
+# therefore detects compressed payloads by themselves, on any topic and with MQTT 3.1.1 as well as 5, and the frame
+# header carries the id of the dictionary that was used, so several dictionaries can be deployed side by side.
+#
+# The dictionary is trained on the Metadata and Data payloads of standard/examples and standard/tests and on the
+# Metadata of data-sender.py, all fixed, so training the same tree gives the same dictionary. Still, deploy the one
+# dictionary file to both sides: a payload compressed with a dictionary the receiver does not have is lost.
+# A decompressed payload is limited to MAX_DECOMPRESSED_BYTES, larger ones are rejected like unparseable payloads.
+# python3 compression.py train --output firstmile.zdict
+# python3 compression.py bench --dict firstmile.zdict
+# python3 compression.py bench --dict firstmile.zdict ./archive
+
+import argparse
+import glob
+import importlib.util
+import os
+import sys
+import time
+
+try:
+    import zstandard
+except ImportError:  # only needed when compression is used
+    zstandard = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DEFAULT_LEVEL = 3
+DICT_SIZE = 16 * 1024
+SAMPLE_OBSERVATIONS = 4
+MAX_DECOMPRESSED_BYTES = 16 * 1024 * 1024
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError("zstd compression requires the zstandard package (pip install zstandard)")
+
+
+def is_compressed(payload):
+    return payload[:4] == ZSTD_MAGIC
+
+
+def load_dictionary(path):
+    require_zstandard()
+    with open(path, "rb") as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+
+class Compressor:
+    """Compresses payloads with zstd, optionally with a dictionary; used from one thread."""
+
+    def __init__(self, dictionary=None, level=DEFAULT_LEVEL):
+        require_zstandard()
+        self.dictionary = dictionary
+        # no checksum in the frame header: a few bytes matter on small messages, and MQTT runs over TCP anyway
+        self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary, write_content_size=True,
+                                                    write_checksum=False, write_dict_id=True)
+
+    def compress(self, payload):
+        return self._compressor.compress(payload)
+
+
+class Decompressor:
+    """Turns received payloads back into serialized FirstMileMessages; uncompressed payloads pass through."""
+
+    def __init__(self, dictionaries=(), max_size=MAX_DECOMPRESSED_BYTES):
+        self.max_size = max_size
+        self.decompressors = {}
+        self.compressed = 0
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        for dictionary in dictionaries:
+            self._add(dictionary.dict_id(), dictionary)
+
+    def _add(self, dict_id, dictionary=None):
+        require_zstandard()
+        decompressor = self.decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return decompressor
+
+    def decompress(self, payload):
+        if not is_compressed(payload):
+            return payload
+        require_zstandard()
+        frame = zstandard.get_frame_parameters(payload)
+        # the content size is unknown (ZSTD_CONTENTSIZE_UNKNOWN) when the sender did not write it, max_output_size
+        # then bounds the output
+        if frame.content_size != zstandard.CONTENTSIZE_UNKNOWN and frame.content_size > self.max_size:
+            raise ValueError(f"compressed payload of {frame.content_size} bytes exceeds {self.max_size}")
+        dict_id = frame.dict_id
+        decompressor = self.decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id:
+                raise ValueError(f"payload compressed with unknown zstd dictionary {dict_id}")
+            decompressor = self._add(0)
+        result = decompressor.decompress(payload, max_output_size=self.max_size)
+        self.compressed += 1
+        self.compressed_bytes += len(payload)
+        self.decompressed_bytes += len(result)
+        return result
+
+
+def training_payloads(root=os.path.join("..", "..", "standard")):
+    """Serialized Metadata messages and small Data batches from the JSON files under root, plus the sender's
+    Metadata. The sender's Data messages are left out, their random values and times would change the dictionary."""
+    from payload_files import load_json_sequence
+    from protospy import firstmile_pb2 as pb2
+
+    spec = importlib.util.spec_from_file_location("data_sender", "data-sender.py")
+    sender = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sender)
+    messages = [pb2.FirstMileMessage(metadata=sender.build_metadata_transmission())]
+
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.json"), recursive=True)):
+        try:
+            messages.extend(load_json_sequence(path))
+        except Exception:
+            continue  # not a payload sequence (e.g. schema bindings)
+
+    samples = []
+    for message in messages:
+        if message.WhichOneof("content") != "data":
+            samples.append(message.SerializeToString())
+            continue
+        # long recorded batches are cut into the message sizes the dictionary should be good at
+        observations = message.data.observations
+        for i in range(0, len(observations), SAMPLE_OBSERVATIONS):
+            chunk = pb2.Data(observations=observations[i:i + SAMPLE_OBSERVATIONS])
+            samples.append(pb2.FirstMileMessage(data=chunk).SerializeToString())
+    return samples
+
+
+def train(samples, size=DICT_SIZE):
+    require_zstandard()
+    return zstandard.train_dictionary(size, samples)
+
+
+def bench(payloads, dictionary, level, rounds=20):
+    """Wire size and CPU time per message of raw protobuf, zstd and zstd + dictionary."""
+    variants = {"zstd": Compressor(None, level)}
+    if dictionary is not None:
+        variants["zstd+dict"] = Compressor(dictionary, level)
+    decompressor = Decompressor([dictionary] if dictionary is not None else [])
+
+    raw_bytes = sum(len(p) for p in payloads)
+    results = {"raw": {"bytes_per_message": raw_bytes / len(payloads), "ratio": 1.0,
+                       "compress_us": 0.0, "decompress_us": 0.0}}
+    for name, compressor in variants.items():
+        started = time.perf_counter()
+        for _ in range(rounds):
+            compressed = [compressor.compress(p) for p in payloads]
+        compress_s = (time.perf_counter() - started) / rounds / len(payloads)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for c in compressed:
+                decompressor.decompress(c)
+        decompress_s = (time.perf_counter() - started) / rounds / len(payloads)
+        size = sum(len(c) for c in compressed)
+        results[name] = {"bytes_per_message": size / len(payloads), "ratio": raw_bytes / size,
+                         "compress_us": compress_s * 1e6, "decompress_us": decompress_s * 1e6}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="zstd dictionary training and compression benchmark")
+    parser.add_argument("command", choices=["train", "bench"], help="train a dictionary or benchmark compression")
+    parser.add_argument("--output", default="firstmile.zdict", help="Dictionary file written by train")
+    parser.add_argument("--dict", help="Dictionary file used by bench")
+    parser.add_argument("--size", type=int, default=DICT_SIZE, help="Dictionary size in bytes")
+    parser.add_argument("--level", type=int, default=DEFAULT_LEVEL, help="zstd compression level")
+    parser.add_argument("inputs", nargs="*", help="Payload files or archives benchmarked instead of the training payloads")
+    args = parser.parse_intermixed_args()
+
+    if args.command == "bench" and args.inputs:
+        from payload_files import load_payloads
+        samples = [payload for path in args.inputs for _, _, payload in load_payloads(path)]
+    else:
+        samples = training_payloads()
+    if args.command == "train":
+        dictionary = train(samples, args.size)
+        with open(args.output, "wb") as f:
+            f.write(dictionary.as_bytes())
+        print(f"Trained dictionary {dictionary.dict_id()} ({len(dictionary.as_bytes())} bytes) "
+              f"from {len(samples)} payloads, written to {args.output}")
+        return
+
+    from protospy import firstmile_pb2 as pb2
+    dictionary = load_dictionary(args.dict) if args.dict else None
+    # benchmarked separately: Metadata and Data compress very differently
+    groups = {"metadata": [], "data": []}
+    for payload in samples:
+        message = pb2.FirstMileMessage.FromString(payload)
+        groups[message.WhichOneof("content") or "metadata"].append(payload)
+    print(f"{'payloads':<9} {'variant':<10} {'B/msg':>8} {'ratio':>6} {'compress us':>12} {'decompress us':>14}")
+    for group, payloads in groups.items():
+        for name, result in bench(payloads, dictionary, args.level).items():
+            print(f"{group:<9} {name:<10} {result['bytes_per_message']:>8.1f} {result['ratio']:>6.2f} "
+                  f"{result['compress_us']:>12.1f} {result['decompress_us']:>14.1f}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,415 @@
+# CSV to FirstMileMessage converter
+#
+# Converts the CSV files of legacy data loggers into FirstMileMessage payloads, to backfill station history.
+# What goes where is described by a binding directory in the format of standard/examples/example_schema_binding
+# (node.json, observer.json, parameters.json, namespaces.json, see schema_binding.py) plus columns.json, which
+# maps CSV columns onto the parameters:
+#
+#   {"time": {"column": "bs. Time", "format": "%d/%m/%Y %H:%M", "timezone": "UTC"},
+#    "bindings": [{"column": "Lat", "parameterDefinitionId": 1, "index": 0, "kind": "floatValue"}, ...]}
+#
+# A column is given by its header name (the first column of that name) or its position. "index" is the position
+# of the value among the parameters of the definition, "kind" the Value field it is written as (default
+# doubleValue). Parameters without a column, and empty or unparsable cells, become emptyValue. Instead of a
+# "format", the time column can have a "unit" ("s", "ms", ...) for epoch numbers; naive times are in "timezone".
+# Every CSV row gives one Observation per parameterDefinitionId that has a value in that row.
+#
+# Files are read in chunks of --chunk-rows rows, so their size is not limited by memory, parsed column-wise by
+# pandas and encoded a column at a time (wire_encoding.py). Rows are batched into Data messages of at most
+# --max-payload-bytes and --batch-rows rows. Each file is one station, firstmile/poc1/{--vendor}/{file name}
+# (or --node), whose Metadata is sent before its data. Files are converted in --workers processes.
+#
+# Targets (--target):
+#   file     one length-delimited capture per input in the --output directory (see payload_files.py)
+#   archive  an archive directory (archive.py), the newest observation time of each message as its receive time
+#   mqtt     published to a broker, the Metadata retained
+#
+# python3 csv-converter.py ../../standard/tests/flexibility/weather/trajectory/AMDAR/VH_QPF.csv --binding bindings/amdar --output converted --drop-repeated-times
+# python3 csv-converter.py logs/*.csv --binding bindings/amdar --workers 4 --target archive --output ./archive
+# python3 csv-converter.py logs/*.csv --binding bindings/amdar --target mqtt --broker localhost
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import re
+import time
+from collections import Counter, namedtuple
+
+import numpy as np
+import pandas as pd
+
+import wire_encoding
+from payload_files import write_delimited
+from schema_binding import load_metadata
+from protospy import firstmile_pb2 as pb2
+
+proto_version = 'poc1'
+INTEGER_KINDS = {"intValue": np.int64, "unsignedIntValue": np.uint64, "int64Value": np.int64,
+                 "unsignedInt64Value": np.uint64}
+TRUE_STRINGS = {"1", "true", "t", "yes", "y", "on"}
+FALSE_STRINGS = {"0", "false", "f", "no", "n", "off"}
+
+# time: (CSV position, time spec of columns.json); definitions: [(parameterDefinitionId, [(position, kind) or
+# None per parameter])]; kinds: {position: kind}
+ConversionPlan = namedtuple("ConversionPlan", ["time", "definitions", "kinds"])
+
+
+def load_binding(directory):
+    """(pb2.Metadata, columns.json mapping) of a binding directory."""
+    metadata = load_metadata(directory)
+    with open(os.path.join(directory, "columns.json"), "r", encoding="utf-8") as f:
+        columns = json.load(f)
+
+    sizes = {pdef.id: len(pdef.parameters) for pdef in metadata.parameterDefinitions}
+    bound = set()
+    for binding in columns["bindings"]:
+        param_id, index = binding["parameterDefinitionId"], binding["index"]
+        if param_id not in sizes:
+            raise ValueError(f"columns.json: parameterDefinitionId {param_id} is not in parameters.json")
+        if not 0 <= index < sizes[param_id]:
+            raise ValueError(f"columns.json: parameterDefinitionId {param_id} has no parameter {index}")
+        if binding.setdefault("kind", "doubleValue") not in wire_encoding.VALUE_FIELDS:
+            raise ValueError(f"columns.json: unknown kind {binding['kind']}")
+        if (param_id, index) in bound:
+            raise ValueError(f"columns.json: parameter {index} of parameterDefinitionId {param_id} is bound twice")
+        bound.add((param_id, index))
+    return metadata, columns
+
+
+def read_header(path, delimiter, encoding):
+    with open(path, "r", encoding=encoding, newline="") as f:
+        return next(csv.reader(f, delimiter=delimiter), [])
+
+
+def compile_plan(header, metadata, columns):
+    """ConversionPlan of a CSV file with this header."""
+    names = [name.strip() for name in header]
+
+    def position(column):
+        if isinstance(column, int):
+            if not 0 <= column < len(names):
+                raise ValueError(f"column {column} is beyond the {len(names)} columns of the header")
+            return column
+        if column.strip() not in names:
+            raise ValueError(f"column {column!r} is not in the header")
+        return names.index(column.strip())
+
+    sizes = {pdef.id: len(pdef.parameters) for pdef in metadata.parameterDefinitions}
+    definitions = {}
+    kinds = {}
+    for binding in columns["bindings"]:
+        param_id = binding["parameterDefinitionId"]
+        slots = definitions.setdefault(param_id, [None] * sizes[param_id])
+        pos = position(binding["column"])
+        # a column bound twice is read with the kind of its first binding
+        kinds.setdefault(pos, binding["kind"])
+        slots[binding["index"]] = (pos, binding["kind"])
+    return ConversionPlan((position(columns["time"]["column"]), columns["time"]),
+                          sorted(definitions.items()), kinds)
+
+
+def parse_distinct(column, time_format):
+    """pd.to_datetime of the column, parsing every distinct string only once."""
+    codes, distinct = pd.factorize(column)
+    parsed = pd.DatetimeIndex(pd.to_datetime(distinct, format=time_format, errors="coerce"))
+    return parsed.take(codes, allow_fill=True, fill_value=pd.NaT)
+
+
+def parse_formatted(column, time_format):
+    """Datetimes of the strings of the column in time_format."""
+    # strptime costs several us per string; a date and a time of day separated by a space are parsed apart,
+    # since a logger file has few distinct days and at most 86400 distinct times of day
+    date_format, _, clock_format = time_format.partition(" ")
+    halves = column.str.strip().str.split(" ", n=1, expand=True)
+    if not clock_format or " " in clock_format or halves.shape[1] != 2:
+        return pd.Series(pd.to_datetime(column, format=time_format, errors="coerce"))
+    days = parse_distinct(halves[0], date_format)
+    clock = parse_distinct(halves[1], clock_format) - pd.Timestamp("1900-01-01")
+    return pd.Series(days + clock)
+
+
+def parse_times(column, spec):
+    """(times ns, valid) of the time column, in UTC."""
+    if spec.get("unit"):
+        times = pd.to_datetime(pd.to_numeric(column, errors="coerce"), unit=spec["unit"], utc=True)
+    else:
+        if spec.get("format"):
+            times = parse_formatted(column, spec["format"])
+        else:
+            times = pd.to_datetime(column, errors="coerce")
+        if times.dt.tz is None:
+            times = times.dt.tz_localize(spec.get("timezone", "UTC"), ambiguous="NaT", nonexistent="NaT")
+    valid = times.notna().to_numpy()
+    times_ns = times.dt.tz_convert("UTC").dt.tz_localize(None).dt.as_unit("ns").to_numpy().view(np.int64)
+    return times_ns, valid
+
+
+def parse_values(column, kind):
+    """(values, missing, number of unparsable cells) of a column as read by read_chunks()."""
+    blank = column.isna().to_numpy()
+    if kind == "stringValue":
+        return column.to_numpy(dtype=object), blank, 0
+    if kind == "boolValue":
+        lowered = column.str.strip().str.lower()
+        values = lowered.isin(TRUE_STRINGS).to_numpy()
+        missing = ~(values | lowered.isin(FALSE_STRINGS).to_numpy())
+    elif kind in INTEGER_KINDS:
+        numbers = pd.to_numeric(column, errors="coerce", dtype_backend="numpy_nullable")
+        missing = numbers.isna().to_numpy()
+        values = numbers.fillna(0).to_numpy().astype(INTEGER_KINDS[kind])
+    else:
+        # already parsed as numbers unless the chunk has cells that are not
+        if column.dtype.kind not in "fiu":
+            column = pd.to_numeric(column, errors="coerce")
+        values = column.to_numpy(dtype=np.float64)
+        missing = np.isnan(values)
+    return values, missing, int((missing & ~blank).sum())
+
+
+def read_chunks(path, plan, chunk_rows, delimiter, encoding):
+    """DataFrames of up to chunk_rows rows of the bound columns, columns named by CSV position."""
+    positions = sorted(set(plan.kinds) | {plan.time[0]})
+    # floating point columns are left to the C parser, which makes them float64 when every cell parses; the
+    # others are read as strings, integers so that 64-bit values next to empty cells keep all their digits
+    dtypes = {pos: str for pos, kind in plan.kinds.items() if kind not in ("floatValue", "doubleValue")}
+    if not plan.time[1].get("unit"):
+        dtypes[plan.time[0]] = str
+    # the header row sets the number of columns, rows with fewer fields (trailing empty cells left out) are
+    # padded; header names may repeat or be blank, so the columns are renamed to their positions
+    reader = pd.read_csv(path, sep=delimiter, encoding=encoding, header=0, usecols=positions, dtype=dtypes,
+                         chunksize=chunk_rows, skipinitialspace=True, on_bad_lines="warn")
+    for frame in reader:
+        frame.columns = positions
+        yield frame
+
+
+def encode_chunk(frame, plan, counts, last_time, drop_repeated=False):
+    """(Data.observations of each row back to back, bytes per row, row times ns) of a chunk; rows without a
+    valid time or without any value are left out, as are, with drop_repeated, rows whose time is not after the
+    time of an earlier row (last_time: newest time of the previous chunks)."""
+    counts["rows"] += len(frame)
+    times, valid = parse_times(frame[plan.time[0]], plan.time[1])
+    columns = {}
+    for pos, kind in plan.kinds.items():
+        values, missing, unparsable = parse_values(frame[pos], kind)
+        columns[pos] = (values, missing)
+        counts["unparsable_cells"] += unparsable
+
+    present = {param_id: ~np.logical_and.reduce([columns[slot[0]][1] for slot in slots if slot is not None])
+               for param_id, slots in plan.definitions}
+    keep = valid & np.logical_or.reduce(list(present.values()))
+    counts["rows_without_time"] += int((~valid).sum())
+    # loggers with a coarse clock repeat times, which the receiver rejects within a message (non_monotonic)
+    newest = np.maximum.accumulate(np.where(keep, times, np.iinfo(np.int64).min))
+    earlier = np.concatenate([[last_time], np.maximum(newest[:-1], last_time)])
+    repeated = keep & (times <= earlier)
+    counts["rows_with_repeated_time"] += int(repeated.sum())
+    if drop_repeated:
+        keep &= ~repeated
+    n = int(keep.sum())
+    counts["rows_converted"] += n
+    last_time = max(last_time, int(newest[-1])) if len(newest) else last_time
+    times = times[keep]
+
+    parts = []
+    for param_id, slots in plan.definitions:
+        cells = []
+        for slot in slots:
+            if slot is None:
+                cells.append(wire_encoding.constant(n, wire_encoding.EMPTY_CELL))
+            else:
+                values, missing = columns[slot[0]]
+                cells.append(wire_encoding.value_cells(slot[1], values[keep], missing[keep]))
+        rows = present[param_id][keep]
+        parts.append(wire_encoding.observations(param_id, times, cells, rows))
+        counts["observations"] += int(rows.sum())
+    stream, lengths = wire_encoding.flatten(parts) if n else (np.zeros(0, np.uint8), np.zeros(0, np.int64))
+    return stream, lengths, times, last_time
+
+
+def convert_file(path, options, send, counts):
+    """Convert one CSV file; send(topic, payload, received_ns, is_metadata) gets its Metadata, then its Data,
+    received_ns being the newest observation time of the message (the first one for the Metadata)."""
+    metadata, columns = load_binding(options.binding)
+    plan = compile_plan(read_header(path, options.delimiter, options.encoding), metadata, columns)
+    node = options.node or re.sub(r"[^A-Za-z0-9_.-]+", "_", os.path.splitext(os.path.basename(path))[0])
+    topic = f"firstmile/{proto_version}/{options.vendor}/{node}"
+    metadata_payload = pb2.FirstMileMessage(metadata=metadata).SerializeToString()
+
+    stream, lengths, times = np.zeros(0, np.uint8), np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    def emit(final):
+        # without final, the last batch is held back to be continued with the rows of the next chunk
+        nonlocal stream, lengths, times, metadata_payload
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        ends = wire_encoding.batch_ends(lengths, options.max_payload_bytes, options.batch_rows)
+        start = 0
+        for end in ends if final else ends[:-1]:
+            if metadata_payload is not None:
+                send(topic, metadata_payload, int(times[start:end].min()), True)
+                metadata_payload = None
+            payload = wire_encoding.data_message(stream[offsets[start]:offsets[end]])
+            send(topic, payload, int(times[start:end].max()), False)
+            counts["messages"] += 1
+            counts["bytes"] += len(payload)
+            start = end
+        stream, lengths, times = stream[offsets[start]:], lengths[start:], times[start:]
+
+    last_time = np.iinfo(np.int64).min
+    for frame in read_chunks(path, plan, options.chunk_rows, options.delimiter, options.encoding):
+        new_stream, new_lengths, new_times, last_time = encode_chunk(frame, plan, counts, last_time,
+                                                                     options.drop_repeated_times)
+        stream = np.concatenate([stream, new_stream])
+        lengths = np.concatenate([lengths, new_lengths])
+        times = np.concatenate([times, new_times])
+        emit(final=False)
+    emit(final=True)
+    if metadata_payload is not None:
+        send(topic, metadata_payload, None, True)  # a file without data
+    counts["files"] += 1
+    return counts
+
+
+def convert_to_file(path, options):
+    """Counts of converting path into a length-delimited capture in options.output."""
+    counts = Counter()
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", os.path.splitext(os.path.basename(path))[0])
+    with open(os.path.join(options.output, f"{name}.pb"), "wb") as f:
+        convert_file(path, options, lambda topic, payload, received_ns, is_metadata: write_delimited(f, payload),
+                     counts)
+    return counts
+
+
+_sink = None
+
+
+def init_worker(sink):
+    global _sink
+    _sink = sink
+
+
+def convert_to_queue(path, options):
+    """Counts of converting path, its payloads put on the queue of the parent process, then None."""
+    counts = Counter()
+    convert_file(path, options, lambda *item: _sink.put(item), counts)
+    _sink.put(None)
+    return counts
+
+
+def run_parallel(inputs, options, consume=None):
+    """Convert the inputs in options.workers processes; consume(topic, payload, received_ns, is_metadata) is
+    called in this process for each payload. Returns the summed counts."""
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    sink = context.Queue(maxsize=1000) if consume else None
+    totals = Counter()
+    with context.Pool(options.workers, initializer=init_worker, initargs=(sink,)) as pool:
+        results = [pool.apply_async(convert_to_queue if consume else convert_to_file, (path, options))
+                   for path in inputs]
+        # every file ends with None on the queue, after all of its payloads
+        finished = 0
+        while consume and finished < len(results):
+            try:
+                item = sink.get(timeout=0.1)
+            except queue.Empty:
+                for result in results:
+                    if result.ready() and not result.successful():
+                        result.get()  # raises the error of the failed file
+                continue
+            if item is None:
+                finished += 1
+            else:
+                consume(*item)
+        for result in results:
+            totals += result.get()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert logger CSV files into FirstMileMessage payloads")
+    parser.add_argument("inputs", nargs="+", help="CSV files, one station each")
+    parser.add_argument("--binding", required=True, help="Binding directory: node.json, parameters.json, namespaces.json, observer.json and columns.json")
+    parser.add_argument("--target", choices=["file", "archive", "mqtt"], default="file", help="Length-delimited files, an archive directory or an MQTT broker")
+    parser.add_argument("--output", help="Output directory of the file and archive targets")
+    parser.add_argument("--vendor", default="csv", help="Vendor of the station topics")
+    parser.add_argument("--node", help="NodeID of all inputs (default: the file name of each input)")
+    parser.add_argument("--workers", type=int, default=1, help="Convert the inputs in this many processes")
+    parser.add_argument("--chunk-rows", type=int, default=100000, help="CSV rows read and encoded at a time")
+    parser.add_argument("--batch-rows", type=int, default=0, help="At most this many CSV rows per Data message (0: no limit)")
+    parser.add_argument("--max-payload-bytes", type=int, default=256 * 1024, help="Size limit of a Data message")
+    parser.add_argument("--drop-repeated-times", action="store_true", help="Leave out rows whose time is not after an earlier row's")
+    parser.add_argument("--delimiter", default=",", help="CSV field delimiter")
+    parser.add_argument("--encoding", default="utf-8", help="Text encoding of the CSV files")
+    # broker options are only needed with --target mqtt
+    from mqtt_publisher import MqttPublisher, add_publisher_arguments, format_stats
+    add_publisher_arguments(parser, broker_required=False)
+    args = parser.parse_args()
+
+    if args.target == "mqtt" and not args.broker:
+        parser.error("--broker is required with --target mqtt")
+    if args.target != "mqtt" and not args.output:
+        parser.error(f"--output is required with --target {args.target}")
+    load_binding(args.binding)  # fail early on a bad binding
+    if args.target == "file":
+        os.makedirs(args.output, exist_ok=True)
+
+    consume = None
+    if args.target == "archive":
+        from archive import ArchiveWriter
+        from metadata_index import content_hash
+        writer = ArchiveWriter(args.output)
+        hashes = {}
+
+        def consume_archive(topic, payload, received_ns, is_metadata):
+            if is_metadata:
+                message = pb2.FirstMileMessage()
+                message.ParseFromString(payload)
+                hashes[topic] = content_hash(message.metadata)
+            writer.append(topic, payload, received_ns, hashes.get(topic))
+        consume = consume_archive
+    elif args.target == "mqtt":
+        publisher = MqttPublisher.from_args(args, client_id=f"{args.vendor}-csv-converter")
+        publisher.start()
+
+        def consume_mqtt(topic, payload, received_ns, is_metadata):
+            if is_metadata:
+                publisher.set_retained(topic, payload)
+                return
+            # wait for room in the local queue rather than have the client refuse the message
+            while publisher.in_flight() >= args.max_queued:
+                time.sleep(0.01)
+            publisher.publish(topic, payload)
+        consume = consume_mqtt
+
+    started = time.perf_counter()
+    if args.workers > 1:
+        counts = run_parallel(args.inputs, args, consume)
+    else:
+        counts = Counter()
+        for path in args.inputs:
+            if consume is None:
+                counts += convert_to_file(path, args)
+            else:
+                convert_file(path, args, consume, counts)
+    if args.target == "archive":
+        writer.close()
+    elif args.target == "mqtt":
+        publisher.stop()
+        print(format_stats(publisher.stats.summary()))
+    elapsed = time.perf_counter() - started
+
+    print(f"Converted {counts['files']} files in {elapsed:.3f} s: {counts['rows_converted']} of {counts['rows']} rows "
+          f"({counts['rows'] / elapsed:.0f} rows/s), {counts['observations']} observations in {counts['messages']} "
+          f"messages, {counts['bytes']} bytes")
+    if counts["rows_without_time"] or counts["unparsable_cells"]:
+        print(f"  {counts['rows_without_time']} rows without a valid time skipped, "
+              f"{counts['unparsable_cells']} unparsable cells written as emptyValue")
+    if counts["rows_with_repeated_time"]:
+        print(f"  {counts['rows_with_repeated_time']} rows with a time not after an earlier row's "
+              f"({'left out' if args.drop_repeated_times else 'the receiver quarantines them, see --drop-repeated-times'})")
+
+
+if __name__ == "__main__":
+    main()
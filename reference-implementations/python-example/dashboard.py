@@ -0,0 +1,447 @@
+# Dash pages of the receiver
+#
+# Home page with a card per station and a site page per station with its metadata and graphs, refreshed every
+# 2 s from the station state of the ingest worker (ingest.IngestWorker or sharded_ingest.ShardedIngest).
+# data-receiver.py only imports this module when the dashboard is enabled, so the headless ingest mode never
+# loads Dash, Plotly or Flask.
+# Graphs never get more points per trace than the window is wide (decimation.py): the full series is drawn from its
+# min/max summaries, a zoom re-queries the visible time range at a finer level, down to the raw points.
+# The map page shows the station locations and, from the spatial index (spatial_index.py), the number of positions
+# per tile of the moving stations; zoomed in, their tracks in the visible area.
+
+import json
+import time
+from itertools import groupby
+
+import dash
+import dash_bootstrap_components as dbc
+import numpy as np
+import plotly.graph_objs as go
+from dash import ALL, MATCH, Patch, dcc, html, no_update
+from dash.dependencies import Input, Output, State
+from flask import Response
+
+from decimation import DEFAULT_POINTS, reduce, select
+from metrics import CONTENT_TYPE, REGISTRY
+from spatial_index import INDEX_ZOOM, tile_center
+
+# set by attach(), the station state is owned by the ingest worker
+ingest = None
+state = {}
+
+RENDER_SECONDS = REGISTRY.histogram("firstmile_render_seconds", "Time to build a page or graph update", ["page"])
+
+MIN_POINTS = 200
+MAX_POINTS = 4000
+
+DETAIL_ZOOM = 6  # map zoom from which tracks are drawn instead of the positions per tile
+TILE_ZOOM_OFFSET = 3  # positions are counted per tile of the map zoom + 3, an eighth of a map tile wide
+MAP_POINTS = 2000  # points drawn per track, sampled evenly
+
+
+def attach(worker):
+    """Show the stations of an ingest worker."""
+    global ingest, state
+    ingest = worker
+    state = worker.stations
+
+
+# UI display
+app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+
+# The page is only rebuilt when its signature changes (home: every tick; site: new metadata version or new series).
+# In between, the site graphs are extended with the points received since the last tick, tracked per trace by the
+# ring buffer sequence numbers kept in the "series-cursor" stores. A cursor also holds the number of points per
+# trace, the zoomed time range if any and the number of points extended since the traces were last decimated:
+# past the number of points per trace, or on new points in a zoomed range, the traces are decimated again.
+app.layout = html.Div([
+    dcc.Location(id="url"),
+    dcc.Store(id="page-signature"),
+    dcc.Store(id="viewport"),
+    html.Div(id="page-content"),
+    dcc.Interval(id="interval", interval=2*1000, n_intervals=0)
+])
+
+# the width of the browser window, in pixels, sets the number of points per trace
+app.clientside_callback("function(pathname) { return window.innerWidth; }",
+                        Output("viewport", "data"), Input("url", "pathname"))
+
+@app.server.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+def render_home_page():
+    cards = []
+
+    if not state:
+        return html.P("No topics received yet.")
+
+    with ingest.lock:
+        summaries = [(topic, site.metadata is not None, site.n_observations, len(site.series), site.series.nbytes,
+                      site.validator.n_quarantined)
+                     for topic, site in state.items()]
+
+    for topic, metadata_exists, n_obs, n_points, nbytes, n_quarantined in summaries:
+        card = dbc.Card([
+            dbc.CardHeader(html.H5(topic)),
+            dbc.CardBody([
+                html.P(f"Metadata received: {'Yes' if metadata_exists else 'No'}"),
+                html.P(f"Observations received: {n_obs}"),
+                html.P(f"Stored points: {n_points} ({nbytes / 1024:.0f} KiB)"),
+                html.P(f"Quarantined messages: {n_quarantined}", style={"color": "red"} if n_quarantined else {}),
+                dbc.Button("View details", href=f"/site/{topic}", color="primary")
+            ])
+        ], className="mb-3")
+        cards.append(card)
+
+    stats = ingest.stats
+    ingest_ui = html.P(f"Ingest: {stats.processed} processed, {stats.dropped} dropped, "
+                       f"{stats.parse_errors} parse errors, {stats.quarantined} quarantined, {ingest.compressed()} compressed, "
+                       f"{stats.duplicates} duplicate and {stats.late} late observations, {stats.evicted} evicted, "
+                       f"queue depth {ingest.queue_depth()}, "
+                       f"{sum(s[4] for s in summaries) / 1e6:.1f} MB of series storage",
+                       className="text-muted")
+
+    return dbc.Container([ingest_ui, dbc.Button("Map", href="/map", color="secondary", className="mb-3"), *cards])
+
+def plot_times(times):
+    return np.datetime_as_string(times.astype("datetime64[ns]"), unit="ms")
+
+def parse_plot_time(text):
+    """Plotly axis range bound ("2024-05-01 12:00:00.5") to epoch nanoseconds."""
+    return int(np.datetime64(str(text).replace(" ", "T")).astype("datetime64[ns]").astype(np.int64))
+
+def plot_points(width):
+    """Points per trace for a browser window `width` pixels wide, about one per pixel."""
+    return min(max(int(width), MIN_POINTS), MAX_POINTS) if width else DEFAULT_POINTS
+
+def select_traces(site_data, keys, time_range, points):
+    """Decimation candidates and sequence number of the series of a graph, called with the ingest lock held."""
+    start, end = time_range or (None, None)
+    traces = []
+    for key in keys:
+        buf = site_data.series.buffers.get(tuple(key)) if site_data else None
+        if buf is None:
+            traces.append((np.zeros(0, dtype=np.int64), np.zeros(0), 0))
+        else:
+            traces.append(select(buf, start, end, points) + (buf.total,))
+    return traces
+
+def traces_patch(traces, points):
+    """Figure update replacing the points of every trace with at most `points` of the candidates."""
+    patch = Patch()
+    for i, (times, values, _) in enumerate(traces):
+        times, values = reduce(times, values, points)
+        patch["data"][i]["x"] = plot_times(times).tolist()
+        patch["data"][i]["y"] = values.tolist()
+    return patch
+
+def site_signature(topic):
+    with ingest.lock:
+        site_data = state.get(topic)
+        if site_data is None:
+            return None
+        version = site_data.metadata.version if site_data.metadata is not None else 0
+        return ["site", topic, version, [list(k) for k in site_data.series.keys()]]
+
+def render_warnings(warnings):
+    return [html.P(w, style={"color": "red"}) for w in warnings]
+
+def render_site_page(topic, width=None):
+    points = plot_points(width)
+    # take a consistent snapshot, the figures are built without holding the ingest lock
+    with ingest.lock:
+        site_data = state.get(topic)
+        if site_data is None:
+            return html.P(f"No data for topic {topic}")
+        warnings = list(site_data.warnings)
+        n_warnings = site_data.n_warnings
+        checks = dict(site_data.validator.counts)
+        index = site_data.metadata
+        series = {}
+        for key in site_data.series.keys():
+            buf = site_data.series.buffers[key]
+            series[key] = select(buf, points=points) + (buf.total,)
+
+    # titles and units come from the station's compiled metadata index
+    metadata_json = json.dumps(index.as_dict() if index is not None else {}, indent=2)
+
+    graphs_ui = []
+    if series:
+        # one graph per paramId, keys are sorted by (paramId, paramIndex, kind)
+        for paramId, keys in groupby(series, key=lambda k: k[0]):
+            fig = go.Figure()
+            keys = list(keys)
+
+            for key in keys:
+                _, paramIndex, kind = key
+                times, values = reduce(*series[key][:2], points)
+                series_name = f"Value {paramIndex} ({kind})"
+                fig.add_trace(go.Scatter(
+                    x=plot_times(times),
+                    y=values,
+                    mode='lines+markers',
+                    name=series_name
+                ))
+
+            fig.update_layout(
+                title=index.title(paramId) if index is not None else f"Param ID {paramId} (Unit: )",
+                uirevision=f"{topic}/{paramId}"
+            )
+
+            graphs_ui.append(dcc.Graph(id={"type": "series-graph", "param": paramId}, figure=fig))
+            graphs_ui.append(dcc.Store(id={"type": "series-cursor", "param": paramId}, data={
+                "topic": topic,
+                "keys": [list(k) for k in keys],
+                "seqs": [series[k][2] for k in keys],
+                "points": points,
+                "range": None,
+                "extended": 0
+            }))
+    else:
+        graphs_ui.append(html.P("No observations yet."))
+
+    return dbc.Container([
+        dbc.Row([
+            dbc.Col(dbc.Button("⬅ Back", href="/", color="secondary"), width="auto")
+        ]),
+        html.H3(f"Site: {topic}"),
+        html.Div(render_warnings(warnings), id={"type": "site-warnings", "topic": topic}),
+        dcc.Store(id={"type": "warnings-count", "topic": topic}, data=n_warnings),
+        html.P("Validation: " + (", ".join(f"{check} {count}" for check, count in sorted(checks.items()))
+                                 or "no issues"), className="text-muted"),
+        html.H5("Metadata:"),
+        html.Pre(metadata_json, style={"maxHeight": "300px", "overflowY": "scroll"}),
+        html.H5("Graphs:"),
+        *graphs_ui
+    ])
+
+def map_bbox(relayout):
+    """Visible (west, south, east, north) of a map from its relayoutData, None when the whole world is visible."""
+    corners = ((relayout or {}).get("map._derived") or {}).get("coordinates")
+    if not corners:
+        return None
+    longitudes = [c[0] for c in corners]
+    latitudes = [max(-90.0, min(90.0, c[1])) for c in corners]
+    west, east = min(longitudes), max(longitudes)
+    if east - west >= 360:
+        return None
+    return [(west + 180) % 360 - 180, min(latitudes), (east + 180) % 360 - 180, max(latitudes)]
+
+def map_layers(bbox, zoom):
+    """Station locations, tracks and positions per tile of the visible area, called with the ingest lock held."""
+    spatial = getattr(ingest, "spatial", None)
+    if spatial is None:
+        return [], {}, {}
+    stations = spatial.stations(bbox)
+    if zoom >= DETAIL_ZOOM:
+        return stations, spatial.points(bbox), {}
+    return stations, {}, spatial.overview(min(int(zoom) + TILE_ZOOM_OFFSET, INDEX_ZOOM), bbox)
+
+def map_traces(stations, tracks, tiles, zoom):
+    """(latitudes, longitudes, texts) of the stations, tracks and tiles traces of the map."""
+    station_trace = ([s[2] for s in stations], [s[3] for s in stations],
+                     [s[0] if s[1] is None else f"{s[0]} observer {s[1]}" for s in stations])
+    # one trace for all tracks, separated by None
+    track_trace = ([], [], [])
+    for key in sorted(tracks):
+        times, latitudes, longitudes = tracks[key]
+        if len(times) > MAP_POINTS:
+            picked = np.unique(np.linspace(0, len(times) - 1, MAP_POINTS).astype(np.int64))
+            times, latitudes, longitudes = times[picked], latitudes[picked], longitudes[picked]
+        track_trace[0].extend(latitudes.tolist() + [None])
+        track_trace[1].extend(longitudes.tolist() + [None])
+        track_trace[2].extend([f"{key} {t}" for t in plot_times(times)] + [None])
+    tile_zoom = min(int(zoom) + TILE_ZOOM_OFFSET, INDEX_ZOOM)
+    centers = [tile_center(x, y, tile_zoom) for x, y in tiles]
+    counts = [n_points for _, n_points in tiles.values()]
+    tile_trace = ([c[0] for c in centers], [c[1] for c in centers], [f"{n} positions" for n in counts],
+                  [6 + 4 * float(np.log10(max(n, 1))) for n in counts])
+    return station_trace, track_trace, tile_trace
+
+def render_map_page():
+    with ingest.lock:
+        layers = map_layers(None, 1)
+        revision = ingest.spatial.revision if getattr(ingest, "spatial", None) is not None else 0
+    stations, tracks, tiles = map_traces(*layers, 1)
+    fig = go.Figure([
+        go.Scattermap(lat=stations[0], lon=stations[1], text=stations[2], mode="markers", name="Stations",
+                      marker={"size": 10}),
+        go.Scattermap(lat=tracks[0], lon=tracks[1], text=tracks[2], mode="lines+markers", name="Tracks",
+                      marker={"size": 4}),
+        go.Scattermap(lat=tiles[0], lon=tiles[1], text=tiles[2], mode="markers", name="Positions per tile",
+                      marker={"size": tiles[3], "opacity": 0.6}),
+    ])
+    fig.update_layout(map={"style": "open-street-map", "zoom": 1}, uirevision="map", height=700,
+                      margin={"l": 0, "r": 0, "t": 0, "b": 0})
+    return dbc.Container([
+        dbc.Row([
+            dbc.Col(dbc.Button("⬅ Back", href="/", color="secondary"), width="auto")
+        ]),
+        html.H3("Map"),
+        dcc.Graph(id={"type": "map-graph", "view": "map"}, figure=fig),
+        dcc.Store(id={"type": "map-view", "view": "map"}, data={"bbox": None, "zoom": 1, "revision": revision}),
+    ])
+
+@app.callback(
+    Output({"type": "map-graph", "view": MATCH}, "figure"),
+    Output({"type": "map-view", "view": MATCH}, "data"),
+    Input({"type": "map-graph", "view": MATCH}, "relayoutData"),
+    Input("interval", "n_intervals"),
+    State({"type": "map-view", "view": MATCH}, "data"),
+    prevent_initial_call=True
+)
+def update_map(relayout, n_intervals, view):
+    # layers of the visible area, on a pan or zoom and when the index changes
+    if dash.ctx.triggered_id != "interval":
+        if not relayout or "map.zoom" not in relayout:
+            return no_update, no_update
+        view = dict(view, bbox=map_bbox(relayout), zoom=relayout["map.zoom"])
+    started = time.perf_counter()
+    with ingest.lock:
+        revision = ingest.spatial.revision if getattr(ingest, "spatial", None) is not None else 0
+        if dash.ctx.triggered_id == "interval" and revision == view["revision"]:
+            return no_update, no_update
+        layers = map_layers(view["bbox"], view["zoom"])
+    patch = Patch()
+    for i, trace in enumerate(map_traces(*layers, view["zoom"])):
+        patch["data"][i]["lat"] = trace[0]
+        patch["data"][i]["lon"] = trace[1]
+        patch["data"][i]["text"] = trace[2]
+    patch["data"][2]["marker"]["size"] = trace[3]
+    RENDER_SECONDS.labels("map").observe(time.perf_counter() - started)
+    return patch, dict(view, revision=revision)
+
+@app.callback(
+    Output("page-content", "children"),
+    Output("page-signature", "data"),
+    Input("url", "pathname"),
+    Input("interval", "n_intervals"),
+    State("page-signature", "data"),
+    State("viewport", "data")
+)
+def update_page(pathname, n_intervals, signature, width):
+    started = time.perf_counter()
+    result = route_page(pathname, signature, width)
+    page = "site" if pathname and pathname.startswith("/site/") else "map" if pathname == "/map" else "home"
+    RENDER_SECONDS.labels(page).observe(
+        time.perf_counter() - started)
+    return result
+
+def route_page(pathname, signature, width=None):
+    # Routing
+    if pathname == "/" or pathname == "":
+        return render_home_page(), ["home"]
+    elif pathname == "/map":
+        # rendered once, the layers are updated by update_map
+        if signature == ["map"]:
+            return no_update, no_update
+        return render_map_page(), ["map"]
+    elif pathname.startswith("/site/"):
+        key = pathname.replace("/site/", "", 1)
+        new_signature = site_signature(key)
+        if new_signature is not None and new_signature == signature:
+            # same metadata and series: the graphs are kept up to date by extend_graphs
+            return no_update, no_update
+        return render_site_page(key, width), new_signature
+    else:
+        return html.P("Unknown page."), None
+
+@app.callback(
+    Output({"type": "series-graph", "param": ALL}, "extendData"),
+    Output({"type": "series-graph", "param": ALL}, "figure"),
+    Output({"type": "series-cursor", "param": ALL}, "data"),
+    Output({"type": "site-warnings", "topic": ALL}, "children"),
+    Output({"type": "warnings-count", "topic": ALL}, "data"),
+    Input("interval", "n_intervals"),
+    State({"type": "series-cursor", "param": ALL}, "data"),
+    State({"type": "warnings-count", "topic": ALL}, "data"),
+    State({"type": "warnings-count", "topic": ALL}, "id"),
+)
+def extend_graphs(n_intervals, cursors, warning_counts, warning_ids):
+    started = time.perf_counter()
+    extend_out = []
+    figure_out = []
+    cursor_out = []
+    redraws = {}  # graph index -> decimation candidates, reduced once the lock is released
+    with ingest.lock:
+        for n, cursor in enumerate(cursors):
+            site_data = state.get(cursor["topic"])
+            updates = []
+            for key, seq in zip(cursor["keys"], cursor["seqs"]):
+                buf = site_data.series.buffers.get(tuple(key)) if site_data else None
+                updates.append(buf.since(seq) if buf is not None else None)
+            capacity = site_data.series.capacity if site_data else 0
+
+            extend_out.append(no_update)
+            figure_out.append(no_update)
+            if not any(u is not None and len(u[0]) for u in updates):
+                cursor_out.append(no_update)
+                continue
+
+            time_range = cursor.get("range")
+            n_new = max(len(u[0]) for u in updates if u is not None)
+            if time_range is not None or cursor["extended"] + n_new > cursor["points"]:
+                seqs = [u[2] if u is not None else s for u, s in zip(updates, cursor["seqs"])]
+                if time_range is not None and not any(
+                        u is not None and ((u[0] >= time_range[0]) & (u[0] < time_range[1])).any() for u in updates):
+                    # nothing new in the zoomed range
+                    cursor_out.append(dict(cursor, seqs=seqs))
+                    continue
+                redraws[n] = select_traces(site_data, cursor["keys"], time_range, cursor["points"])
+                cursor_out.append(dict(cursor, seqs=[t[2] or s for t, s in zip(redraws[n], seqs)], extended=0))
+                continue
+
+            xs, ys, traces = [], [], []
+            for i, update in enumerate(updates):
+                if update is not None and len(update[0]):
+                    xs.append(plot_times(update[0]))
+                    ys.append(update[1])
+                    traces.append(i)
+            extend_out[n] = [{"x": xs, "y": ys}, traces, capacity]
+            cursor_out.append(dict(cursor, seqs=[u[2] if u is not None else s
+                                                 for u, s in zip(updates, cursor["seqs"])],
+                                   extended=cursor["extended"] + n_new))
+
+        warnings_out = []
+        count_out = []
+        for count, wid in zip(warning_counts, warning_ids):
+            site_data = state.get(wid["topic"])
+            if site_data is None or site_data.n_warnings == count:
+                warnings_out.append(no_update)
+                count_out.append(no_update)
+            else:
+                warnings_out.append(render_warnings(site_data.warnings))
+                count_out.append(site_data.n_warnings)
+
+    for n, traces in redraws.items():
+        figure_out[n] = traces_patch(traces, cursors[n]["points"])
+    RENDER_SECONDS.labels("extend").observe(time.perf_counter() - started)
+    return extend_out, figure_out, cursor_out, warnings_out, count_out
+
+@app.callback(
+    Output({"type": "series-graph", "param": MATCH}, "figure", allow_duplicate=True),
+    Output({"type": "series-cursor", "param": MATCH}, "data", allow_duplicate=True),
+    Input({"type": "series-graph", "param": MATCH}, "relayoutData"),
+    State({"type": "series-cursor", "param": MATCH}, "data"),
+    prevent_initial_call=True
+)
+def zoom_graph(relayout, cursor):
+    # the visible time range is decimated again, at a finer level of the summaries when zoomed in
+    relayout = relayout or {}
+    if relayout.get("xaxis.autorange"):
+        time_range = None
+    elif "xaxis.range[0]" in relayout and "xaxis.range[1]" in relayout:
+        time_range = [parse_plot_time(relayout["xaxis.range[0]"]), parse_plot_time(relayout["xaxis.range[1]"])]
+    elif "xaxis.range" in relayout:
+        time_range = [parse_plot_time(bound) for bound in relayout["xaxis.range"]]
+    else:
+        # resize, y axis or legend change
+        return no_update, no_update
+    started = time.perf_counter()
+    with ingest.lock:
+        traces = select_traces(state.get(cursor["topic"]), cursor["keys"], time_range, cursor["points"])
+    patch = traces_patch(traces, cursor["points"])
+    RENDER_SECONDS.labels("zoom").observe(time.perf_counter() - started)
+    return patch, dict(cursor, seqs=[t[2] or s for t, s in zip(traces, cursor["seqs"])], range=time_range,
+                       extended=0)
@@ -3,32 +3,44 @@
 #
 # Expects that stations are differentiated by topics.
 # Receives FirstMileMessage wrappers containing either metadata or data; stores the latest metadata and displays received values on the graph.
+# Messages are applied to the station state by the ingest worker (ingest.py) as they arrive, the web page only reads that state.
+# Metrics (message counts, parse time, queue wait, render time, ...) are served in the Prometheus format on
+# http://localhost:8050/metrics (see metrics.py).
+# With --shards N the ingest runs in N worker processes instead, stations being partitioned by topic (sharded_ingest.py).
+#
+# The pages are in dashboard.py, which is only imported by the dashboard command (the default). The ingest command
+# runs headless: it ingests, archives and exports without loading Dash, Plotly, Flask, pandas or pyarrow (unless
+# --export-dir needs it), which makes it start in a fraction of the time and memory; metrics are then served with
+# --metrics-port and the ingest counters printed every --report-interval seconds.
+# Data received before a station's Metadata is held until it arrives, duplicate observations are dropped and with
+# --reorder-window points are stored in time order, in bounded buffers (reorder_buffer.py).
+# With --api-port, other systems query station summaries and stored series over HTTP/JSON (query_api.py).
+# startup-benchmark.py measures the import time and memory of both and fails when the ingest command regresses.
 #
 # Run it as in the following example:
 # python3 data-receiver.py --broker s87beff9.ala.eu-central-1.emqxsl.com --port 8883 --tls --insecure --topic "firstmile/#"  --username geolux --password "XXXX"
 #
 # After starting the receiver, open the following URL in the browser: http://localhost:8050
+#
+# Headless, archiving only:
+# python3 data-receiver.py ingest --broker localhost --topic "firstmile/#" --archive-dir archive --metrics-port 9100
 
 import argparse
-import dash
-from dash import dcc, html
-import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
-import plotly.graph_objs as go
-from protospy import firstmile_pb2 as pb2
-from google.protobuf.json_format import MessageToDict
+import signal
+import ssl
+import sys
 import threading
-import queue
-import json
-import pandas as pd
+
 import paho.mqtt.client as mqtt
-import ssl
-import re
 
+from ingest import QUEUE_DEPTH, IngestWorker
+from metrics import LOG, REGISTRY, start_http_server
+from series_store import DEFAULT_CAPACITY
 
-state = {}
-message_queue = queue.Queue()
-metadata_queue = queue.Queue()
+COMMANDS = ("dashboard", "ingest")
+
+# created in main, the station state is owned by the ingest worker
+ingest = None
 
 # MQTT Callbacks
 def on_connect(client, userdata, flags, rc):
@@ -36,20 +48,10 @@ def on_connect(client, userdata, flags, rc):
     client.subscribe(userdata["topic"])
 
 def on_message(client, userdata, msg):
-    print("Received message on topic:", msg.topic)
-    topic = msg.topic
-    payload = msg.payload
-
-    message = pb2.FirstMileMessage()
-    message.ParseFromString(payload)
-
-    content_type = message.WhichOneof('content')
-    if content_type == 'metadata':
-        d = MessageToDict(message.metadata)
-        metadata_queue.put((topic, d))
-    elif content_type == 'data':
-        d = MessageToDict(message.data)
-        message_queue.put((topic, d))
+    # counted in the ingest metrics, printing every message would cost more than ingesting it
+    LOG.log("received", "Received message on topic: %s", msg.topic)
+    # parsing and state updates happen on the ingest worker thread
+    ingest.submit(msg.topic, msg.payload)
 
 
 # MQTT handler
@@ -75,211 +77,122 @@ def start_mqtt(broker, port, topic, username=None, password=None, tls=None):
     client.loop_start()
 
 
-# UI display
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
-
-app.layout = html.Div([
-    dcc.Location(id="url"),
-    html.Div(id="page-content"),
-    dcc.Interval(id="interval", interval=2*1000, n_intervals=0)
-])
-
-def render_home_page():
-    cards = []
-
-    if not state:
-        return html.P("No topics received yet.")
-
-    for topic, site_data in state.items():
-        metadata_exists = "metadata" in site_data
-        n_obs = len(site_data.get("data", []))
-        card = dbc.Card([
-            dbc.CardHeader(html.H5(topic)),
-            dbc.CardBody([
-                html.P(f"Metadata received: {'Yes' if metadata_exists else 'No'}"),
-                html.P(f"Observations received: {n_obs}"),
-                dbc.Button("View details", href=f"/site/{topic}", color="primary")
-            ])
-        ], className="mb-3")
-        cards.append(card)
-
-    return dbc.Container(cards)
-
-def render_site_page(topic):
-    if topic not in state:
-        return html.P(f"No data for topic {topic}")
-
-    site_data = state[topic]
-
-    warnings_ui = []
-    for w in site_data.get("warnings", []):
-        warnings_ui.append(html.P(w, style={"color": "red"}))
-
-    metadata_json = json.dumps(site_data.get("metadata", {}), indent=2)
-
-    graphs_ui = []
-    obs_list = site_data.get("data", [])
-    if obs_list:
-        df_all = []
-        for obs in obs_list:
-            param_id = obs.get("parameterDefinitionId")
-            time_str = obs.get("time", None)
-
-            for i, val in enumerate(obs.get("values", [])):
-                for k, v in val.items():
-                    df_all.append({
-                        "paramId": param_id,
-                        "paramIndex": i,
-                        "kind": k,
-                        "timestamp": time_str,
-                        "value": v
-                    })
-
-        if df_all:
-            df = pd.DataFrame(df_all)
-
-            # Group by paramId → one graph per paramId
-            for paramId, param_group in df.groupby("paramId"):
-                fig = go.Figure()
-
-                for (paramIndex, kind), series_group in param_group.groupby(["paramIndex", "kind"]):
-                    series_name = f"Value {paramIndex} ({kind})"
-                    fig.add_trace(go.Scatter(
-                        x=series_group["timestamp"],
-                        y=series_group["value"],
-                        mode='lines+markers',
-                        name=series_name
-                    ))
-
-                # Lookup metadata for graph title and unit
-                param_name = f"Param ID {paramId}"
-                unit = ""
-
-                meta = site_data.get("metadata")
-                if meta:
-                    param_defs = meta.get("parameterDefinitions", [])
-                    for pdef in param_defs:
-                        if str(pdef["id"]) == str(paramId):
-                            if pdef.get("parameters"):
-                                names = []
-                                units = set()
-                                for param in pdef["parameters"]:
-                                    names.append(param.get("longName", ""))
-                                    unit_val = param.get("unit", "")
-                                    if unit_val:
-                                        units.add(unit_val)
-                                param_name = ", ".join([n for n in names if n])
-                                unit = ", ".join(units)
-                            break
-
-                fig.update_layout(
-                    title=f"{param_name} (Unit: {unit})"
-                )
-
-                graphs_ui.append(dcc.Graph(figure=fig))
-        else:
-            graphs_ui.append(html.P("No data to plot yet."))
-    else:
-        graphs_ui.append(html.P("No observations yet."))
-
-    return dbc.Container([
-        dbc.Row([
-            dbc.Col(dbc.Button("⬅ Back", href="/", color="secondary"), width="auto")
-        ]),
-        html.H3(f"Site: {topic}"),
-        *warnings_ui,
-        html.H5("Metadata:"),
-        html.Pre(metadata_json, style={"maxHeight": "300px", "overflowY": "scroll"}),
-        html.H5("Graphs:"),
-        *graphs_ui
-    ])
-
-@app.callback(
-    Output("page-content", "children"),
-    Input("url", "pathname"),
-    Input("interval", "n_intervals")
-)
-def update_page(pathname, n_intervals):
-    # Process queued MQTT metadata messages
-    while not metadata_queue.empty():
-        topic, msg = metadata_queue.get()
-
-        # use regex to extract vendor and nodeid from the topic in format firstmile/{version}/{vendor}/{nodeid}
-        match = re.match(r"firstmile/([^/]+)/([^/]+)/([^/]+)", topic)
-        if match:
-            version = match.group(1)
-            vendor = match.group(2)
-            nodeid = match.group(3)
-            key = f"{vendor}/{nodeid}"
-
-            if key not in state:
-                state[key] = {
-                    "last_messages": [],
-                    "data": [],
-                    "warnings": []
-                }
-
-            state[key]["metadata"] = msg
-            state[key]["last_messages"].append(msg)
-            state[key]["last_messages"] = state[key]["last_messages"][-20:]
-
-    # Process queued MQTT data messages
-    while not message_queue.empty():
-        topic, msg = message_queue.get()
-
-        # use regex to extract vendor and nodeid from the topic in format firstmile/{version}/{vendor}/{nodeid}
-        match = re.match(r"firstmile/([^/]+)/([^/]+)/([^/]+)", topic)
-        if match:
-            version = match.group(1)
-            vendor = match.group(2)
-            nodeid = match.group(3)
-            key = f"{vendor}/{nodeid}"
-
-            if key not in state:
-                state[key] = {
-                    "last_messages": [],
-                    "data": [],
-                    "warnings": []
-                }
-
-            if "metadata" not in state[key]:
-                warning = f"⚠️ WARNING: Data for topic {topic} arrived with no metadata and no cached metadata."
-                print(warning)
-                state[key]["warnings"].append(warning)
-
-            state[key]["last_messages"].append(msg)
-            state[key]["last_messages"] = state[key]["last_messages"][-20:]
-
-            state[key]["data"].extend(msg.get("observations", []))
-            # Limit stored data to avoid memory growth
-            MAX_OBS = 500
-            if len(state[key]["data"]) > MAX_OBS:
-                state[key]["data"] = state[key]["data"][-MAX_OBS:]
-
-    # Routing
-    if pathname == "/" or pathname == "":
-        return render_home_page()
-    elif pathname.startswith("/site/"):
-        key = pathname.replace("/site/", "", 1)
-        return render_site_page(key)
-    else:
-        return html.P("Unknown page.")
+def create_ingest(args):
+    """IngestWorker or ShardedIngest for the command line options; imports only the modules the options need."""
+    archive_options = {"segment_bytes": args.archive_segment_mb * 1024 * 1024,
+                       "fsync_interval": args.archive_fsync_interval}
+    buffer_options = {"window": args.reorder_window, "dedup_horizon": args.dedup_horizon,
+                      "max_bytes": args.buffer_mb * 1024 * 1024,
+                      "max_station_bytes": args.buffer_station_mb * 1024 * 1024}
+    if args.shards:
+        from sharded_ingest import ShardedIngest
+
+        # every shard archives to and restores from its own subdirectory of --archive-dir;
+        # headless, the parent needs the workers' counters but no copy of their series
+        return ShardedIngest(args.shards, max_queue=args.ingest_queue, put_timeout=args.ingest_timeout,
+                             capacity=args.max_obs, decoder=args.decoder, zstd_dicts=args.zstd_dict,
+                             archive_dir=args.archive_dir, archive_options=archive_options, restore=args.restore,
+                             export_dir=args.export_dir, export_options={"file_interval": args.export_interval},
+                             strict_order=args.strict_order, buffer_options=buffer_options,
+                             mirror=args.command == "dashboard")
+
+    from compression import Decompressor, load_dictionary
+
+    worker = IngestWorker(max_queue=args.ingest_queue, put_timeout=args.ingest_timeout, capacity=args.max_obs,
+                          decoder=args.decoder, strict_order=args.strict_order, buffer_options=buffer_options,
+                          decompressor=Decompressor([load_dictionary(path) for path in args.zstd_dict]))
+    if args.archive_dir:
+        from archive import ArchiveReader, ArchiveWriter
+
+        if args.restore:
+            restored = worker.restore(ArchiveReader(args.archive_dir))
+            print(f"Restored {restored} archived messages from {args.archive_dir}")
+        worker.archive = ArchiveWriter(args.archive_dir, **archive_options)
+    if args.export_dir:
+        from parquet_export import ParquetExporter
+
+        worker.exporter = ParquetExporter(args.export_dir, file_interval=args.export_interval)
+    return worker
+
+
+def run_headless(report_interval):
+    # supervisors stop a service with SIGTERM, handled like Ctrl-C
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    last = 0
+    try:
+        while not stopping.wait(report_interval):
+            stats = ingest.stats
+            print(f"Ingest: {stats.processed - last} processed in the last {report_interval:.0f} s, "
+                  f"{stats.processed} total, {stats.dropped} dropped, {stats.parse_errors} parse errors, "
+                  f"{stats.quarantined} quarantined, {stats.duplicates} duplicate and {stats.late} late observations, "
+                  f"queue depth {ingest.queue_depth()}, {len(ingest.stations)} stations", flush=True)
+            last = stats.processed
+    except KeyboardInterrupt:
+        pass
+    # processes what is queued and closes the archive and the Parquet files
+    ingest.stop()
+    if isinstance(ingest, IngestWorker):
+        ingest.join()
+    print(f"Stopped after {ingest.stats.processed} messages")
+
+
+def parse_args(argv):
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--broker", required=True, help="MQTT broker address")
+    options.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    options.add_argument("--topic", required=True, help="MQTT topic")
+    options.add_argument("--username", help="MQTT username (optional)")
+    options.add_argument("--password", help="MQTT password (optional)")
+    options.add_argument("--tls", action="store_true", help="Enable TLS (MQTTS)")
+    options.add_argument("--ca-cert", help="CA certificate file for TLS connection")
+    options.add_argument("--client-cert", help="Client certificate file for mutual TLS (optional)")
+    options.add_argument("--client-key", help="Client private key file for mutual TLS (optional)")
+    options.add_argument("--insecure", action="store_true", help="Skip server certificate verification")
+    options.add_argument("--ingest-queue", type=int, default=10000, help="Maximum number of messages waiting for the ingest worker")
+    options.add_argument("--max-obs", type=int, default=DEFAULT_CAPACITY, help="Number of points kept per series (parameter value) and station")
+    options.add_argument("--decoder", choices=["fast", "dict"], default="fast", help="Data decoding path, 'dict' uses MessageToDict (slower, for debugging)")
+    options.add_argument("--ingest-timeout", type=float, default=1.0, help="Seconds the MQTT thread waits on a full ingest queue before dropping a message")
+
+    options.add_argument("--archive-dir", help="Archive every received payload to this directory (see archive.py)")
+    options.add_argument("--archive-segment-mb", type=int, default=64, help="Size at which archive segments are rotated")
+    options.add_argument("--archive-fsync-interval", type=float, default=1.0, help="Maximum seconds between archive fsyncs")
+    options.add_argument("--restore", action="store_true", help="Rebuild the station state from --archive-dir on startup")
+    options.add_argument("--zstd-dict", action="append", default=[], help="zstd dictionary of compressed payloads (see compression.py), may be repeated")
+    options.add_argument("--export-dir", help="Export received observations as partitioned Parquet to this directory (see parquet_export.py)")
+    options.add_argument("--export-interval", type=float, default=3600.0, help="Seconds after which Parquet files are closed and readable")
+    options.add_argument("--strict-order", action="store_true", help="Quarantine Data older than the data already received (see validation.py)")
+    options.add_argument("--reorder-window", type=float, default=0.0, help="Seconds of observation time points are held to be stored in time order, 0 stores them as received (see reorder_buffer.py)")
+    options.add_argument("--dedup-horizon", type=float, default=3600.0, help="Seconds of observation time accepted observations are remembered to drop duplicates")
+    options.add_argument("--buffer-mb", type=int, default=256, help="Memory of the pending-metadata, reorder and dedup buffers of all stations")
+    options.add_argument("--buffer-station-mb", type=int, default=16, help="Memory of the pending-metadata, reorder and dedup buffers of one station")
+    options.add_argument("--shards", type=int, default=0, help="Ingest in this many worker processes, 0 ingests in a thread of this process")
+    options.add_argument("--api-port", type=int, help="Serve the HTTP/JSON query API on this port (see query_api.py)")
 
-if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="AWS MQTT Host PoC")
-    parser.add_argument("--broker", required=True, help="MQTT broker address")
-    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
-    parser.add_argument("--topic", required=True, help="MQTT topic")
-    parser.add_argument("--username", help="MQTT username (optional)")
-    parser.add_argument("--password", help="MQTT password (optional)")
-    parser.add_argument("--tls", action="store_true", help="Enable TLS (MQTTS)")
-    parser.add_argument("--ca-cert", help="CA certificate file for TLS connection")
-    parser.add_argument("--client-cert", help="Client certificate file for mutual TLS (optional)")
-    parser.add_argument("--client-key", help="Client private key file for mutual TLS (optional)")
-    parser.add_argument("--insecure", action="store_true", help="Skip server certificate verification")
-
-    args = parser.parse_args()
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("dashboard", parents=[options], help="Ingest and serve the web pages on port 8050 (default)")
+    headless = subparsers.add_parser("ingest", parents=[options], help="Ingest, archive and export without the web pages")
+    headless.add_argument("--metrics-port", type=int, help="Serve metrics on this port")
+    headless.add_argument("--report-interval", type=float, default=60.0, help="Seconds between two printed ingest summaries")
+
+    # without a command, the options are those of the dashboard
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        argv = ["dashboard"] + argv
+    return parser.parse_args(argv)
 
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+
+    ingest = create_ingest(args)
+    REGISTRY.add_callback(lambda: QUEUE_DEPTH.set(ingest.queue_depth()))
+    # the sharded workers are forked here, before the dashboard is imported
+    ingest.start()
+    if args.api_port:
+        from query_api import start_api_server
+
+        start_api_server(ingest, args.api_port)
     start_mqtt(
         broker=args.broker,
         port=args.port,
@@ -294,4 +207,12 @@ if __name__ == '__main__':
         } if args.tls else None
     )
 
-    app.run(host="0.0.0.0", port=8050, debug=True)
+    if args.command == "ingest":
+        if args.metrics_port:
+            start_http_server(args.metrics_port)
+        run_headless(args.report_interval)
+    else:
+        import dashboard
+
+        dashboard.attach(ingest)
+        dashboard.app.run(host="0.0.0.0", port=8050, debug=True)
@@ -2,6 +2,15 @@
 # Emulates an AWS then sends periodic temperature measurements using 1M-TT protocol.
 # The script will first send a single Metadata message with site configuration info, it will be sent as MQTT retained message.
 # Then it will periodically publish Data messages with temperature and voltage readings.
+# A single MQTT session is kept open for the whole run (see mqtt_publisher.py); the Metadata is re-published
+# on every reconnection and Data messages are pipelined over the open connection.
+# Readings are not published directly but go through a store-and-forward queue (see outbox.py): with --outbox
+# they are kept on disk until acknowledged by the broker, so nothing is lost while the link is down or across
+# restarts, and pending readings are sent as batched Data messages (--batch-size, --batch-age, --max-payload-bytes).
+# With --compress, payloads are zstd compressed, optionally with a trained dictionary (see compression.py);
+# the receiver recognizes compressed payloads by themselves.
+# With --metrics-port, publish counts, acknowledgement latency and the outbox size are served in the Prometheus
+# format at /metrics (see metrics.py).
 # Both message types are wrapped in a FirstMileMessage and published to the same unified topic. 
 #
 # Before running this script, ensure that proto schema is compiled and the protobuf classes are generated. This can be achieved by running the script:
@@ -11,12 +20,15 @@
 # python3 data-sender.py --period 10 --vendor geolux --nodeid "AWS123" --broker s87beff9.ala.eu-central-1.emqxsl.com --username geolux --password "XXXX" --port 8883 --tls --insecure
 
 import argparse
+import functools
 import random
 import time
-import ssl
 from datetime import datetime, timezone
 
-import paho.mqtt.client as mqtt
+from compression import Compressor, load_dictionary
+from metrics import REGISTRY, start_http_server
+from outbox import Outbox
+from mqtt_publisher import IN_FLIGHT, MqttPublisher, add_publisher_arguments, format_stats
 from protospy import firstmile_pb2 as pb2
 from google.protobuf import timestamp_pb2 as Timestamp
 from google.protobuf import empty_pb2 as Empty
@@ -82,15 +94,22 @@ def define_parameters():
 
     return [pd1, pd2]
 
+# The parameter definitions never change while the node runs, build them once
+@functools.lru_cache(maxsize=None)
+def parameter_definitions():
+    return tuple(define_parameters())
+
 # This function creates a measurement Observation message with simulated values
 def generate_observations(parameter_defs):
     observations = []
+    # all readings of one cycle share the same timestamp
+    now = current_timestamp()
 
     # Loop over parameter definitions
     for pd in parameter_defs:
         obs = pb2.Observation()
         obs.parameterDefinitionId = pd.id
-        obs.time.CopyFrom(current_timestamp())
+        obs.time.CopyFrom(now)
 
         # For each Parameter in this ParameterDefinition
         for param in pd.parameters:
@@ -142,7 +161,7 @@ def create_metadata():
 
 # This is the main function to construct Data message
 def build_data_transmission(nodeid):
-    observations = generate_observations(define_parameters())
+    observations = generate_observations(parameter_definitions())
 
     transmission = pb2.Data(
         observations = observations
@@ -167,73 +186,83 @@ def build_metadata_transmission():
 
     return metadata
 
-# MQTT(s) data exchange
-def send_mqtt_payload(args, topic, payload_bytes, retain=False):
-    client = mqtt.Client()
-
-    if args.username and args.password:
-        client.username_pw_set(args.username, args.password)
-
-    if args.tls:
-        client.tls_set(
-            ca_certs=args.ca_cert,
-            certfile=args.client_cert,
-            keyfile=args.client_key,
-            tls_version=ssl.PROTOCOL_TLSv1_2
-        )
-        client.tls_insecure_set(args.insecure)
-
-    print(f"Connecting to MQTT broker {args.broker}:{args.port}...")
-    client.connect(args.broker, args.port, 60)
-    client.loop_start()
-
-    msg_info = client.publish(topic, payload_bytes, qos = 1, retain = retain)
-    msg_info.wait_for_publish(timeout=10)
-    if msg_info.is_published():
-        print(f"Published payload ({len(payload_bytes)} bytes) to topic '{topic}'")
-    else:
-        print("Publication failed")
-
-    client.loop_stop()
-    client.disconnect()
-
 # Main
 def main():
     parser = argparse.ArgumentParser(description="AWS MQTT Node PoC")
-    parser.add_argument("--broker", required=True, help="MQTT broker address")
-    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    add_publisher_arguments(parser)
     parser.add_argument("--vendor", required=True, help="Vendor name")
     parser.add_argument("--nodeid", required=True, help="Node ID")
     parser.add_argument("--period", type=int, default=10, help="Period in seconds between measurements")
-    parser.add_argument("--username", help="MQTT username (optional)")
-    parser.add_argument("--password", help="MQTT password (optional)")
-    parser.add_argument("--tls", action="store_true", help="Enable TLS (MQTTS)")
-    parser.add_argument("--ca-cert", help="CA certificate file for TLS connection")
-    parser.add_argument("--client-cert", help="Client certificate file for mutual TLS (optional)")
-    parser.add_argument("--client-key", help="Client private key file for mutual TLS (optional)")
-    parser.add_argument("--insecure", action="store_true", help="Skip server certificate verification")
-
+    parser.add_argument("--report-interval", type=int, default=60, help="Seconds between publish statistics reports (0 disables)")
+    parser.add_argument("--outbox", help="SQLite file of the store-and-forward queue (kept in memory if not given)")
+    parser.add_argument("--batch-size", type=int, default=100, help="Maximum number of observations per Data message")
+    parser.add_argument("--batch-age", type=float, default=0.0, help="Send pending observations once the oldest is this many seconds old")
+    parser.add_argument("--max-payload-bytes", type=int, default=256 * 1024, help="Maximum size of a Data message")
+    parser.add_argument("--compress", action="store_true", help="zstd compress the payloads")
+    parser.add_argument("--zstd-dict", help="zstd dictionary used with --compress (see compression.py)")
+    parser.add_argument("--outbox-max", type=int, default=1000000, help="Maximum number of queued observations, the oldest are dropped beyond")
 
     args = parser.parse_args()
 
     # unified topic for both metadata and data
     topic = f"firstmile/{proto_version}/{args.vendor}/{args.nodeid}"
 
-    # build and send metadata transmission (retained)
+    outbox = Outbox(args.outbox or ":memory:", batch_size=args.batch_size, batch_age=args.batch_age,
+                    max_payload_bytes=args.max_payload_bytes, max_observations=args.outbox_max)
+    if outbox.pending():
+        print(f"{outbox.pending()} observations pending from a previous run")
+
+    # one long-lived session for the whole run, the broker connection is re-established automatically
+    publisher = MqttPublisher.from_args(args, client_id=f"{args.vendor}-{args.nodeid}")
+
+    compress = None
+    if args.compress:
+        compress = Compressor(load_dictionary(args.zstd_dict) if args.zstd_dict else None).compress
+
+    # build metadata transmission, it is published retained once per connection
     metadata = build_metadata_transmission()
     msg = pb2.FirstMileMessage(metadata=metadata)
     payload_bytes = msg.SerializeToString()
-    send_mqtt_payload(args, topic, payload_bytes, retain=True)
-
-    while True:
-        # build and send data transmission (not retained)
-        data_transmission = build_data_transmission(args.nodeid)
-        msg = pb2.FirstMileMessage(data=data_transmission)
-        payload_bytes = msg.SerializeToString()
-        send_mqtt_payload(args, topic, payload_bytes)
-
-        # wait for the specified period before sending the next measurement
-        time.sleep(args.period)
+    publisher.set_retained(topic, compress(payload_bytes) if compress else payload_bytes)
+
+    pending = REGISTRY.gauge("firstmile_outbox_pending_observations", "Observations waiting in the outbox")
+    dropped = REGISTRY.counter("firstmile_outbox_dropped_observations_total", "Observations dropped from a full outbox")
+    if args.metrics_port:
+        REGISTRY.add_callback(lambda: IN_FLIGHT.set(publisher.in_flight()))
+        start_http_server(args.metrics_port)
+    publisher.start()
+
+    last_report = time.monotonic()
+    next_reading = time.monotonic()
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= next_reading:
+                # take the readings and queue them, they are published when a batch is due and the link is up
+                outbox.put(build_data_transmission(args.nodeid).observations)
+                next_reading += args.period
+                if next_reading < now:
+                    next_reading = now + args.period
+
+            # a backlog goes out as back-to-back batches while the connection is up
+            outbox.send(publisher, topic, max_in_flight=args.max_inflight, compress=compress)
+            if args.metrics_port:
+                # the outbox is read here, its SQLite connection belongs to this thread
+                pending.set(outbox.pending())
+                dropped.set(outbox.dropped)
+
+            if args.report_interval and now - last_report >= args.report_interval:
+                print(f"{format_stats(publisher.stats.summary())} pending={outbox.pending()} dropped={outbox.dropped}")
+                last_report = now
+
+            time.sleep(max(0.0, min(0.2, next_reading - time.monotonic())))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        outbox.send(publisher, topic, max_in_flight=args.max_inflight, compress=compress)
+        publisher.stop()
+        outbox.close()
+        print(format_stats(publisher.stats.summary()))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+# Decimation of stored series for plotting
+#
+# A plot needs no more points than its width in pixels, whatever the length of the series. select() gathers the
+# candidate points of a RingBuffer in a time range from its min/max pyramid (series_store.Summaries): the coarsest
+# level with at least one bucket per requested point gives the minimum and maximum of every bucket inside the range,
+# the buckets it has not summarised yet come from the finer levels, and buckets that straddle an end of the range
+# or whose points were partly overwritten give their raw points. Zooming in on a short range thus ends on the raw
+# points, and a request costs O(points) whatever the number of points stored.
+# reduce() brings the candidates down to the requested number, with Largest-Triangle-Three-Buckets (lttb, the
+# default, keeps the shape of the curve) or the minimum and maximum per time bin (minmax, keeps every peak);
+# string series, which have no summaries, are sampled evenly.
+# select() only copies and is called with the ingest lock held, reduce() works on the copies without it.
+
+import numpy as np
+
+DEFAULT_POINTS = 1000
+METHODS = ("lttb", "minmax")
+
+EARLIEST = np.iinfo(np.int64).min
+LATEST = np.iinfo(np.int64).max
+
+
+def _bucket_points(buf, level, span, first, start, end):
+    """Candidate (times, values) of the buckets of a level from bucket index `first` on."""
+    tmin, buckets = level.between(first, level.total)
+    first = max(first, level.total - len(level))
+    seqs = np.arange(first, first + len(tmin)) * span
+    overlaps = (tmin < end) & (buckets["tmax"] >= start)
+    inside = overlaps & (tmin >= start) & (buckets["tmax"] < end) & (seqs >= buf.total - len(buf))
+    times = [buckets["t_low"][inside], buckets["t_high"][inside]]
+    values = [buckets["low"][inside], buckets["high"][inside]]
+    for seq in seqs[overlaps & ~inside]:
+        raw_times, raw_values = buf.between(seq, seq + span)
+        selected = (raw_times >= start) & (raw_times < end)
+        times.append(raw_times[selected])
+        values.append(raw_values[selected].astype(np.float64))
+    return times, values
+
+
+def select(buf, start=None, end=None, points=DEFAULT_POINTS):
+    """Candidate (times, values) of a RingBuffer in [start, end), in time order: its raw points when they are
+    few, otherwise a few per requested point from its summaries. NaN values are left out."""
+    start = EARLIEST if start is None else start
+    end = LATEST if end is None else end
+    summaries = buf.summaries
+    chosen = None
+    if summaries is not None:
+        for k in reversed(range(len(summaries.levels))):
+            tmin, buckets = summaries.levels[k].arrays()
+            if np.count_nonzero((tmin < end) & (buckets["tmax"] >= start)) >= points:
+                chosen = k
+                break
+
+    if chosen is None:
+        times, values = buf.arrays()
+        selected = (times >= start) & (times < end)
+        if values.dtype.kind == "f":
+            selected &= ~np.isnan(values)
+        times, values = times[selected], values[selected]
+    else:
+        times, values = [], []
+        # the chosen level, then the finer levels for the points it has not summarised yet, then the raw points
+        first = 0
+        for k in range(chosen, -1, -1):
+            level, span = summaries.levels[k], summaries.spans[k]
+            level_times, level_values = _bucket_points(buf, level, span, first // span, start, end)
+            times += level_times
+            values += level_values
+            first = level.total * span
+        raw_times, raw_values = buf.between(first, buf.total)
+        selected = (raw_times >= start) & (raw_times < end)
+        times = np.concatenate(times + [raw_times[selected]])
+        values = np.concatenate(values + [raw_values[selected].astype(np.float64)])
+        selected = ~np.isnan(values)
+        times, values = times[selected], values[selected].astype(buf.values.dtype)
+
+    order = np.argsort(times, kind="stable")
+    return times[order], values[order]
+
+
+def lttb(times, values, points):
+    """Indices of the `points` points picked by Largest-Triangle-Three-Buckets, times being sorted."""
+    n = len(times)
+    x = (times - times[0]).astype(np.float64)
+    y = values.astype(np.float64)
+    # bucket b holds [edges[b], edges[b + 1]), the first and last points are buckets of their own
+    edges = np.empty(points, dtype=np.int64)
+    edges[:-1] = (np.arange(points - 1) * ((n - 2) / (points - 2))).astype(np.int64) + 1
+    edges[-1] = n
+    sum_x = np.concatenate(([0.0], np.cumsum(x)))
+    sum_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = edges[2:] - edges[1:-1]
+    next_x = (sum_x[edges[2:]] - sum_x[edges[1:-1]]) / counts
+    next_y = (sum_y[edges[2:]] - sum_y[edges[1:-1]]) / counts
+
+    picked = np.empty(points, dtype=np.int64)
+    picked[0], picked[-1] = 0, n - 1
+    a = 0
+    for b in range(points - 2):
+        lo, hi = edges[b], edges[b + 1]
+        # twice the area of the triangle between the last pick, a point of the bucket and the next bucket's mean
+        area = np.abs((x[a] - next_x[b]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[b] - y[a]))
+        a = lo + int(area.argmax())
+        picked[b + 1] = a
+    return picked
+
+
+def minmax(times, values, points):
+    """Indices of the minimum and maximum of `points` // 2 equal time bins, times being sorted."""
+    n_bins = max(points // 2, 1)
+    duration = float(times[-1] - times[0]) + 1.0
+    bins = ((times - times[0]) / duration * n_bins).astype(np.int64)
+    # the bins are contiguous runs of the sorted times
+    changes = np.r_[True, bins[1:] != bins[:-1]]
+    starts = np.flatnonzero(changes)
+    run = np.cumsum(changes) - 1
+    picked = []
+    for extreme in (np.minimum, np.maximum):
+        hits = np.flatnonzero(values == extreme.reduceat(values, starts)[run])
+        picked.append(hits[np.r_[True, run[hits[1:]] != run[hits[:-1]]]])  # the first one of ties
+    return np.union1d(*picked)
+
+
+def reduce(times, values, points=DEFAULT_POINTS, method="lttb"):
+    """At most `points` of the (times, values) returned by select(); fewer than 3 are the first and last."""
+    if len(times) <= points:
+        return times, values
+    if points < 3:
+        picked = [0, len(times) - 1][-points:] if points > 0 else []
+    elif values.dtype == object:
+        # strings have no min or max, they are sampled evenly
+        picked = np.unique(np.linspace(0, len(times) - 1, points).astype(np.int64))
+    elif method == "lttb":
+        picked = lttb(times, values, points)
+    else:
+        picked = minmax(times, values, points)
+    return times[picked], values[picked]
+
+
+def decimate(buf, start=None, end=None, points=DEFAULT_POINTS, method="lttb"):
+    """At most `points` points of a RingBuffer in [start, end), in time order."""
+    return reduce(*select(buf, start, end, points), points, method)
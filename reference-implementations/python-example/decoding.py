@@ -0,0 +1,71 @@
+# Decoding of Data messages into per-series columns
+#
+# The fast path walks the pb2.Data message directly: the Value kind comes from WhichOneof('kind') and the
+# observation time from Timestamp seconds/nanos, so no JSON-style dict or ISO time string is ever built.
+# Points are grouped per series key (parameterDefinitionId, value index, Value kind) so that they can be
+# appended to the ring buffers in one vectorised step per series, which matters for large batched messages
+# such as AMDAR trajectories.
+# The dict path (MessageToDict) is kept as a fallback for debugging and gives the same result.
+
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.timestamp_pb2 import Timestamp
+
+NAN = float("nan")
+
+
+def timestamp_ns(ts):
+    return ts.seconds * 1_000_000_000 + ts.nanos
+
+
+def decode_data(data):
+    """Return {(parameterDefinitionId, value index, kind): (times_ns, values)} for a pb2.Data message."""
+    columns = {}
+    for obs in data.observations:
+        param_id = obs.parameterDefinitionId
+        t = obs.time.seconds * 1_000_000_000 + obs.time.nanos
+        for i, val in enumerate(obs.values):
+            kind = val.WhichOneof("kind")
+            if kind is None:
+                continue
+            value = NAN if kind == "emptyValue" else getattr(val, kind)
+            column = columns.get((param_id, i, kind))
+            if column is None:
+                column = columns[(param_id, i, kind)] = ([], [])
+            column[0].append(t)
+            column[1].append(value)
+    return columns
+
+
+def json_timestamp_ns(json_time):
+    ts = Timestamp()
+    ts.FromJsonString(json_time)
+    return timestamp_ns(ts)
+
+
+def dict_value(kind, value):
+    # MessageToDict renders 64-bit integers as strings and Empty as {}
+    if kind in ("int64Value", "unsignedInt64Value"):
+        return int(value)
+    if kind == "emptyValue":
+        return NAN
+    return value
+
+
+def decode_data_dict(data):
+    """Same result as decode_data(), going through MessageToDict (slow, for debugging)."""
+    columns = {}
+    for obs in MessageToDict(data).get("observations", []):
+        param_id = obs.get("parameterDefinitionId", 0)
+        t = json_timestamp_ns(obs["time"]) if "time" in obs else 0
+        for i, val in enumerate(obs.get("values", [])):
+            for kind, v in val.items():
+                column = columns.setdefault((param_id, i, kind), ([], []))
+                column[0].append(t)
+                column[1].append(dict_value(kind, v))
+    return columns
+
+
+DECODERS = {
+    "fast": decode_data,
+    "dict": decode_data_dict,
+}
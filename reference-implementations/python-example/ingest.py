@@ -0,0 +1,402 @@
+# Ingest stage of the receiver
+#
+# MQTT messages are handed over by the paho network thread to a bounded queue and applied to the per-station
+# state by a dedicated worker thread as soon as they arrive, independently of the Dash page refresh.
+# When the queue is full the network thread blocks for a short while (backpressure towards the broker via TCP
+# flow control), after that the message is dropped and counted.
+# Data messages are validated against the station's Metadata first (validation.py); messages that fail are
+# quarantined per station instead of being stored, and retried when new Metadata arrives.
+# Data received before a station's first Metadata is held until it arrives, duplicate observations are dropped and,
+# with a reorder window, points are stored in time order (reorder_buffer.py).
+# Station locations and the positions of moving stations are indexed by tile as they are stored (spatial_index.py).
+# Message and byte counts per station, errors, parse/process time and queue wait are exported as metrics (metrics.py).
+
+import functools
+import queue
+import re
+import threading
+import time
+from collections import deque
+
+from protospy import firstmile_pb2 as pb2
+
+from compression import Decompressor
+from decoding import DECODERS
+from metadata_index import MetadataIndex
+from metrics import LOG, REGISTRY
+from reorder_buffer import ReorderBuffers
+from series_store import DEFAULT_CAPACITY, StationSeries
+from spatial_index import SpatialIndex
+from validation import StationValidator, describe
+
+# topic format: firstmile/{version}/{vendor}/{nodeid}
+TOPIC_PATTERN = re.compile(r"firstmile/([^/]+)/([^/]+)/([^/]+)")
+
+MAX_LAST_MESSAGES = 20
+MAX_WARNINGS = 100
+
+RECEIVED = REGISTRY.counter("firstmile_received_messages_total", "Messages handed to the ingest stage", ["station"])
+RECEIVED_BYTES = REGISTRY.counter("firstmile_received_bytes_total", "Payload bytes handed to the ingest stage", ["station"])
+PROCESSED = REGISTRY.counter("firstmile_processed_messages_total", "Messages applied to the station state", ["content"])
+ERRORS = REGISTRY.counter("firstmile_ingest_errors_total", "Messages dropped or not applied", ["reason"])
+WARNINGS = REGISTRY.counter("firstmile_warnings_total", "Warnings raised while applying messages", ["kind"])
+PARSE_SECONDS = REGISTRY.histogram("firstmile_parse_seconds", "Decompression and protobuf parsing time per message")
+PROCESS_SECONDS = REGISTRY.histogram("firstmile_process_seconds", "Ingest time per message, parsing to archiving",
+                                     ["content"])
+QUEUE_WAIT = REGISTRY.histogram("firstmile_queue_wait_seconds", "Time between receipt and start of ingest per message")
+VALIDATION_ISSUES = REGISTRY.counter("firstmile_validation_issues_total", "Data messages failing a validation check",
+                                     ["check"])
+QUARANTINED = REGISTRY.counter("firstmile_quarantined_messages_total", "Data messages quarantined by validation")
+QUEUE_DEPTH = REGISTRY.gauge("firstmile_ingest_queue_depth", "Messages waiting for the ingest worker")
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_topic(topic):
+    """Return (version, vendor, nodeid, station key) for a first mile topic, or None."""
+    match = TOPIC_PATTERN.match(topic)
+    if not match:
+        return None
+    version, vendor, nodeid = match.groups()
+    return version, vendor, nodeid, f"{vendor}/{nodeid}"
+
+
+def count_received(topic, payload):
+    parsed = parse_topic(topic)
+    station = parsed[3] if parsed is not None else "unknown"
+    RECEIVED.labels(station).inc()
+    RECEIVED_BYTES.labels(station).inc(len(payload))
+
+
+class Station:
+    """State kept for one vendor/nodeid."""
+
+    def __init__(self, key, capacity=DEFAULT_CAPACITY, strict_order=False):
+        self.key = key
+        self.metadata = None  # MetadataIndex of the metadata in force
+        self.validator = StationValidator(strict_order)
+        self.last_messages = deque(maxlen=MAX_LAST_MESSAGES)
+        self.series = StationSeries(capacity)
+        self.warnings = deque(maxlen=MAX_WARNINGS)
+        self.n_warnings = 0
+        self.n_messages = 0
+        self.n_observations = 0
+        self.last_seen_ns = None  # receive time of the last message
+        # incremented on every change, readers (query_api.py) cache what they derive from the station per revision
+        self.revision = 0
+
+    def touch(self, received_ns):
+        """Called with the ingest lock held after every change."""
+        if received_ns is not None and (self.last_seen_ns is None or received_ns > self.last_seen_ns):
+            self.last_seen_ns = received_ns
+        self.revision += 1
+
+
+class IngestStats:
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.parse_errors = 0
+        self.unknown_topics = 0
+        self.quarantined = 0
+        self.duplicates = 0  # observations
+        self.late = 0  # observations
+        self.evicted = 0  # pending messages
+        self.max_depth = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class StageTimings:
+    """Accumulated wall time per ingest stage, enabled for benchmarks (payload-replay.py)."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+
+    def add(self, stage, started, ended=None):
+        if ended is None:
+            ended = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + ended - started
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def as_dict(self):
+        return {stage: {"count": self.counts[stage], "seconds": seconds,
+                        "us_per_call": seconds / self.counts[stage] * 1e6}
+                for stage, seconds in self.seconds.items()}
+
+
+class IngestWorker(threading.Thread):
+    """Parses queued payloads and applies them to the station state."""
+
+    def __init__(self, max_queue=10000, put_timeout=1.0, capacity=DEFAULT_CAPACITY, decoder="fast", archive=None,
+                 decompressor=None, exporter=None, strict_order=False, buffer_options=None, spatial=True):
+        super().__init__(name="ingest", daemon=True)
+        self.stations = {}
+        self.strict_order = strict_order
+        self.capacity = capacity
+        self.decode = DECODERS[decoder]
+        self.archive = archive  # optional archive.ArchiveWriter receiving every parsed payload
+        self.exporter = exporter  # optional parquet_export.ParquetExporter receiving the decoded Data
+        self.timings = None  # optional StageTimings
+        # zstd compressed payloads are detected by themselves and expanded before parsing
+        self.decompressor = decompressor or Decompressor()
+        # held while the state is mutated, readers (UI) take it to get a consistent view
+        self.lock = threading.Lock()
+        self.stats = IngestStats()
+        # see reorder_buffer.py for the options: window, dedup_horizon, max_bytes, max_station_bytes
+        self.buffers = ReorderBuffers(self.stats, **(buffer_options or {}))
+        # station locations and tracks, read by the query API and the map page with the lock held
+        self.spatial = SpatialIndex(capacity) if spatial else None
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+
+    def submit(self, topic, payload):
+        """Called from the MQTT network thread; returns False if the message had to be dropped."""
+        self.stats.received += 1
+        count_received(topic, payload)
+        try:
+            self._queue.put((topic, payload, time.time_ns()), timeout=self.put_timeout)
+        except queue.Full:
+            self.stats.dropped += 1
+            ERRORS.labels("dropped").inc()
+            return False
+        depth = self._queue.qsize()
+        if depth > self.stats.max_depth:
+            self.stats.max_depth = depth
+        return True
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        self._queue.put(None)
+
+    def run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                self.flush_idle()
+                if self.archive is not None:
+                    self.archive.sync_if_due()
+                if self.exporter is not None:
+                    self.exporter.flush_if_due()
+                continue
+            if item is None:
+                self.flush()
+                if self.archive is not None:
+                    self.archive.close()
+                if self.exporter is not None:
+                    self.exporter.close()
+                return
+            try:
+                self.process(*item)
+            finally:
+                self._queue.task_done()
+
+    def drain(self):
+        """Block until every submitted message has been processed."""
+        self._queue.join()
+
+    def restore(self, reader):
+        """Rebuild the station state from an archive.ArchiveReader, before live ingestion starts."""
+        count = 0
+        for received_ns, topic, payload, _ in reader.scan():
+            self.process(topic, payload, received_ns, archive=False)
+            count += 1
+        return count
+
+    def process(self, topic, payload, received_ns=None, archive=True):
+        timings = self.timings
+        started = time.perf_counter()
+        if archive and received_ns is not None:
+            # restored messages are not timed, they were received long ago
+            QUEUE_WAIT.observe((time.time_ns() - received_ns) / 1e9)
+        parsed = parse_topic(topic)
+        if parsed is None:
+            self.stats.unknown_topics += 1
+            ERRORS.labels("unknown_topic").inc()
+            return
+
+        message = pb2.FirstMileMessage()
+        try:
+            payload = self.decompressor.decompress(payload)
+            message.ParseFromString(payload)
+        except Exception:
+            self.stats.parse_errors += 1
+            ERRORS.labels("parse_error").inc()
+            return
+        PARSE_SECONDS.observe(time.perf_counter() - started)
+        if timings is not None:
+            timings.add("parse", started)
+
+        key = parsed[3]
+        content_type = message.WhichOneof("content")
+        accepted = []
+        if content_type == "metadata":
+            accepted = self.apply_metadata(key, message.metadata, received_ns)
+        elif content_type == "data":
+            columns = self.apply_data(key, topic, message.data, received_ns)
+            if columns is not None:
+                accepted = [(columns, received_ns)]
+        # restored messages (archive=False) have been exported when they were first received
+        if accepted and archive and self.exporter is not None:
+            exported = time.perf_counter()
+            for columns, accepted_ns in accepted:
+                self.exporter.add(key, columns, self.stations[key].metadata, accepted_ns)
+            if timings is not None:
+                timings.add("export", exported)
+        self.stats.processed += 1
+
+        if archive and self.archive is not None:
+            archived = time.perf_counter()
+            # archived uncompressed, with the hash of the metadata in force, so Data can be joined with its Metadata later
+            metadata = self.stations[key].metadata if key in self.stations else None
+            self.archive.append(topic, payload, received_ns, metadata.hash if metadata is not None else None)
+            if timings is not None:
+                timings.add("archive", archived)
+        PROCESSED.labels(content_type or "empty").inc()
+        PROCESS_SECONDS.labels(content_type or "empty").observe(time.perf_counter() - started)
+        if timings is not None:
+            timings.add("total", started)
+
+    def station(self, key):
+        station = self.stations.get(key)
+        if station is None:
+            station = self.stations[key] = Station(key, self.capacity, self.strict_order)
+        return station
+
+    def apply_metadata(self, key, metadata, received_ns=None):
+        """Returns [(columns, received_ns)] of the held Data messages the new Metadata made valid."""
+        started = time.perf_counter()
+        with self.lock:
+            previous = self.station(key).metadata
+        # hashing and indexing happen outside the lock; an unchanged Metadata keeps the current index and version
+        index = MetadataIndex.from_payload(metadata, previous)
+        if index is not previous:
+            # points waiting for the reorder watermark are stored with the version they were accepted under
+            self.buffers.flush(key)
+            self._store_ready()
+        with self.lock:
+            station = self.station(key)
+            station.metadata = index
+            if index is not previous and self.spatial is not None:
+                self.spatial.set_metadata(key, index)
+            station.last_messages.append(metadata)
+            station.n_messages += 1
+            station.touch(received_ns)
+        # the validator is only used from this thread
+        for issue in station.validator.set_metadata(index):
+            VALIDATION_ISSUES.labels(issue.check).inc()
+            self._warn(station, f"⚠️ WARNING: Metadata for {key}: {describe([issue])}")
+        accepted = []
+        if index is not previous:
+            quarantined = station.validator.release()
+            # Data that arrived before the first Metadata is validated for the first time
+            for pending in self.buffers.release_pending(key):
+                columns = self.apply_data(key, pending.topic, pending.data, pending.received_ns, released=True)
+                if columns is not None:
+                    accepted.append((columns, pending.received_ns))
+            for held in quarantined:
+                columns = self.apply_data(key, held.topic, held.data, held.received_ns, retry=True)
+                if columns is not None:
+                    accepted.append((columns, held.received_ns))
+        if self.timings is not None:
+            self.timings.add("metadata", started)
+        return accepted
+
+    def _warn(self, station, warning):
+        with self.lock:
+            station.warnings.append(warning)
+            station.n_warnings += 1
+            station.revision += 1
+
+    def apply_data(self, key, topic, data, received_ns=None, retry=False, released=False):
+        """Validate and store a Data message; returns its decoded columns without the observations already
+        accepted, or None if it was held for Metadata, quarantined or a duplicate.
+        retry: a quarantined message, released: a message held for Metadata; both were counted when received."""
+        # decoding and validation happen outside the lock, only the column appends are done while holding it
+        started = time.perf_counter()
+        with self.lock:
+            station = self.station(key)
+            if not retry and not released:
+                station.n_messages += 1
+        if station.metadata is None:
+            if self.buffers.hold_pending(key, topic, data, received_ns):
+                warning = f"⚠️ WARNING: Data for topic {topic} arrived before any Metadata, held until it arrives."
+                WARNINGS.labels("data_before_metadata").inc()
+                LOG.log(("data_before_metadata", key), warning)
+                self._warn(station, warning)
+            with self.lock:
+                station.touch(received_ns)
+            return None
+
+        columns = self.decode(data)
+        decoded = time.perf_counter()
+        columns, duplicates = self.buffers.deduplicate(key, columns)
+        if duplicates and not columns:
+            # a redelivery: nothing new, and nothing to validate
+            with self.lock:
+                station.touch(received_ns)
+            return None
+        validator = station.validator
+        issues = validator.check(columns)
+        if issues and not retry:
+            validator.count(issues)
+            for check in {issue.check for issue in issues}:
+                VALIDATION_ISSUES.labels(check).inc()
+        if validator.is_error(issues):
+            validator.hold(topic, data, received_ns, issues, retry)
+            if not retry:
+                self.stats.quarantined += 1
+                QUARANTINED.inc()
+                warning = f"⛔ Quarantined Data message on {topic}: {describe(issues)}"
+                LOG.log(("quarantined", key), warning)
+                self._warn(station, warning)
+            return None
+        validator.accept(columns)
+        self.buffers.accept(key, columns, received_ns)
+
+        with self.lock:
+            station.last_messages.append(data)
+            station.n_observations += len(data.observations) - duplicates
+            station.touch(received_ns)
+        self._store_ready()
+        if self.timings is not None:
+            self.timings.add("decode", started, decoded)
+            self.timings.add("apply", decoded)
+        return columns
+
+    def _store_ready(self):
+        """Append the points released by the buffers to the series of their stations; returns the station keys."""
+        ready = self.buffers.take_ready()
+        if not ready:
+            return set()
+        with self.lock:
+            for key, columns in ready:
+                station = self.station(key)
+                station.series.extend(columns, station.metadata.version if station.metadata is not None else 0)
+                station.revision += 1
+                if self.spatial is not None:
+                    self.spatial.add(key, columns)
+        return {key for key, _ in ready}
+
+    def flush_idle(self):
+        """Store the held points of the stations that have been quiet for the reorder window."""
+        self.buffers.flush_idle(time.time_ns())
+        return self._store_ready()
+
+    def flush(self):
+        """Store every held point, e.g. before stopping."""
+        self.buffers.flush_all()
+        return self._store_ready()
+
+    def compressed(self):
+        """Number of compressed payloads received."""
+        return self.decompressor.compressed
+
+    def memory_usage(self):
+        with self.lock:
+            return sum(station.series.nbytes for station in self.stations.values())
@@ -0,0 +1,248 @@
+# Load generator
+# Emulates many nodes from a single process to measure how many firstmile/{version}/{vendor}/{nodeid} stations
+# a broker and a receiver can handle.
+#
+# Every emulated node is an asyncio task built on the message construction of data-sender.py: it publishes its
+# Metadata retained, then a Data message every period (+/- jitter) carrying a batch of observations.
+# A fraction of the Data messages is preceded by a Metadata change (new firmware version), as happens after a
+# field visit.
+# All nodes share a small pool of long-lived MQTT sessions (mqtt_publisher.py), or the in-process loopback
+# stand-in when --broker is "loopback", in which case no broker is needed at all.
+#
+# A probe subscriber receives the messages back and computes end-to-end latency from the newest observation
+# time in each Data message, so sender and probe must share a clock (same host or NTP synchronised).
+#
+# Example, 2000 nodes reporting every 10-20 s in batches of 5 observations for 5 minutes against a local broker:
+# python3 load-generator.py --broker localhost --nodes 2000 --period 10 --period-max 20 --batch-size 5 --duration 300
+#
+# Example without any broker:
+# python3 load-generator.py --broker loopback --nodes 5000 --period 1 --duration 30
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+from mqtt_publisher import LoopbackPublisher, MqttPublisher, add_publisher_arguments, format_stats
+from protospy import firstmile_pb2 as pb2
+
+# data-sender.py is not an importable module name, load it from its path
+_spec = importlib.util.spec_from_file_location(
+    "data_sender", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data-sender.py"))
+sender = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(sender)
+
+
+class LatencyProbe:
+    """Receives the generated messages back and records end-to-end latency and volume."""
+
+    def __init__(self, max_samples=200000):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.messages = 0
+        self.data_messages = 0
+        self.metadata_messages = 0
+        self.bytes = 0
+        self.latencies = deque(maxlen=max_samples)
+
+    def on_payload(self, topic, payload, retain=False):
+        received = time.time_ns()
+        message = pb2.FirstMileMessage()
+        message.ParseFromString(payload)
+
+        latency = None
+        if message.WhichOneof("content") == "data":
+            newest = max((obs.time.seconds * 1_000_000_000 + obs.time.nanos
+                          for obs in message.data.observations), default=None)
+            if newest is not None:
+                latency = (received - newest) / 1e9
+
+        with self.lock:
+            self.messages += 1
+            self.bytes += len(payload)
+            if latency is None:
+                self.metadata_messages += 1
+            else:
+                self.data_messages += 1
+                self.latencies.append(latency)
+
+    def summary(self):
+        with self.lock:
+            lat = sorted(self.latencies)
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            result = {
+                "received": self.messages,
+                "data": self.data_messages,
+                "metadata": self.metadata_messages,
+                "msgs_per_s": self.messages / elapsed,
+                "bytes_per_s": self.bytes / elapsed,
+            }
+        for p in (0.5, 0.9, 0.95, 0.99, 0.999):
+            result[f"latency_ms_p{p * 100:g}"] = lat[min(len(lat) - 1, int(p * len(lat)))] * 1000.0 if lat else 0.0
+        result["latency_ms_max"] = lat[-1] * 1000.0 if lat else 0.0
+        return result
+
+
+def start_mqtt_probe(args, topic, probe):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"{args.vendor}-probe")
+    if args.username and args.password:
+        client.username_pw_set(args.username, args.password)
+    if args.tls:
+        client.tls_set(ca_certs=args.ca_cert, certfile=args.client_cert, keyfile=args.client_key)
+        client.tls_insecure_set(args.insecure)
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe(topic, qos=args.qos)
+
+    client.on_connect = on_connect
+    client.on_message = lambda client, userdata, msg: probe.on_payload(msg.topic, msg.payload, msg.retain)
+    client.connect(args.broker, args.port, 60)
+    client.loop_start()
+    return client
+
+
+class EmulatedNode:
+    """One emulated station: fixed parameter definitions, changing metadata, batched observations."""
+
+    def __init__(self, topic, period, rng):
+        self.topic = topic
+        self.period = period
+        self.rng = rng
+        self.metadata = sender.build_metadata_transmission()
+        self.metadata_revision = 0
+
+    def metadata_payload(self):
+        return pb2.FirstMileMessage(metadata=self.metadata).SerializeToString()
+
+    def change_metadata(self):
+        self.metadata_revision += 1
+        self.metadata.node.firmwareVersion = f"1.0.{self.metadata_revision}"
+        return self.metadata_payload()
+
+    def data_payload(self, batch_size):
+        # batch_size observations per parameter definition, evenly spread over the last period
+        now_ns = time.time_ns()
+        step_ns = int(self.period * 1e9 / batch_size)
+        data = pb2.Data()
+        for pd in self.metadata.parameterDefinitions:
+            for k in range(batch_size):
+                obs = data.observations.add()
+                obs.parameterDefinitionId = pd.id
+                t = now_ns - (batch_size - 1 - k) * step_ns
+                obs.time.seconds = t // 1_000_000_000
+                obs.time.nanos = t % 1_000_000_000
+                for param in pd.parameters:
+                    if param.longName == "Supply Voltage":
+                        obs.values.add().doubleValue = round(self.rng.uniform(11.5, 13.0), 2)
+                    else:
+                        obs.values.add().doubleValue = round(self.rng.uniform(-40.0, 40.0), 2)
+        return pb2.FirstMileMessage(data=data).SerializeToString()
+
+
+async def run_node(node, publisher, args, deadline):
+    publisher.set_retained(node.topic, node.metadata_payload())
+
+    # spread the start of the nodes over one period to avoid a thundering herd
+    await asyncio.sleep(node.rng.uniform(0, node.period))
+    next_tick = time.monotonic()
+    while next_tick < deadline:
+        if args.metadata_change_rate and node.rng.random() < args.metadata_change_rate:
+            publisher.set_retained(node.topic, node.change_metadata())
+        publisher.publish(node.topic, node.data_payload(args.batch_size))
+
+        next_tick += node.period + node.rng.uniform(-args.jitter, args.jitter)
+        await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+async def report(publishers, probe, interval, deadline):
+    while time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+        sent = sum(p.stats.acked for p in publishers)
+        s = probe.summary()
+        print(f"sent={sent} received={s['received']} rate={s['msgs_per_s']:.1f} msg/s "
+              f"{s['bytes_per_s'] / 1024:.1f} KiB/s e2e latency p50={s['latency_ms_p50']:.1f} ms "
+              f"p99={s['latency_ms_p99']:.1f} ms")
+
+
+async def run(args, publishers, probe):
+    rng = random.Random(args.seed)
+    deadline = time.monotonic() + args.duration
+    tasks = []
+    for i in range(args.nodes):
+        period = args.period if args.period_max is None else rng.uniform(args.period, args.period_max)
+        topic = f"firstmile/{sender.proto_version}/{args.vendor}/{args.node_prefix}{i:06d}"
+        node = EmulatedNode(topic, period, random.Random(rng.random()))
+        tasks.append(run_node(node, publishers[i % len(publishers)], args, deadline))
+    if args.report_interval:
+        tasks.append(report(publishers, probe, args.report_interval, deadline))
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="First mile multi-node load generator")
+    add_publisher_arguments(parser)
+    parser.set_defaults(max_inflight=1000, max_queued=100000)
+    parser.add_argument("--vendor", default="loadgen", help="Vendor name used in the topics")
+    parser.add_argument("--node-prefix", default="NODE", help="Prefix of the generated node ids")
+    parser.add_argument("--nodes", type=int, default=100, help="Number of emulated nodes")
+    parser.add_argument("--connections", type=int, default=1, help="Number of MQTT sessions shared by the nodes")
+    parser.add_argument("--period", type=float, default=10.0, help="Seconds between Data messages of a node")
+    parser.add_argument("--period-max", type=float, help="If set, each node gets a random period between --period and --period-max")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Uniform +/- jitter in seconds added to each period")
+    parser.add_argument("--batch-size", type=int, default=1, help="Observations per parameter definition in each Data message")
+    parser.add_argument("--metadata-change-rate", type=float, default=0.0, help="Probability that a Data message is preceded by a Metadata change")
+    parser.add_argument("--duration", type=float, default=60.0, help="Test duration in seconds")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="Seconds between progress reports (0 disables)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--no-probe", action="store_true", help="Do not subscribe back, only measure publishing")
+    parser.add_argument("--json", help="Write the final summary as JSON to this file")
+
+    args = parser.parse_args()
+
+    probe = LatencyProbe()
+    probe_client = None
+    if args.broker == "loopback":
+        publishers = [LoopbackPublisher(max_queued=args.max_queued)]
+        if not args.no_probe:
+            publishers[0].subscribe(probe.on_payload)
+    else:
+        if not args.no_probe:
+            probe_client = start_mqtt_probe(args, f"firstmile/{sender.proto_version}/{args.vendor}/#", probe)
+        publishers = [MqttPublisher.from_args(args, client_id=f"{args.vendor}-loadgen-{i}")
+                      for i in range(args.connections)]
+
+    for publisher in publishers:
+        publisher.start()
+    try:
+        asyncio.run(run(args, publishers, probe))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for publisher in publishers:
+            publisher.stop()
+        if probe_client is not None:
+            time.sleep(1)  # let the last messages arrive
+            probe_client.loop_stop()
+            probe_client.disconnect()
+
+    summary = {
+        "nodes": args.nodes,
+        "publishers": [p.stats.summary() for p in publishers],
+        "probe": probe.summary(),
+    }
+    for publisher in publishers:
+        print(format_stats(publisher.stats.summary()))
+    print(json.dumps(summary["probe"], indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Compiled metadata of a station
+#
+# Built once when a (retained) Metadata message arrives, so that every consumer (rendering, export,
+# validation) resolves a parameterDefinitionId or a (parameterDefinitionId, value index) pair with a dict
+# lookup instead of scanning the parameter definitions.
+# Each index carries a content hash of the Metadata message; the ingest stage only creates a new index, and
+# bumps the station's metadata version, when the content actually changes (a node re-publishes the same
+# retained Metadata on every reconnection).
+
+import hashlib
+from collections import namedtuple
+
+from protospy import firstmile_pb2 as pb2
+from google.protobuf.json_format import MessageToDict
+
+# One entry per value index of a ParameterDefinition
+ParameterDescriptor = namedtuple("ParameterDescriptor", [
+    "parameter_definition_id",
+    "index",
+    "long_name",
+    "unit",
+    "cell_method",          # CellMethod enum name, e.g. "MEAN"
+    "cell_period_seconds",
+    "device",               # "node" or the observerId, None when not set
+    "device_name",          # name of the node / observer device, None when the reference does not resolve
+    "standard_names",       # {namespace prefix: name}
+    "standard_name_uris",   # {namespace prefix: name resolved through Metadata.namespaces}
+])
+
+
+def content_hash(metadata):
+    return hashlib.sha256(metadata.SerializeToString(deterministic=True)).hexdigest()
+
+
+def resolve_standard_name(namespaces, prefix, name):
+    base = namespaces.get(prefix)
+    if not base:
+        return name
+    if base.endswith(("/", "#", ":")):
+        return base + name
+    return f"{base}/{name}"
+
+
+class MetadataIndex:
+    """Lookup tables derived from one pb2.Metadata message."""
+
+    def __init__(self, metadata, version=1, digest=None):
+        self.message = metadata
+        self.version = version
+        self.hash = digest or content_hash(metadata)
+
+        namespaces = dict(metadata.namespaces)
+        self.namespaces = namespaces
+        self.observers = {obs.id: obs for obs in metadata.observers}
+        self.definitions = {}
+        self.descriptors = {}
+        self.titles = {}
+
+        for pdef in metadata.parameterDefinitions:
+            self.definitions[pdef.id] = pdef
+            for i, param in enumerate(pdef.parameters):
+                target = param.device.WhichOneof("target")
+                if target == "node":
+                    device, device_name = "node", metadata.node.name
+                elif target == "observerId":
+                    device = param.device.observerId
+                    observer = self.observers.get(device)
+                    device_name = observer.name if observer is not None else None
+                else:
+                    device, device_name = None, None
+
+                standard_names = dict(param.standardNames)
+                self.descriptors[(pdef.id, i)] = ParameterDescriptor(
+                    parameter_definition_id=pdef.id,
+                    index=i,
+                    long_name=param.longName,
+                    unit=param.unit,
+                    cell_method=pb2.CellMethod.Name(param.cellMethod),
+                    cell_period_seconds=param.cellPeriodSeconds,
+                    device=device,
+                    device_name=device_name,
+                    standard_names=standard_names,
+                    standard_name_uris={prefix: resolve_standard_name(namespaces, prefix, name)
+                                        for prefix, name in standard_names.items()},
+                )
+
+            if pdef.parameters:
+                names = [p.longName for p in pdef.parameters if p.longName]
+                units = list(dict.fromkeys(p.unit for p in pdef.parameters if p.unit))
+                self.titles[pdef.id] = f"{', '.join(names)} (Unit: {', '.join(units)})"
+
+        self._dict = None
+
+    @classmethod
+    def from_payload(cls, metadata, previous=None):
+        """Index `metadata`, or return `previous` unchanged if the content is identical."""
+        digest = content_hash(metadata)
+        if previous is not None and previous.hash == digest:
+            return previous
+        return cls(metadata, version=previous.version + 1 if previous is not None else 1, digest=digest)
+
+    def definition(self, parameter_definition_id):
+        return self.definitions.get(parameter_definition_id)
+
+    def descriptor(self, parameter_definition_id, index):
+        return self.descriptors.get((parameter_definition_id, index))
+
+    def title(self, parameter_definition_id):
+        return self.titles.get(parameter_definition_id, f"Param ID {parameter_definition_id} (Unit: )")
+
+    def as_dict(self):
+        """MessageToDict rendering of the metadata, computed once per version."""
+        if self._dict is None:
+            self._dict = MessageToDict(self.message)
+        return self._dict
@@ -0,0 +1,251 @@
+# Instrumentation of the sender and receiver
+#
+# Counters, gauges and histograms are kept in process and rendered in the Prometheus text exposition format, so
+# a Prometheus server (or curl) can scrape them from /metrics: the receiver serves them next to the Dash pages,
+# the sender with --metrics-port. Updating a metric is a lock and an addition, cheap enough for every message;
+# values that already exist elsewhere (queue depth, outbox size) are read by callbacks at scrape time instead.
+# Counters and histograms of other processes (sharded ingest workers) are merged in with merge().
+#
+# Per-message printing is replaced by RateLimitedLog: a message is printed at most once per interval and key,
+# with the number of similar messages suppressed in between.
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from 10 us (parse of a small payload) to 10 s (publish acknowledgement over a bad link)
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Child:
+    """Value of a counter or gauge for one combination of label values."""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Metric:
+    """Counter or gauge, optionally with labels: metric.labels("a", "b").inc()."""
+
+    def __init__(self, kind, name, documentation, labelnames=()):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._default = None if self.labelnames else self.labels()
+
+    def _new_child(self):
+        return _Child()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def samples(self):
+        """Yield (name suffix, label values, extra label, value)."""
+        for values, child in list(self._children.items()):
+            yield "", values, "", child.value
+
+    def reset(self):
+        with self._lock:
+            self._children = {}
+        self._default = None if self.labelnames else self.labels()
+
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        super().__init__("histogram", name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", values, f'le="{_format_value(float(bound))}"', cumulative
+            yield "_sum", values, "", child.sum
+            yield "_count", values, "", cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.callbacks = []
+        self.remote = {}  # source -> snapshot() of another process
+
+    def _add(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing  # modules loaded twice (importlib) share the metric
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Metric("counter", name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Metric("gauge", name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def add_callback(self, callback):
+        """callback() is called before every render, to set gauges from state kept elsewhere."""
+        self.callbacks.append(callback)
+
+    def snapshot(self):
+        """Counter and histogram samples, {(name, suffix, label values, extra label): value}, for merge()."""
+        return {(metric.name, suffix, values, extra): value
+                for metric in self.metrics.values() if metric.kind != "gauge"
+                for suffix, values, extra, value in metric.samples()}
+
+    def merge(self, source, snapshot):
+        """Add the samples of another process to the rendered values; a newer snapshot replaces the older."""
+        self.remote[source] = snapshot
+
+    def reset(self):
+        """Zero all metrics, e.g. in a forked worker that reports its own values through snapshot()."""
+        for metric in self.metrics.values():
+            metric.reset()
+        self.callbacks = []
+        self.remote = {}
+
+    def render(self):
+        for callback in list(self.callbacks):
+            callback()
+        remote = {}
+        for snapshot in list(self.remote.values()):
+            for key, value in snapshot.items():
+                remote[key] = remote.get(key, 0) + value
+
+        lines = []
+        for metric in self.metrics.values():
+            samples = {(metric.name, suffix, values, extra): value for suffix, values, extra, value in metric.samples()}
+            for key, value in remote.items():
+                if key[0] == metric.name:
+                    samples[key] = samples.get(key, 0) + value
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for (name, suffix, values, extra), value in samples.items():
+                lines.append(f"{name}{suffix}{_format_labels(metric.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape would drown the tool's own output
+
+
+def start_http_server(port, host="0.0.0.0", registry=REGISTRY):
+    """Serve registry on http://host:port/metrics from a daemon thread."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+class RateLimitedLog:
+    """Prints a message at most once per interval and key, counting the ones suppressed in between."""
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self._last = {}  # key -> (time printed, suppressed since)
+        self._lock = threading.Lock()
+
+    def log(self, key, message, *args):
+        """message is only formatted (message % args) when it is printed."""
+        now = time.monotonic()
+        with self._lock:
+            printed, suppressed = self._last.get(key, (None, 0))
+            if printed is not None and now - printed < self.interval:
+                self._last[key] = (printed, suppressed + 1)
+                return
+            self._last[key] = (now, 0)
+        text = message % args if args else message
+        if suppressed:
+            text += f" ({suppressed} similar messages suppressed in the last {now - printed:.0f} s)"
+        print(text)
+
+
+LOG = RateLimitedLog()
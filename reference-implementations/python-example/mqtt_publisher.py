@@ -0,0 +1,306 @@
+# Long-lived MQTT publisher used by the sender scripts.
+#
+# Keeps a single broker connection open (TCP+TLS handshake happens once, not per message),
+# reconnects automatically with exponential back-off and lets paho pipeline QoS 1/2 messages
+# (several in flight at once, the rest waiting in a bounded local queue).
+# The retained Metadata message is re-published once on every (re)connection, Data messages
+# are streamed over the open session.
+# Publish latency (publish() call -> PUBACK/PUBCOMP) and throughput are tracked for reporting, and exported as
+# metrics (metrics.py).
+
+import queue
+import ssl
+import threading
+import time
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+from metrics import REGISTRY
+
+PUBLISHED = REGISTRY.counter("firstmile_published_messages_total", "Messages handed to the MQTT client", ["topic"])
+PUBLISHED_BYTES = REGISTRY.counter("firstmile_published_bytes_total", "Payload bytes handed to the MQTT client", ["topic"])
+PUBLISH_FAILURES = REGISTRY.counter("firstmile_publish_failures_total", "Messages the MQTT client refused")
+ACKED = REGISTRY.counter("firstmile_acked_messages_total", "Messages acknowledged by the broker")
+CONNECTS = REGISTRY.counter("firstmile_broker_connects_total", "Successful (re)connections to the broker")
+ACK_SECONDS = REGISTRY.histogram("firstmile_publish_ack_seconds", "Time from publish to PUBACK/PUBCOMP")
+IN_FLIGHT = REGISTRY.gauge("firstmile_publish_in_flight", "Published messages not yet acknowledged")
+
+
+class PublisherStats:
+    """Counters and latency samples for published messages."""
+
+    def __init__(self, max_samples=10000):
+        self.started = time.monotonic()
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+        self.bytes = 0
+        self.connects = 0
+        self.latencies = deque(maxlen=max_samples)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        lat = sorted(self.latencies)
+
+        def pct(p):
+            if not lat:
+                return 0.0
+            return lat[min(len(lat) - 1, int(p * len(lat)))] * 1000.0
+
+        return {
+            "published": self.published,
+            "acked": self.acked,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "connects": self.connects,
+            "msgs_per_s": self.acked / elapsed,
+            "bytes_per_s": self.bytes / elapsed,
+            "latency_ms_p50": pct(0.50),
+            "latency_ms_p95": pct(0.95),
+            "latency_ms_p99": pct(0.99),
+            "latency_ms_max": lat[-1] * 1000.0 if lat else 0.0,
+        }
+
+
+class MqttPublisher:
+    """Persistent MQTT session with automatic reconnect and pipelined QoS 1/2 publishing."""
+
+    def __init__(self, broker, port, username=None, password=None, tls=None, client_id="",
+                 qos=1, max_inflight=20, max_queued=1000, keepalive=60):
+        self.broker = broker
+        self.port = port
+        self.qos = qos
+        self.keepalive = keepalive
+        self.stats = PublisherStats()
+
+        # never held while calling into paho, the network thread's callbacks take it under paho's own mutexes
+        self._lock = threading.RLock()
+        self._pending = {}  # mid -> (publish time, payload length)
+        self._early_acks = set()  # mids acknowledged before publish() returned
+        self._retained = {}  # topic -> payload, re-published on every connection
+        self._connected = threading.Event()
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        if username and password:
+            self.client.username_pw_set(username, password)
+
+        if tls:
+            self.client.tls_set(
+                ca_certs=tls.get("ca_cert"),
+                certfile=tls.get("client_cert"),
+                keyfile=tls.get("client_key"),
+                tls_version=ssl.PROTOCOL_TLSv1_2
+            )
+            self.client.tls_insecure_set(tls.get("insecure", False))
+
+        # pipelining: up to max_inflight unacknowledged messages on the wire,
+        # up to max_queued waiting locally (also while the connection is down)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queued)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+
+    @classmethod
+    def from_args(cls, args, client_id=""):
+        tls = {
+            "ca_cert": args.ca_cert,
+            "client_cert": args.client_cert,
+            "client_key": args.client_key,
+            "insecure": args.insecure
+        } if args.tls else None
+
+        return cls(args.broker, args.port, username=args.username, password=args.password, tls=tls,
+                   client_id=client_id, qos=args.qos, max_inflight=args.max_inflight,
+                   max_queued=args.max_queued)
+
+    def start(self, wait=10):
+        print(f"Connecting to MQTT broker {self.broker}:{self.port}...")
+        # connect_async + loop_start: the network thread handles (re)connection on its own
+        self.client.connect_async(self.broker, self.port, self.keepalive)
+        self.client.loop_start()
+        if wait:
+            self._connected.wait(wait)
+
+    def stop(self, drain_timeout=10):
+        deadline = time.monotonic() + drain_timeout
+        while self.in_flight() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def set_retained(self, topic, payload):
+        """Register a retained message (Metadata) and publish it now if connected."""
+        with self._lock:
+            self._retained[topic] = payload
+        if self._connected.is_set():
+            self._publish(topic, payload, retain=True)
+
+    def publish(self, topic, payload):
+        """Queue a non-retained message (Data) for publication; returns the paho MQTTMessageInfo."""
+        return self._publish(topic, payload, retain=False)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def _publish(self, topic, payload, retain):
+        # publish() outside the lock: paho calls on_publish with its own message mutex held, so holding our lock
+        # while publish() takes that mutex would take the two in opposite orders. An acknowledgement handled before
+        # the mid is recorded below is kept in _early_acks instead.
+        sent = time.monotonic()
+        info = self.client.publish(topic, payload, qos=self.qos, retain=retain)
+        with self._lock:
+            # NO_CONN: paho keeps QoS>0 messages queued and sends them after reconnect
+            if info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0):
+                self.stats.published += 1
+                PUBLISHED.labels(topic).inc()
+                PUBLISHED_BYTES.labels(topic).inc(len(payload))
+                if info.mid in self._early_acks:
+                    self._early_acks.discard(info.mid)
+                    self._record_ack(sent, len(payload))
+                else:
+                    self._pending[info.mid] = (sent, len(payload))
+            else:
+                self.stats.failed += 1
+                PUBLISH_FAILURES.inc()
+        return info
+
+    def _record_ack(self, sent, length):
+        latency = time.monotonic() - sent
+        self.stats.acked += 1
+        self.stats.bytes += length
+        self.stats.latencies.append(latency)
+        ACKED.inc()
+        ACK_SECONDS.observe(latency)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print(f"Connection refused: {reason_code}")
+            return
+        self.stats.connects += 1
+        CONNECTS.inc()
+        self._connected.set()
+        with self._lock:
+            retained = list(self._retained.items())
+        # retained Metadata goes out once per connection
+        for topic, payload in retained:
+            self._publish(topic, payload, retain=True)
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self._connected.clear()
+        if reason_code != 0:
+            print(f"Disconnected from broker ({reason_code}), reconnecting...")
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self._lock:
+            sent = self._pending.pop(mid, None)
+            if sent is None:
+                self._early_acks.add(mid)
+                return
+            self._record_ack(*sent)
+
+
+class LoopbackPublisher:
+    """In-process stand-in for a broker connection with the same interface as MqttPublisher.
+
+    Messages are handed to the subscribed callables, callback(topic, payload, retain), from a delivery
+    thread; retained messages are replayed to late subscribers like a broker would.
+    """
+
+    def __init__(self, max_queued=100000):
+        self.stats = PublisherStats()
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._subscribers = []
+        self._retained = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._deliver, name="loopback-delivery", daemon=True)
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+            retained = list(self._retained.items())
+        for topic, payload in retained:
+            callback(topic, payload, True)
+
+    def start(self, wait=None):
+        self.stats.connects += 1
+        self._thread.start()
+
+    def stop(self, drain_timeout=10):
+        deadline = time.monotonic() + drain_timeout
+        while self.in_flight() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._queue.put(None)
+        self._thread.join(drain_timeout)
+
+    def set_retained(self, topic, payload):
+        with self._lock:
+            self._retained[topic] = payload
+        self._enqueue(topic, payload, True)
+
+    def publish(self, topic, payload):
+        self._enqueue(topic, payload, False)
+
+    def in_flight(self):
+        return self._queue.qsize()
+
+    def is_connected(self):
+        return True
+
+    def _enqueue(self, topic, payload, retain):
+        try:
+            self._queue.put_nowait((time.monotonic(), topic, payload, retain))
+            self.stats.published += 1
+            PUBLISHED.labels(topic).inc()
+            PUBLISHED_BYTES.labels(topic).inc(len(payload))
+        except queue.Full:
+            self.stats.failed += 1
+            PUBLISH_FAILURES.inc()
+
+    def _deliver(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            sent, topic, payload, retain = item
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for callback in subscribers:
+                callback(topic, payload, retain)
+            latency = time.monotonic() - sent
+            self.stats.acked += 1
+            self.stats.bytes += len(payload)
+            self.stats.latencies.append(latency)
+            ACKED.inc()
+            ACK_SECONDS.observe(latency)
+
+
+def add_publisher_arguments(parser, broker_required=True):
+    """Broker connection and pipelining options shared by the sender scripts."""
+    parser.add_argument("--broker", required=broker_required, help="MQTT broker address")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--username", help="MQTT username (optional)")
+    parser.add_argument("--password", help="MQTT password (optional)")
+    parser.add_argument("--tls", action="store_true", help="Enable TLS (MQTTS)")
+    parser.add_argument("--ca-cert", help="CA certificate file for TLS connection")
+    parser.add_argument("--client-cert", help="Client certificate file for mutual TLS (optional)")
+    parser.add_argument("--client-key", help="Client private key file for mutual TLS (optional)")
+    parser.add_argument("--insecure", action="store_true", help="Skip server certificate verification")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=1, help="QoS level for published messages")
+    parser.add_argument("--max-inflight", type=int, default=20, help="Maximum number of unacknowledged QoS 1/2 messages on the wire")
+    parser.add_argument("--max-queued", type=int, default=1000, help="Maximum number of messages queued locally while in flight window is full or link is down")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Serve Prometheus metrics on this port at /metrics (0 disables)")
+
+
+def format_stats(summary):
+    return (f"published={summary['published']} acked={summary['acked']} failed={summary['failed']} "
+            f"connects={summary['connects']} rate={summary['msgs_per_s']:.1f} msg/s "
+            f"{summary['bytes_per_s'] / 1024:.1f} KiB/s latency p50={summary['latency_ms_p50']:.1f} ms "
+            f"p95={summary['latency_ms_p95']:.1f} ms p99={summary['latency_ms_p99']:.1f} ms")
@@ -0,0 +1,150 @@
+# Disk-backed store-and-forward queue of outgoing Observations
+#
+# First mile links (cellular, satellite) are often down or expensive per message. The sender therefore does not
+# publish readings directly: every Observation is first committed to a small SQLite database, and Data messages
+# are cut from the oldest pending Observations when
+#   * at least batch_size Observations are pending, or
+#   * the oldest pending Observation is batch_age seconds old,
+# and never larger than max_payload_bytes serialized (clause 7 of the guide allows several Observations in one
+# Data message). Rows are deleted only once the broker has acknowledged the Data message that carried them,
+# so readings taken while the broker was unreachable, or before a restart, are sent after the next connection;
+# a backlog is sent as full batches back to back.
+# Delivery is at-least-once: a batch that was sent but not acknowledged before a restart is sent again.
+
+import sqlite3
+import time
+
+import paho.mqtt.client as mqtt
+
+from payload_files import varint_bytes
+from protospy import firstmile_pb2 as pb2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queued REAL NOT NULL,
+    observation BLOB NOT NULL
+)
+"""
+
+
+def field_size(length):
+    # tag (field number < 16) + length prefix + content of a length-delimited field
+    return 1 + len(varint_bytes(length)) + length
+
+
+class Outbox:
+    """Queue of serialized pb2.Observation; not thread-safe, used from the sender's main loop."""
+
+    def __init__(self, path=":memory:", batch_size=100, batch_age=0.0, max_payload_bytes=256 * 1024,
+                 max_observations=1_000_000):
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self.max_payload_bytes = max_payload_bytes
+        self.max_observations = max_observations
+        self.dropped = 0
+
+        self.db = sqlite3.connect(path)
+        # WAL + synchronous=NORMAL: a commit survives a process crash, at most the last commits are lost on power loss
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+        # rows up to this id are handed to the publisher and waiting for their acknowledgement
+        self._cursor = 0
+        self._in_flight = []  # (message info, first id, last id)
+        self._connects = 0
+
+    def put(self, observations):
+        now = time.time()
+        with self.db:
+            self.db.executemany("INSERT INTO observations (queued, observation) VALUES (?, ?)",
+                                [(now, obs.SerializeToString()) for obs in observations])
+            excess = self.pending() - self.max_observations
+            if excess > 0:
+                # bounded on disk: the oldest readings that are not in flight are given up
+                self.db.execute("DELETE FROM observations WHERE id IN "
+                                "(SELECT id FROM observations WHERE id > ? ORDER BY id LIMIT ?)",
+                                (self._cursor, excess))
+                self.dropped += excess
+
+    def pending(self):
+        """Number of queued Observations, including those in flight."""
+        return self.db.execute("SELECT COUNT(*) FROM observations").fetchone()[0]
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def due(self, now=None):
+        """True when the unsent Observations make up a batch (by count or by age)."""
+        count, oldest = self.db.execute("SELECT COUNT(*), MIN(queued) FROM observations WHERE id > ?",
+                                        (self._cursor,)).fetchone()
+        if not count:
+            return False
+        return count >= self.batch_size or (now or time.time()) - oldest >= self.batch_age
+
+    def next_batch(self):
+        """Serialized FirstMileMessage with the oldest unsent Observations and the id of its last row, or None."""
+        rows = self.db.execute("SELECT id, observation FROM observations WHERE id > ? ORDER BY id LIMIT ?",
+                               (self._cursor, self.batch_size)).fetchall()
+        if not rows:
+            return None
+
+        data = pb2.Data()
+        size = 0
+        last_id = None
+        for row_id, blob in rows:
+            grown = size + field_size(len(blob))
+            # always take at least one Observation, even if it alone exceeds the limit
+            if last_id is not None and field_size(grown) > self.max_payload_bytes:
+                break
+            data.observations.add().MergeFromString(blob)
+            size = grown
+            last_id = row_id
+        return pb2.FirstMileMessage(data=data).SerializeToString(), last_id
+
+    def send(self, publisher, topic, max_in_flight=10, compress=None):
+        """Publish due batches while connected, up to max_in_flight unacknowledged ones; returns batches sent.
+
+        compress, if given, is applied to each serialized batch (see compression.py).
+        """
+        self.collect()
+        if publisher.stats.connects != self._connects:
+            self._connects = publisher.stats.connects
+            if publisher.qos == 0:
+                # paho re-sends unacknowledged QoS 1/2 messages after a reconnection, QoS 0 ones are gone
+                self.rewind()
+        sent = 0
+        while publisher.is_connected() and len(self._in_flight) < max_in_flight and self.due():
+            payload, last_id = self.next_batch()
+            info = publisher.publish(topic, compress(payload) if compress else payload)
+            if not (info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and publisher.qos > 0)):
+                break  # not accepted (local publish queue full), retry on the next call
+            self._in_flight.append((info, self._cursor + 1, last_id))
+            self._cursor = last_id
+            sent += 1
+        return sent
+
+    def collect(self):
+        """Delete the rows of acknowledged batches."""
+        done, waiting = [], []
+        for item in self._in_flight:
+            (done if item[0].is_published() else waiting).append(item)
+        if not done:
+            return
+        self._in_flight = waiting
+        with self.db:
+            self.db.executemany("DELETE FROM observations WHERE id BETWEEN ? AND ?",
+                                [(first, last) for _, first, last in done])
+
+    def rewind(self):
+        """Forget the unacknowledged batches, their Observations are sent again."""
+        self.collect()
+        if self._in_flight:
+            self._cursor = self._in_flight[0][1] - 1
+            self._in_flight = []
+
+    def close(self):
+        self.collect()
+        self.db.close()
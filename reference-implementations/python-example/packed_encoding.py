@@ -0,0 +1,98 @@
+# Experimental packed encoding of Data messages (standard/protobuf-schema/firstmile_packed.proto)
+#
+# The Observations of a Data message are grouped into blocks of the same parameterDefinitionId and value layout
+# (number and kinds of values), Observations without a time in blocks of their own (noTime). A block stores its
+# times once as a base time plus deltas, in the largest time unit that divides all of them (a 10 s series is
+# stored in units of 10 s, so every delta is a 1 byte varint), and one packed column per value index (repeated
+# double / float / ... without a Value wrapper per value).
+#
+# pack_data() and unpack_data() convert between pb2.Data and pb2_packed.PackedData without loss: unpacking a
+# packed Data gives a message that serializes to the same bytes as the original.
+
+import math
+
+from protospy import firstmile_pb2 as pb2
+from protospy import firstmile_packed_pb2 as pb2_packed
+
+NANOS = 1_000_000_000
+
+# Value oneof field -> (ValueKind, PackedColumn field)
+KINDS = {
+    "floatValue": (pb2_packed.FLOAT, "floatValues"),
+    "doubleValue": (pb2_packed.DOUBLE, "doubleValues"),
+    "intValue": (pb2_packed.INT, "intValues"),
+    "unsignedIntValue": (pb2_packed.UNSIGNED_INT, "unsignedIntValues"),
+    "int64Value": (pb2_packed.INT64, "int64Values"),
+    "unsignedInt64Value": (pb2_packed.UNSIGNED_INT64, "unsignedInt64Values"),
+    "stringValue": (pb2_packed.STRING, "stringValues"),
+    "boolValue": (pb2_packed.BOOL, "boolValues"),
+    "emptyValue": (pb2_packed.EMPTY, None),
+    None: (pb2_packed.VALUE_KIND_UNSPECIFIED, None),
+}
+VALUE_FIELDS = {kind: (value_field, column_field) for value_field, (kind, column_field) in KINDS.items()}
+
+
+def pack_data(data):
+    """pb2_packed.PackedData holding the Observations of a pb2.Data message."""
+    groups = {}
+    for position, obs in enumerate(data.observations):
+        layout = tuple(val.WhichOneof("kind") for val in obs.values)
+        rows = groups.setdefault((obs.parameterDefinitionId, obs.HasField("time"), layout), [])
+        rows.append((obs.time.seconds * NANOS + obs.time.nanos, position, obs))
+
+    packed = pb2_packed.PackedData()
+    for (param_id, has_time, layout), rows in groups.items():
+        times = [row[0] for row in rows]
+        unit = math.gcd(*times) or 1
+        block = packed.blocks.add(parameterDefinitionId=param_id, timeUnitNanos=unit, baseTime=times[0] // unit,
+                                  noTime=not has_time)
+        block.timeDeltas.extend((times[i] - times[i - 1]) // unit for i in range(1, len(times)))
+
+        for i, value_field in enumerate(layout):
+            kind, column_field = KINDS[value_field]
+            column = block.columns.add(kind=kind)
+            if column_field is not None:
+                getattr(column, column_field).extend([getattr(row[2].values[i], value_field) for row in rows])
+
+    # positions are only needed when the Observations are not in the order unpack_data() restores by itself
+    keyed = [(row[0], b, row[1]) for b, rows in enumerate(groups.values()) for row in rows]
+    if [item[2] for item in sorted(keyed)] != list(range(len(data.observations))):
+        for block, rows in zip(packed.blocks, groups.values()):
+            block.positions.extend(row[1] for row in rows)
+    return packed
+
+
+def block_times(block):
+    """Observation times of a PackedBlock in ns."""
+    unit = block.timeUnitNanos or 1
+    t = block.baseTime
+    times = [t * unit]
+    for delta in block.timeDeltas:
+        t += delta
+        times.append(t * unit)
+    return times
+
+
+def unpack_data(packed):
+    """pb2.Data with the Observations of a pb2_packed.PackedData, in their original order."""
+    rows = []
+    for b, block in enumerate(packed.blocks):
+        times = block_times(block)
+        columns = [(VALUE_FIELDS[column.kind][0],
+                    getattr(column, VALUE_FIELDS[column.kind][1]) if VALUE_FIELDS[column.kind][1] else None)
+                   for column in block.columns]
+        positions = block.positions or None
+        for r, t in enumerate(times):
+            obs = pb2.Observation(parameterDefinitionId=block.parameterDefinitionId)
+            if not block.noTime:
+                obs.time.seconds, obs.time.nanos = divmod(t, NANOS)
+            for value_field, values in columns:
+                val = obs.values.add()
+                if value_field == "emptyValue":
+                    val.emptyValue.SetInParent()
+                elif value_field is not None:
+                    setattr(val, value_field, values[r])
+            rows.append(((positions[r],) if positions else (t, b, r), obs))
+
+    rows.sort(key=lambda row: row[0])
+    return pb2.Data(observations=[obs for _, obs in rows])
@@ -0,0 +1,359 @@
+# Columnar export of received observations to Parquet
+#
+# Decoded Data observations are joined with the metadata in force for their station (longName, unit,
+# standardNames, cellMethod, device of each value) and written as Parquet, one row per observed value, in a
+# Hive-style partitioned directory that pyarrow, pandas, DuckDB or Spark read as one dataset:
+#
+#   <directory>/vendor=geolux/nodeid=AWS123/date=2026-03-11/part-<writer>-<n>.parquet
+#
+# Rows are buffered per partition and written as a row group every row_group_rows rows; when the buffers of all
+# partitions together reach max_buffer_rows the largest is written early, so memory stays bounded whatever the
+# number of stations. A Parquet file is only readable once closed (the footer comes last), so files are
+# written under a hidden name, which dataset readers skip, and renamed when closed: after max_file_rows rows,
+# when more than max_open_files are open, on close(), and once the file has been open, or its partition has had
+# rows buffered, for file_interval seconds. The latter is checked as rows are added, so every row is readable
+# file_interval seconds after it was buffered, whether the receiver is busy or idle.
+#
+# The live receiver exports with --export-dir; archives and payload files are exported in bulk with:
+# python3 parquet_export.py ./archive --output ./parquet
+# python3 parquet_export.py ./archive --output ./parquet --node geolux/AWS123 --start 2026-03-11T00:00:00Z
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed when exporting
+    pa = None
+    pq = None
+
+NS_PER_DAY = 86400 * 1_000_000_000
+ROW_GROUP_ROWS = 128 * 1024
+MAX_BUFFER_ROWS = 1024 * 1024
+MAX_FILE_ROWS = 16 * 1024 * 1024
+MAX_OPEN_FILES = 64
+FILE_INTERVAL = 3600.0
+
+INT_KINDS = {"intValue", "unsignedIntValue", "int64Value", "unsignedInt64Value"}
+INT64_MAX = np.iinfo(np.int64).max
+
+# descriptor columns joined from metadata_index.ParameterDescriptor
+DESCRIPTOR_FIELDS = ("long_name", "unit", "cell_method", "cell_period_seconds", "device_name")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Parquet export requires the pyarrow package (pip install pyarrow)")
+
+
+def export_schema():
+    require_pyarrow()
+    text = pa.dictionary(pa.int32(), pa.string())
+    timestamp = pa.timestamp("ns", tz="UTC")
+    return pa.schema([
+        ("time", timestamp),
+        ("received_time", timestamp),
+        ("parameter_definition_id", pa.uint32()),
+        ("value_index", pa.uint16()),
+        ("value_kind", text),
+        ("value", pa.float64()),         # numeric and bool values, NaN for strings and emptyValue
+        ("int_value", pa.int64()),       # exact integer values, null for other kinds
+        ("string_value", pa.string()),   # stringValue, null for other kinds
+        ("metadata_version", pa.uint32()),  # 0: no metadata had been received, descriptor columns are null
+        ("long_name", text),
+        ("unit", text),
+        ("cell_method", text),
+        ("cell_period_seconds", pa.uint32()),
+        ("device", text),
+        ("device_name", text),
+        ("standard_names", pa.map_(pa.string(), pa.string())),
+    ])
+
+
+def partition_path(key, day):
+    vendor, _, nodeid = key.partition("/")
+    date = np.datetime_as_string(np.datetime64(day, "D"))
+    return os.path.join(f"vendor={vendor}", f"nodeid={nodeid}", f"date={date}")
+
+
+class Partition:
+    """Buffered rows and open file of one node and date."""
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []  # (times, values, parameterDefinitionId, value index, kind, received ns, descriptor, version)
+        self.rows = 0
+        self.buffered_since = 0.0  # when the oldest buffered row was added
+        self.writer = None
+        self.file = None
+        self.file_rows = 0
+        self.opened = 0.0
+        self.used = 0.0
+
+
+class ParquetExporter:
+    """Streams decoded observations into partitioned Parquet files; used from one thread."""
+
+    def __init__(self, directory, name=None, row_group_rows=ROW_GROUP_ROWS, max_buffer_rows=MAX_BUFFER_ROWS,
+                 max_file_rows=MAX_FILE_ROWS, max_open_files=MAX_OPEN_FILES, file_interval=FILE_INTERVAL,
+                 compression="zstd"):
+        require_pyarrow()
+        self.directory = directory
+        # file names are unique per writer and run, so several processes can export into the same dataset
+        self.name = name or f"{time.time_ns():x}"
+        self.row_group_rows = row_group_rows
+        self.max_buffer_rows = max_buffer_rows
+        self.max_file_rows = max_file_rows
+        self.max_open_files = max_open_files
+        self.file_interval = file_interval
+        self.compression = compression
+        self.schema = export_schema()
+        self.partitions = {}
+        self.buffered = 0
+        self.open_files = 0
+        self.rows = 0
+        self.row_groups = 0
+        self.files = 0
+        self._counter = 0
+        self._next_flush = time.monotonic() + file_interval
+
+    def add(self, key, columns, metadata=None, received_ns=None):
+        """Buffer decoded columns, {(parameterDefinitionId, value index, kind): (times_ns, values)}, of station key."""
+        if received_ns is None:
+            received_ns = time.time_ns()
+        version = metadata.version if metadata is not None else 0
+        for (param_id, index, kind), (times, values) in columns.items():
+            times = np.asarray(times, dtype=np.int64)
+            descriptor = metadata.descriptor(param_id, index) if metadata is not None else None
+            chunk = (param_id, index, kind, received_ns, descriptor, version)
+            days = times // NS_PER_DAY
+            if days[0] == days[-1] and (len(days) < 3 or (days == days[0]).all()):
+                self._buffer(key, int(days[0]), times, values, chunk)
+                continue
+            # a batch spanning midnight UTC goes to two partitions
+            values = np.asarray(values, dtype=object)
+            for day in np.unique(days).tolist():
+                mask = days == day
+                self._buffer(key, day, times[mask], values[mask].tolist(), chunk)
+
+        while self.buffered >= self.max_buffer_rows:
+            largest = max(self.partitions.values(), key=lambda p: p.rows)
+            self._write(largest)
+        if time.monotonic() >= self._next_flush:
+            self.flush_if_due()
+
+    def _buffer(self, key, day, times, values, chunk):
+        partition = self.partitions.get((key, day))
+        if partition is None:
+            partition = self.partitions[(key, day)] = Partition(partition_path(key, day))
+        if not partition.rows:
+            partition.buffered_since = time.monotonic()
+        partition.chunks.append((times, values) + chunk)
+        partition.rows += len(times)
+        self.buffered += len(times)
+        if partition.rows >= self.row_group_rows:
+            self._write(partition)
+
+    def _write(self, partition):
+        if not partition.rows:
+            return
+        table = self._table(partition.chunks)
+        self.buffered -= partition.rows
+        partition.chunks = []
+        partition.rows = 0
+
+        if partition.writer is None:
+            if self.open_files >= self.max_open_files:
+                self._close_file(min((p for p in self.partitions.values() if p.writer is not None),
+                                     key=lambda p: p.used))
+            directory = os.path.join(self.directory, partition.path)
+            os.makedirs(directory, exist_ok=True)
+            self._counter += 1
+            partition.file = os.path.join(directory, f"part-{self.name}-{self._counter:05d}.parquet")
+            partition.writer = pq.ParquetWriter(self._hidden(partition.file), self.schema,
+                                                compression=self.compression)
+            partition.file_rows = 0
+            partition.opened = time.monotonic()
+            self.open_files += 1
+
+        partition.writer.write_table(table, row_group_size=len(table))
+        partition.file_rows += len(table)
+        partition.used = time.monotonic()
+        self.rows += len(table)
+        self.row_groups += 1
+        if partition.file_rows >= self.max_file_rows:
+            self._close_file(partition)
+
+    @staticmethod
+    def _hidden(path):
+        directory, name = os.path.split(path)
+        return os.path.join(directory, "." + name)
+
+    def _close_file(self, partition):
+        partition.writer.close()
+        os.replace(self._hidden(partition.file), partition.file)
+        partition.writer = None
+        self.open_files -= 1
+        self.files += 1
+
+    def _table(self, chunks):
+        lengths = np.array([len(c[0]) for c in chunks])
+        n = int(lengths.sum())
+        kinds = [c[4] for c in chunks]
+
+        value = np.full(n, np.nan)
+        int_value = np.zeros(n, dtype=np.int64)
+        int_valid = np.zeros(n, dtype=bool)
+        string_value = [None] * n
+        offset = 0
+        for (_, values, _, _, kind, *_), length in zip(chunks, lengths.tolist()):
+            end = offset + length
+            if kind == "stringValue":
+                string_value[offset:end] = values
+            elif kind != "emptyValue":
+                value[offset:end] = values
+                if kind in INT_KINDS:
+                    ints = np.asarray(values, dtype=np.uint64 if kind == "unsignedInt64Value" else np.int64)
+                    exact = ints <= INT64_MAX if ints.dtype == np.uint64 else True
+                    int_value[offset:end] = np.where(exact, ints, 0).astype(np.int64)
+                    int_valid[offset:end] = exact
+            offset = end
+
+        # the metadata join is done on the distinct descriptors of the buffer, then expanded with take()
+        slots = {}
+        descriptors = []
+        chunk_slots = []
+        for chunk in chunks:
+            descriptor = chunk[6]
+            slot = slots.get(id(descriptor))
+            if slot is None:
+                slot = slots[id(descriptor)] = len(descriptors)
+                descriptors.append(descriptor)
+            chunk_slots.append(slot)
+        rows = np.repeat(np.array(chunk_slots, dtype=np.int32), lengths)
+        joined = {field: pa.array([getattr(d, field) if d is not None else None for d in descriptors],
+                                  type=self.schema.field(field).type).take(rows)
+                  for field in DESCRIPTOR_FIELDS}
+        # "node" or the observerId
+        joined["device"] = pa.array([str(d.device) if d is not None and d.device is not None else None
+                                     for d in descriptors], type=self.schema.field("device").type).take(rows)
+        joined["standard_names"] = pa.array(
+            [list(d.standard_names.items()) if d is not None else None for d in descriptors],
+            type=self.schema.field("standard_names").type).take(rows)
+
+        columns = {
+            "time": np.concatenate([c[0] for c in chunks]),
+            "received_time": np.repeat(np.array([c[5] for c in chunks], dtype=np.int64), lengths),
+            "parameter_definition_id": np.repeat(np.array([c[2] for c in chunks], dtype=np.uint32), lengths),
+            "value_index": np.repeat(np.array([c[3] for c in chunks], dtype=np.uint16), lengths),
+            "value_kind": pa.array(kinds, type=self.schema.field("value_kind").type).take(
+                pa.array(np.repeat(np.arange(len(chunks), dtype=np.int32), lengths))),
+            "value": value,
+            "int_value": pa.array(int_value, mask=~int_valid),
+            "string_value": pa.array(string_value, type=pa.string()),
+            "metadata_version": np.repeat(np.array([c[7] for c in chunks], dtype=np.uint32), lengths),
+        }
+        columns.update(joined)
+        return pa.table([pa.array(columns[field.name], type=field.type) if isinstance(columns[field.name], np.ndarray)
+                         else columns[field.name] for field in self.schema], schema=self.schema)
+
+    def flush_if_due(self):
+        """Write and close the partitions whose file has been open, or whose oldest buffered row has waited, for
+        file_interval, so their rows become readable."""
+        now = time.monotonic()
+        self._next_flush = now + self.file_interval
+        for partition in list(self.partitions.values()):
+            since = min(partition.opened if partition.writer is not None else now,
+                        partition.buffered_since if partition.rows else now)
+            if now - since >= self.file_interval:
+                # _write() closes the file itself once it reaches max_file_rows
+                self._write(partition)
+                if partition.writer is not None:
+                    self._close_file(partition)
+            elif since < now:
+                self._next_flush = min(self._next_flush, since + self.file_interval)
+        # forget partitions with nothing buffered or open, e.g. the previous day
+        self.partitions = {key: p for key, p in self.partitions.items() if p.rows or p.writer is not None}
+
+    def close(self):
+        for partition in self.partitions.values():
+            self._write(partition)
+            if partition.writer is not None:
+                self._close_file(partition)
+        self.partitions = {}
+
+
+def export_payloads(records, exporter, decompressor=None):
+    """Export (topic, receive time ns, payload) records, replaying the Metadata messages to join the Data with."""
+    from archive import station_key
+    from decoding import decode_data
+    from metadata_index import MetadataIndex
+    from protospy import firstmile_pb2 as pb2
+
+    metadata = {}
+    counts = {"messages": 0, "data": 0, "parse_errors": 0}
+    for topic, received_ns, payload in records:
+        counts["messages"] += 1
+        message = pb2.FirstMileMessage()
+        try:
+            if decompressor is not None:
+                payload = decompressor.decompress(payload)
+            message.ParseFromString(payload)
+        except Exception:
+            counts["parse_errors"] += 1
+            continue
+        key = station_key(topic)
+        content_type = message.WhichOneof("content")
+        if content_type == "metadata":
+            metadata[key] = MetadataIndex.from_payload(message.metadata, metadata.get(key))
+        elif content_type == "data":
+            exporter.add(key, decode_data(message.data), metadata.get(key), received_ns)
+            counts["data"] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export archived or recorded payloads to partitioned Parquet")
+    parser.add_argument("inputs", nargs="+", help="Archive directories, JSON payload sequences or length-delimited files")
+    parser.add_argument("--output", required=True, help="Dataset directory")
+    parser.add_argument("--topic", default="firstmile/poc1/export/node", help="Topic of inputs that carry no topic")
+    parser.add_argument("--node", help="Only export this station key vendor/nodeid (archives)")
+    parser.add_argument("--start", help="Start of the receive time range (RFC 3339, archives)")
+    parser.add_argument("--end", help="End of the receive time range (RFC 3339, archives)")
+    parser.add_argument("--row-group-rows", type=int, default=ROW_GROUP_ROWS, help="Rows per Parquet row group")
+    parser.add_argument("--max-buffer-rows", type=int, default=MAX_BUFFER_ROWS, help="Rows buffered over all partitions")
+    parser.add_argument("--compression", default="zstd", help="Parquet compression codec")
+    parser.add_argument("--zstd-dict", action="append", default=[], help="zstd dictionary of compressed payloads, may be repeated")
+    args = parser.parse_intermixed_args()
+
+    from archive import ArchiveReader, parse_time
+    from compression import Decompressor, load_dictionary
+    from payload_files import load_payloads
+
+    def records():
+        for path in args.inputs:
+            if os.path.isdir(path):
+                query = ArchiveReader(path).query(args.node, parse_time(args.start), parse_time(args.end))
+                for received_ns, topic, payload, _ in query:
+                    yield topic, received_ns, payload
+            else:
+                for topic, received_ns, payload in load_payloads(path):
+                    yield topic or args.topic, received_ns, payload
+
+    exporter = ParquetExporter(args.output, row_group_rows=args.row_group_rows, max_buffer_rows=args.max_buffer_rows,
+                               compression=args.compression)
+    started = time.perf_counter()
+    counts = export_payloads(records(), exporter, Decompressor([load_dictionary(p) for p in args.zstd_dict]))
+    exporter.close()
+    elapsed = time.perf_counter() - started
+    print(f"Exported {exporter.rows} rows from {counts['data']} Data messages ({counts['messages']} messages, "
+          f"{counts['parse_errors']} parse errors) into {exporter.files} files, {exporter.row_groups} row groups, "
+          f"in {elapsed:.1f} s ({exporter.rows / elapsed if elapsed else 0:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
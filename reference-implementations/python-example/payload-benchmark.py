@@ -0,0 +1,202 @@
+# Benchmark of protobuf encoding/decoding of FirstMileMessage payloads
+#
+# Cases: the Data/Metadata messages built by data-sender.py, the station examples of standard/examples, the
+# AMDAR and BOM AWS test sequences of standard/tests (all Data of a sequence merged into one batch) and synthetic
+# Data batches of 1 to 10000 observations.
+# For every case it measures message construction (synthetic batches), SerializeToString, ParseFromString,
+# MessageToJson and JSON Parse, and reports the wire size and bytes per observation.
+# Data cases are also converted to the experimental packed encoding (packed_encoding.py): pack/unpack are timed
+# and the packed size per observation is reported next to the size of today's Data message.
+#
+# The Python protobuf backend is selected when google.protobuf is first imported, so each backend runs in its
+# own subprocess (PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=upb / python) and the results are merged.
+#
+# Results are written as JSON (--output) so they can be compared between runs to track regressions:
+# python3 payload-benchmark.py --output bench.json
+# python3 payload-benchmark.py --backend upb --quick
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BACKENDS = ["upb", "python"]
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+TESTS_DIR = os.path.join("..", "..", "standard", "tests")
+EXAMPLES_DIR = os.path.join("..", "..", "standard", "examples")
+SEQUENCE_CASES = {
+    "amdar": os.path.join(TESTS_DIR, "flexibility", "weather", "trajectory", "AMDAR", "amdar.json"),
+    "bom_aws": os.path.join(TESTS_DIR, "flexibility", "weather", "timeSeries", "BOM_AWS", "BOM AWS.json"),
+}
+EXAMPLE_CASES = ["meteostation", "hydrostation"]
+
+
+def measure(func, min_time, repeat=5):
+    """Best and median seconds per call of func over `repeat` rounds of at least min_time seconds."""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10 or number >= 1 << 20:
+            break
+        number *= 2
+    number = max(1, int(number * (min_time / max(elapsed, 1e-9))))
+    rounds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        rounds.append((time.perf_counter() - started) / number)
+    rounds.sort()
+    return rounds[0], rounds[len(rounds) // 2]
+
+
+def load_sender():
+    spec = importlib.util.spec_from_file_location("data_sender", "data-sender.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def merged_data(messages, pb2):
+    data = pb2.Data()
+    for message in messages:
+        if message.WhichOneof("content") == "data":
+            data.observations.extend(message.data.observations)
+    return pb2.FirstMileMessage(data=data)
+
+
+def synthetic_batch(pb2, n, values_per_obs=3):
+    data = pb2.Data()
+    t0 = 1_770_000_000
+    for i in range(n):
+        obs = data.observations.add()
+        obs.parameterDefinitionId = 1
+        obs.time.seconds = t0 + i * 10
+        for j in range(values_per_obs):
+            obs.values.add().doubleValue = 20.0 + i * 0.01 + j
+    return pb2.FirstMileMessage(data=data)
+
+
+def build_cases(pb2, quick):
+    from payload_files import load_json_sequence
+
+    sender = load_sender()
+    cases = {
+        "sender_data": (pb2.FirstMileMessage(data=sender.build_data_transmission("AWS123")), None),
+        "sender_metadata": (pb2.FirstMileMessage(metadata=sender.build_metadata_transmission()), None),
+    }
+    for name in EXAMPLE_CASES:
+        for kind in ("data", "metadata"):
+            path = os.path.join(EXAMPLES_DIR, name, f"{kind}.json")
+            cases[f"{name}_{kind}"] = (load_json_sequence(path)[0], None)
+    for name, path in SEQUENCE_CASES.items():
+        messages = load_json_sequence(path)
+        cases[f"{name}_data"] = (merged_data(messages, pb2), None)
+        cases[f"{name}_metadata"] = (next(m for m in messages if m.WhichOneof("content") == "metadata"), None)
+    for n in BATCH_SIZES[:3] if quick else BATCH_SIZES:
+        cases[f"synthetic_{n}"] = (synthetic_batch(pb2, n), lambda n=n: synthetic_batch(pb2, n))
+    return cases
+
+
+def run_backend(min_time, quick):
+    """Benchmark with the protobuf backend of this process; returns a list of result rows."""
+    from protospy import firstmile_pb2 as pb2
+    from google.protobuf import json_format
+    from google.protobuf.internal import api_implementation
+    from packed_encoding import pack_data, unpack_data
+
+    backend = api_implementation.Type()
+    rows = []
+    for case, (message, build) in build_cases(pb2, quick).items():
+        payload = message.SerializeToString()
+        json_text = json_format.MessageToJson(message)
+        n_obs = len(message.data.observations) if message.WhichOneof("content") == "data" else 0
+
+        ops = {
+            "serialize": message.SerializeToString,
+            "parse": lambda: pb2.FirstMileMessage().ParseFromString(payload),
+            "to_json": lambda: json_format.MessageToJson(message),
+            "from_json": lambda: json_format.Parse(json_text, pb2.FirstMileMessage()),
+        }
+        if build is not None:
+            ops["build"] = build
+        packed_bytes = None
+        if n_obs:
+            packed = pack_data(message.data)
+            packed_bytes = packed.ByteSize()
+            ops["pack"] = lambda: pack_data(message.data)
+            ops["unpack"] = lambda: unpack_data(packed)
+
+        for op, func in ops.items():
+            best, median = measure(func, min_time)
+            rows.append({
+                "backend": backend,
+                "case": case,
+                "op": op,
+                "observations": n_obs,
+                "wire_bytes": len(payload),
+                "json_bytes": len(json_text.encode("utf-8")),
+                "bytes_per_observation": len(payload) / n_obs if n_obs else None,
+                "packed_bytes": packed_bytes,
+                "packed_bytes_per_observation": packed_bytes / n_obs if n_obs else None,
+                "best_us": best * 1e6,
+                "median_us": median * 1e6,
+                "us_per_observation": median * 1e6 / n_obs if n_obs else None,
+            })
+            print(f"{backend:<7} {case:<22} {op:<10} {median * 1e6:>12.1f} us  {len(payload):>9} B", file=sys.stderr)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FirstMileMessage encode/decode benchmark")
+    parser.add_argument("--backend", choices=BACKENDS + ["all"], default="all", help="Python protobuf backend to benchmark")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per measurement round")
+    parser.add_argument("--quick", action="store_true", help="Only synthetic batches up to 100 observations")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(run_backend(args.min_time, args.quick), sys.stdout)
+        return
+
+    rows = []
+    for backend in BACKENDS if args.backend == "all" else [args.backend]:
+        env = dict(os.environ, PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=backend)
+        cmd = [sys.executable, __file__, "--child", "--min-time", str(args.min_time)] + (["--quick"] if args.quick else [])
+        proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, check=False)
+        if proc.returncode != 0:
+            print(f"Backend {backend} failed or is not available", file=sys.stderr)
+            continue
+        rows.extend(json.loads(proc.stdout))
+
+    import google.protobuf
+    result = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "protobuf": google.protobuf.__version__,
+        "machine": platform.machine(),
+        "results": rows,
+    }
+
+    print(f"{'backend':<7} {'case':<22} {'op':<10} {'median us':>12} {'bytes':>9} {'B/obs':>7} {'packed':>7}")
+    for row in rows:
+        per_obs = f"{row['bytes_per_observation']:.1f}" if row["bytes_per_observation"] else "-"
+        packed_per_obs = f"{row['packed_bytes_per_observation']:.1f}" if row["packed_bytes_per_observation"] else "-"
+        print(f"{row['backend']:<7} {row['case']:<22} {row['op']:<10} {row['median_us']:>12.1f} {row['wire_bytes']:>9} "
+              f"{per_obs:>7} {packed_per_obs:>7}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
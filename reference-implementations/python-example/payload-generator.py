@@ -1,90 +1,349 @@
-from protospy import firstmile_pb2
-from google.protobuf.json_format import Parse
-from google.protobuf.json_format import MessageToJson
-from google.protobuf.json_format import ParseDict
+# Payload generator
+# Builds FirstMileMessage payloads from schema bindings (node.json, observer.json, parameters.json and
+# namespaces.json, see schema_binding.py), by default those of standard/examples/example_schema_binding.
+#
+# "examples" (the default command) writes a Metadata and a Data message as indented JSON to
+# standard/examples/example_output, to be read.
+#
+# "corpus" generates a synthetic corpus for benchmarks and fuzzing, as length-delimited files (payload_files.py),
+# one per node and named after its NodeID. Every node has the Metadata of the bindings under its own name, then
+# --messages Data messages of --batch-size observations per parameter definition, every --period seconds from
+# --start. Each series is a random walk written as one Value kind, the kinds of --kinds being dealt round-robin
+# over the parameters and shifted from node to node, so that all kinds are covered; --empty-rate of the values are
+# emptyValue. A fraction of the Data messages is preceded by a Metadata change (new firmware version), and
+# another fraction carries a deliberate fault (--faults):
+#
+#   unknown_definition  an Observation of a parameterDefinitionId that is not in the Metadata
+#   too_many_values     an Observation with one value more than its definition has parameters
+#   kind_mismatch       a value of another kind than the series had so far
+#   non_monotonic       an Observation repeated at the end of the message
+#   out_of_order        the times moved back before the previous message
+#   short_values        an Observation with one value less
+#   late_metadata       the node's Metadata sent after its first Data message (per node)
+#   truncated           the payload cut short (not parseable, for fuzzing only)
+#   garbage             random bytes instead of the payload (not parseable, for fuzzing only)
+#
+# Nodes are generated in --workers processes, each node from its own seed (--seed and the node number), so a
+# corpus is the same whatever the number of workers. The bindings are read once; the Data messages are encoded
+# a column at a time (wire_encoding.py) and only the faulty ones go through the protobuf API.
+# manifest.json in the output directory records the options and the number of messages and faults.
+#
+# python3 payload-generator.py
+# python3 payload-generator.py corpus --nodes 1000 --messages 1000 --batch-size 5 --metadata-change-rate 0.01 --fault-rate 0.01 --workers 4 --output corpus
+# python3 payload-replay.py corpus/*.pb --vendor corpus
+
+import argparse
 import json
+import multiprocessing
 import os
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+from google.protobuf.json_format import MessageToJson
+from google.protobuf.timestamp_pb2 import Timestamp
+
+import wire_encoding
+from payload_files import write_delimited
+from protospy import firstmile_pb2
+from schema_binding import DEFAULT_BINDING, load_metadata
 
-path_oberservers = "../../standard/examples/example_schema_binding/observer.json"
-path_node = "../../standard/examples/example_schema_binding/host.json"
-path_parameters = "../../standard/examples/example_schema_binding/parameters.json"
-path_namespaces = "../../standard/examples/example_schema_binding/namespaces.json"
-
-output_dir = "../../standard/examples/example_output"
-os.makedirs(output_dir, exist_ok=True)
-
-def read_config_json(json_path, schema):
-    """Load list of protobuf message objects from a JSON config file."""
-    bindings = []
-    with open(json_path, "r") as f:
-        bindings_json = json.load(f)
-        for binding in bindings_json["bindings"]:
-            new_binding = schema()
-            ParseDict(binding, new_binding)
-            bindings.append(new_binding)
-    return bindings
-
-# load and parse bindings for devices and parameters
-observers = read_config_json(path_oberservers, firstmile_pb2.ObserverDevice)
-parameter_definitions = read_config_json(path_parameters, firstmile_pb2.ParameterDefinition)
-namespace_definitions = read_config_json(path_namespaces, firstmile_pb2.Metadata.NamespacesEntry)
-# read node bindings
-with open(path_node, "r") as f:
-    binding_json = f.read()
-    node = firstmile_pb2.Node()
-    Parse(binding_json, node)
-
-# generate internal observations
-observations = []
-internal_observation = firstmile_pb2.Observation()
-internal_observation.parameterDefinitionId = 1
-internal_observation.time.GetCurrentTime()
-internal_observation.values.extend([
-    firstmile_pb2.Value(doubleValue=12.9),
-    firstmile_pb2.Value(doubleValue=33.28)
-])
-observations.append(internal_observation)
-
-# generate 3 random observations
-for i in range(3):
-    observation = firstmile_pb2.Observation()
-    observation.time.GetCurrentTime()
-    observation.parameterDefinitionId = 2
-    observation.values.extend([
-        firstmile_pb2.Value(doubleValue=2304.54),
-        firstmile_pb2.Value(doubleValue=12.3),
-        firstmile_pb2.Value(doubleValue=1.2),
-        firstmile_pb2.Value(intValue=232),
-
-        firstmile_pb2.Value(boolValue=True)
+COMMANDS = ("examples", "corpus")
+KINDS = ["doubleValue", "floatValue", "intValue", "unsignedIntValue", "int64Value", "unsignedInt64Value",
+         "stringValue", "boolValue"]
+MESSAGE_FAULTS = ["unknown_definition", "too_many_values", "kind_mismatch", "non_monotonic", "out_of_order",
+                  "short_values"]
+FAULTS = MESSAGE_FAULTS + ["late_metadata", "truncated", "garbage"]
+DEFAULT_FAULTS = MESSAGE_FAULTS + ["late_metadata"]
+NEEDS_HISTORY = {"kind_mismatch", "out_of_order"}
+UNKNOWN_DEFINITION_ID = 9999
+STATES = np.array(["OK", "OK", "MAINTENANCE", "DEGRADED", "FAULT"], dtype=object)
+
+
+def write_examples(binding, output_dir):
+    """One Metadata and one Data message as indented JSON files."""
+    os.makedirs(output_dir, exist_ok=True)
+    metadata_message = load_metadata(binding)
+
+    # generate internal observations
+    observations = []
+    internal_observation = firstmile_pb2.Observation()
+    internal_observation.parameterDefinitionId = 1
+    internal_observation.time.GetCurrentTime()
+    internal_observation.values.extend([
+        firstmile_pb2.Value(doubleValue=12.9),
+        firstmile_pb2.Value(doubleValue=33.28)
     ])
-    observations.append(observation)
-
-# create transmission payload with observations only
-data_message = firstmile_pb2.Data()
-data_message.observations.extend(observations)
-
-data_wrapper = firstmile_pb2.FirstMileMessage(data=data_message)
-
-# generate data message
-serialized_data_message = data_wrapper.SerializeToString()
-print(f"Length of data message: {len(serialized_data_message)}")
-with open(f"{output_dir}/data_message.json", "w") as f:
-    json_str = json.loads(MessageToJson(data_wrapper))
-    f.write(json.dumps(json_str, indent=4, ensure_ascii=False))
-
-# add metadata
-metadata_message = firstmile_pb2.Metadata()
-metadata_message.node.CopyFrom(node)
-metadata_message.observers.extend(observers)
-metadata_message.parameterDefinitions.extend(parameter_definitions)
-metadata_message.namespaces.update({ns.key: ns.value for ns in namespace_definitions})
-
-metadata_wrapper = firstmile_pb2.FirstMileMessage(metadata=metadata_message)
-
-# generate output with metadata
-serialized_with_metadata = metadata_wrapper.SerializeToString()
-print(f"Length of metadata message: {len(serialized_with_metadata)}")
-with open(f"{output_dir}/metadata_message_with_metadata.json", "w") as f:
-    json_str = json.loads(MessageToJson(metadata_wrapper))
-    f.write(json.dumps(json_str, indent=4, ensure_ascii=False))
+    observations.append(internal_observation)
+
+    # generate 3 random observations
+    for i in range(3):
+        observation = firstmile_pb2.Observation()
+        observation.time.GetCurrentTime()
+        observation.parameterDefinitionId = 2
+        observation.values.extend([
+            firstmile_pb2.Value(doubleValue=2304.54),
+            firstmile_pb2.Value(doubleValue=12.3),
+            firstmile_pb2.Value(doubleValue=1.2),
+            firstmile_pb2.Value(intValue=232),
+
+            firstmile_pb2.Value(boolValue=True)
+        ])
+        observations.append(observation)
+
+    # create transmission payload with observations only
+    data_message = firstmile_pb2.Data()
+    data_message.observations.extend(observations)
+
+    data_wrapper = firstmile_pb2.FirstMileMessage(data=data_message)
+
+    # generate data message
+    serialized_data_message = data_wrapper.SerializeToString()
+    print(f"Length of data message: {len(serialized_data_message)}")
+    with open(f"{output_dir}/data_message.json", "w") as f:
+        json_str = json.loads(MessageToJson(data_wrapper))
+        f.write(json.dumps(json_str, indent=4, ensure_ascii=False))
+
+    metadata_wrapper = firstmile_pb2.FirstMileMessage(metadata=metadata_message)
+
+    # generate output with metadata
+    serialized_with_metadata = metadata_wrapper.SerializeToString()
+    print(f"Length of metadata message: {len(serialized_with_metadata)}")
+    with open(f"{output_dir}/metadata_message_with_metadata.json", "w") as f:
+        json_str = json.loads(MessageToJson(metadata_wrapper))
+        f.write(json.dumps(json_str, indent=4, ensure_ascii=False))
+
+
+def series_values(kind, n, rng):
+    """n values of a random series as the given Value kind."""
+    level = rng.normal(15.0, 10.0)
+    walk = level + np.cumsum(rng.normal(0.0, 0.3, n))
+    if kind == "floatValue":
+        return walk.astype(np.float32)
+    if kind == "doubleValue":
+        return walk
+    if kind == "intValue":  # e.g. tenths of a degree
+        return np.round(walk * 10).astype(np.int64)
+    if kind == "unsignedIntValue":  # e.g. rain gauge tips
+        return np.cumsum(rng.poisson(3.0, n)).astype(np.uint64)
+    if kind == "int64Value":  # e.g. micro-units
+        return np.round(walk * 1e6).astype(np.int64)
+    if kind == "unsignedInt64Value":  # e.g. bytes sent
+        return (rng.integers(0, 2 ** 40) + np.cumsum(rng.integers(0, 2 ** 20, n))).astype(np.uint64)
+    if kind == "stringValue":  # a state that changes now and then
+        return STATES[(rng.random(n) < 0.01).cumsum() % len(STATES)]
+    if kind == "boolValue":  # an alarm
+        return walk > level + 1.0
+    raise ValueError(f"unknown kind {kind}")
+
+
+def shift_times(observations, delta_ns):
+    for observation in observations:
+        t = observation.time.seconds * 1_000_000_000 + observation.time.nanos + delta_ns
+        observation.time.seconds, observation.time.nanos = divmod(t, 1_000_000_000)
+
+
+def inject_fault(fault, payload, rng, shift_ns):
+    """The Data payload with the fault."""
+    if fault == "truncated":
+        return payload[:int(rng.integers(1, len(payload)))]
+    if fault == "garbage":
+        return rng.bytes(len(payload))
+    message = firstmile_pb2.FirstMileMessage.FromString(payload)
+    observations = message.data.observations
+    first = observations[0]
+    if fault == "unknown_definition":
+        unknown = observations.add()
+        unknown.CopyFrom(first)
+        unknown.parameterDefinitionId = UNKNOWN_DEFINITION_ID
+    elif fault == "too_many_values":
+        first.values.add().doubleValue = 0.0
+    elif fault == "kind_mismatch":
+        kinds = [value.WhichOneof("kind") for value in first.values]
+        value = first.values[next((i for i, kind in enumerate(kinds) if kind != "emptyValue"), 0)]
+        if value.WhichOneof("kind") == "stringValue":
+            value.doubleValue = 0.0
+        else:
+            value.stringValue = "mismatch"
+    elif fault == "non_monotonic":
+        observations.add().CopyFrom(first)
+    elif fault == "out_of_order":
+        shift_times(observations, -shift_ns)
+    elif fault == "short_values":
+        del first.values[-1]
+    return message.SerializeToString()
+
+
+_base = None  # serialized Metadata of the bindings, set in every worker
+_options = None
+
+
+def init_worker(metadata_payload, options):
+    global _base, _options
+    _base = firstmile_pb2.Metadata.FromString(metadata_payload)
+    _options = options
+
+
+def generate_node(number):
+    """Write the corpus file of one node; returns its counts."""
+    options = _options
+    rng = np.random.default_rng([options.seed, number])
+    node_id = f"{options.node_prefix}{number:06d}"
+    metadata = firstmile_pb2.Metadata()
+    metadata.CopyFrom(_base)
+    metadata.node.name = node_id
+    metadata.node.serialNumber = f"SN{options.seed}-{number:06d}"
+    metadata.node.firmwareVersion = "1.0.0"
+
+    n_rows = options.messages * options.batch_size
+    period_ns = int(options.period * 1e9)
+    start_ns = int(options.start.seconds * 1e9) + int(rng.integers(0, period_ns))
+    # up to half a period late, times stay strictly increasing
+    times = start_ns + np.arange(n_rows, dtype=np.int64) * period_ns + rng.integers(0, period_ns // 2, n_rows)
+
+    parts = []
+    slot = number
+    for pdef in metadata.parameterDefinitions:
+        cells = []
+        for _ in pdef.parameters:
+            kind = options.kinds[slot % len(options.kinds)]
+            slot += 1
+            empty = rng.random(n_rows) < options.empty_rate
+            cells.append(wire_encoding.value_cells(kind, series_values(kind, n_rows, rng), empty))
+        parts.append(wire_encoding.observations(pdef.id, times, cells))
+    stream, lengths = wire_encoding.flatten(parts)
+    # a row holds one Observation per definition, a message batch_size rows
+    offsets = np.concatenate([[0], np.cumsum(lengths)])[::options.batch_size]
+
+    message_faults = [fault for fault in options.faults if fault in MESSAGE_FAULTS + ["truncated", "garbage"]]
+    faulty = rng.random(options.messages) < (options.fault_rate if message_faults else 0.0)
+    changes = rng.random(options.messages) < options.metadata_change_rate
+    late_metadata = "late_metadata" in options.faults and rng.random() < options.fault_rate
+
+    counts = Counter(files=1, data_messages=options.messages,
+                     observations=n_rows * len(metadata.parameterDefinitions))
+    with open(os.path.join(options.output, f"{node_id}.pb"), "wb") as f:
+        def send(payload):
+            write_delimited(f, payload)
+            counts["bytes"] += len(payload)
+
+        def send_metadata():
+            send(firstmile_pb2.FirstMileMessage(metadata=metadata).SerializeToString())
+            counts["metadata_messages"] += 1
+
+        if not late_metadata:
+            send_metadata()
+        # the receiver learns the kinds and last times anew for every Metadata version, from the first message
+        # it accepts: the faults that depend on them need a good message since the last Metadata
+        history = False
+        for m in range(options.messages):
+            if changes[m] and m:
+                metadata.node.firmwareVersion = f"1.0.{counts['metadata_messages']}"
+                send_metadata()
+                history = False
+            payload = wire_encoding.data_message(stream[offsets[m]:offsets[m + 1]])
+            fault = message_faults[int(rng.integers(len(message_faults)))] if faulty[m] else None
+            if fault is not None and (history or fault not in NEEDS_HISTORY):
+                payload = inject_fault(fault, payload, rng, (options.batch_size + 1) * period_ns)
+                counts[f"fault_{fault}"] += 1
+            else:
+                history = not late_metadata or m > 0
+            send(payload)
+            if late_metadata and m == 0:
+                send_metadata()
+                counts["fault_late_metadata"] += 1
+    return counts
+
+
+def write_corpus(options):
+    os.makedirs(options.output, exist_ok=True)
+    metadata_payload = load_metadata(options.binding).SerializeToString()
+    started = time.perf_counter()
+    counts = Counter()
+    if options.workers > 1:
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        with context.Pool(options.workers, initializer=init_worker, initargs=(metadata_payload, options)) as pool:
+            for node_counts in pool.imap_unordered(generate_node, range(options.nodes), chunksize=4):
+                counts += node_counts
+    else:
+        init_worker(metadata_payload, options)
+        for number in range(options.nodes):
+            counts += generate_node(number)
+    elapsed = time.perf_counter() - started
+
+    n_messages = counts["data_messages"] + counts["metadata_messages"]
+    faults = {name[6:]: n for name, n in sorted(counts.items()) if name.startswith("fault_")}
+    print(f"Generated {n_messages} messages ({counts['observations']} observations, {counts['bytes']} bytes) for "
+          f"{options.nodes} nodes in {elapsed:.3f} s: {n_messages / elapsed:.0f} msg/s")
+    if faults:
+        print(f"  faults: {', '.join(f'{name} {n}' for name, n in faults.items())}")
+    manifest = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "options": {name: value for name, value in vars(options).items() if name not in ("command", "start")},
+        "start": options.start.ToJsonString(),
+        "data_messages": counts["data_messages"],
+        "metadata_messages": counts["metadata_messages"],
+        "observations": counts["observations"],
+        "bytes": counts["bytes"],
+        "faults": faults,
+    }
+    with open(os.path.join(options.output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def parse_time(value):
+    timestamp = Timestamp()
+    timestamp.FromJsonString(value)
+    return timestamp
+
+
+def parse_list(choices):
+    def parse(value):
+        items = [item.strip() for item in value.split(",") if item.strip()]
+        unknown = [item for item in items if item not in choices]
+        if unknown:
+            raise argparse.ArgumentTypeError(f"unknown {', '.join(unknown)}, choose from {', '.join(choices)}")
+        return items
+    return parse
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Generate FirstMileMessage payloads from schema bindings")
+    subparsers = parser.add_subparsers(dest="command")
+    examples = subparsers.add_parser("examples", help="Write example messages as JSON (default)")
+    examples.add_argument("--binding", default=DEFAULT_BINDING, help="Binding directory")
+    examples.add_argument("--output", default="../../standard/examples/example_output", help="Output directory")
+
+    corpus = subparsers.add_parser("corpus", help="Generate a synthetic corpus of length-delimited files")
+    corpus.add_argument("--binding", default=DEFAULT_BINDING, help="Binding directory")
+    corpus.add_argument("--output", required=True, help="Output directory")
+    corpus.add_argument("--nodes", type=int, default=10, help="Number of nodes")
+    corpus.add_argument("--node-prefix", default="NODE", help="Prefix of the generated node ids")
+    corpus.add_argument("--messages", type=int, default=100, help="Data messages per node")
+    corpus.add_argument("--batch-size", type=int, default=1, help="Observations per parameter definition in each Data message")
+    corpus.add_argument("--period", type=float, default=60.0, help="Seconds between two observations of a node")
+    corpus.add_argument("--start", type=parse_time, default=parse_time("2026-01-01T00:00:00Z"), help="Time of the first observations")
+    corpus.add_argument("--kinds", type=parse_list(KINDS), default=KINDS, help="Comma-separated Value kinds to use")
+    corpus.add_argument("--empty-rate", type=float, default=0.02, help="Fraction of the values that are emptyValue")
+    corpus.add_argument("--metadata-change-rate", type=float, default=0.0, help="Probability that a Data message is preceded by a Metadata change")
+    corpus.add_argument("--fault-rate", type=float, default=0.0, help="Probability that a Data message (or node, for late_metadata) has a fault")
+    corpus.add_argument("--faults", type=parse_list(FAULTS), default=DEFAULT_FAULTS, help="Comma-separated faults to inject")
+    corpus.add_argument("--seed", type=int, default=1, help="Random seed")
+    corpus.add_argument("--workers", type=int, default=1, help="Generate the nodes in this many processes")
+
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        argv = ["examples"] + argv
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.command == "corpus":
+        write_corpus(args)
+    else:
+        write_examples(args.binding, args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
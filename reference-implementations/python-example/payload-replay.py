@@ -0,0 +1,184 @@
+# Replay / backfill tool
+# Feeds recorded payloads through the receiver's ingest path, to test and benchmark the receiver without live
+# senders.
+#
+# Inputs can be the JSON sequences of standard/tests (e.g. AMDAR/amdar.json, misaligned_metadata/resilience2.json,
+# BOM_AWS/BOM AWS.json), length-delimited binary captures or archive directories written by the receiver
+# (see payload_files.py). All payloads are serialized once up front, so the replay itself only measures ingest.
+#
+# Pacing (--speed): "realtime" follows the observation times of the Data messages (receive times for archives),
+# a number N replays N times faster, "max" sends as fast as the ingest path accepts.
+# Target (--target): "ingest" bypasses the broker and submits straight to an in-process IngestWorker, reporting
+# ingest throughput and per-stage timings (parse, decode, apply, metadata); "mqtt" publishes to a broker.
+#
+# Examples:
+# python3 payload-replay.py ../../standard/tests/flexibility/weather/trajectory/AMDAR/amdar.json --speed max --repeat 1000
+# python3 payload-replay.py ../../standard/tests/resilience/misaligned_metadata/resilience2.json --speed 60
+# python3 payload-replay.py ./archive --target mqtt --broker localhost --speed realtime
+
+import argparse
+import heapq
+import json
+import os
+import re
+import time
+
+from ingest import IngestWorker, StageTimings
+from sharded_ingest import ShardedIngest
+from mqtt_publisher import MqttPublisher, add_publisher_arguments, format_stats
+from payload_files import load_payloads
+from protospy import firstmile_pb2 as pb2
+
+proto_version = 'poc1'
+
+
+def event_time(payload):
+    """Observation time of a Data payload (newest observation) in ns, None for Metadata."""
+    message = pb2.FirstMileMessage()
+    message.ParseFromString(payload)
+    if message.WhichOneof("content") != "data" or not message.data.observations:
+        return None, message
+    return max(obs.time.seconds * 1_000_000_000 + obs.time.nanos for obs in message.data.observations), message
+
+
+def load_stream(path, vendor):
+    """List of (event time ns, topic, payload, is_metadata, n_observations) for one input, in replay order."""
+    # inputs without topics are one node each, named after the file (payload-generator.py corpus files are
+    # named after their NodeID)
+    node = os.path.splitext(os.path.basename(path.rstrip('/')))[0]
+    default_topic = f"firstmile/{proto_version}/{vendor}/{re.sub(r'[^A-Za-z0-9_.-]+', '_', node)}"
+    stream = []
+    last = None
+    for topic, received_ns, payload in load_payloads(path):
+        t, message = event_time(payload)
+        if received_ns is not None:
+            t = received_ns
+        # keep times monotonic within an input so inputs can be merged without reordering them
+        if t is None or (last is not None and t < last):
+            t = last
+        last = t
+        is_metadata = message.WhichOneof("content") == "metadata"
+        n_obs = 0 if is_metadata else len(message.data.observations)
+        stream.append((t, topic or default_topic, payload, is_metadata, n_obs))
+
+    # leading Metadata without a time inherit the first known time
+    first = next((item[0] for item in stream if item[0] is not None), 0)
+    return [(item[0] if item[0] is not None else first,) + item[1:] for item in stream]
+
+
+def merge_streams(streams):
+    keyed = [[(item[0], n, i) + item[1:] for i, item in enumerate(stream)] for n, stream in enumerate(streams)]
+    return [(item[0],) + item[3:] for item in heapq.merge(*keyed)]
+
+
+def replay(messages, send, speed, max_gap=None):
+    """Send the messages paced according to speed (None = as fast as possible)."""
+    start = time.monotonic()
+    base = messages[0][0] if messages else 0
+    offset = 0.0
+    previous = base
+    for t, topic, payload, is_metadata, _ in messages:
+        if speed is not None:
+            gap = (t - previous) / 1e9
+            if max_gap is not None and gap > max_gap:
+                offset += gap - max_gap
+            previous = t
+            due = start + ((t - base) / 1e9 - offset) / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        send(topic, payload, is_metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded first mile payloads through the receiver")
+    parser.add_argument("inputs", nargs="+", help="JSON sequence files, length-delimited captures or archive directories")
+    parser.add_argument("--target", choices=["ingest", "mqtt"], default="ingest", help="In-process ingest path (no broker) or an MQTT broker")
+    parser.add_argument("--speed", default="max", help="'realtime', a speed-up factor such as 60, or 'max'")
+    parser.add_argument("--max-gap", type=float, help="Compress gaps between messages longer than this many seconds")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the inputs this many times")
+    parser.add_argument("--vendor", default="replay", help="Vendor used in the topic of inputs that carry no topic")
+    parser.add_argument("--decoder", choices=["fast", "dict"], default="fast", help="Decoder of the ingest path")
+    parser.add_argument("--ingest-queue", type=int, default=10000, help="Ingest queue size")
+    parser.add_argument("--shards", type=int, default=0, help="Ingest in this many worker processes (see sharded_ingest.py)")
+    parser.add_argument("--json", help="Write the results as JSON to this file")
+    # broker options are only needed with --target mqtt
+    add_publisher_arguments(parser, broker_required=False)
+
+    args = parser.parse_args()
+    speed = None if args.speed == "max" else 1.0 if args.speed == "realtime" else float(args.speed)
+
+    # serialize everything once, up front
+    started = time.perf_counter()
+    messages = merge_streams([load_stream(path, args.vendor) for path in args.inputs])
+    serialize_seconds = time.perf_counter() - started
+    n_obs = sum(item[4] for item in messages)
+    n_bytes = sum(len(item[2]) for item in messages)
+    print(f"Loaded {len(messages)} messages ({n_obs} observations, {n_bytes} bytes) in {serialize_seconds:.3f} s")
+
+    result = {
+        "inputs": args.inputs,
+        "messages": len(messages) * args.repeat,
+        "observations": n_obs * args.repeat,
+        "bytes": n_bytes * args.repeat,
+        "serialize_seconds": serialize_seconds,
+    }
+
+    if args.target == "ingest":
+        if args.shards:
+            ingest = ShardedIngest(args.shards, max_queue=args.ingest_queue, decoder=args.decoder)
+        else:
+            ingest = IngestWorker(max_queue=args.ingest_queue, decoder=args.decoder)
+            ingest.timings = StageTimings()
+        ingest.start()
+        send = lambda topic, payload, is_metadata: ingest.submit(topic, payload)
+    else:
+        if not args.broker:
+            parser.error("--broker is required with --target mqtt")
+        publisher = MqttPublisher.from_args(args, client_id=f"{args.vendor}-replay")
+        publisher.start()
+
+        def send(topic, payload, is_metadata):
+            if is_metadata:
+                publisher.set_retained(topic, payload)
+            else:
+                publisher.publish(topic, payload)
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        replay(messages, send, speed, args.max_gap)
+    if args.target == "ingest":
+        ingest.drain()
+    else:
+        publisher.stop()
+    elapsed = time.perf_counter() - started
+
+    result.update({
+        "seconds": elapsed,
+        "msgs_per_s": result["messages"] / elapsed,
+        "observations_per_s": result["observations"] / elapsed,
+        "bytes_per_s": result["bytes"] / elapsed,
+    })
+    if args.target == "ingest":
+        result["ingest"] = ingest.stats.as_dict()
+        if ingest.timings is not None:
+            result["stages"] = ingest.timings.as_dict()
+        result["stations"] = {key: {"observations": st.n_observations, "stored_points": len(st.series),
+                                    "metadata_version": st.metadata.version if st.metadata else 0,
+                                    "warnings": st.n_warnings}
+                              for key, st in ingest.stations.items()}
+    else:
+        print(format_stats(publisher.stats.summary()))
+        result["publisher"] = publisher.stats.summary()
+
+    print(f"Replayed {result['messages']} messages in {elapsed:.3f} s: {result['msgs_per_s']:.0f} msg/s, "
+          f"{result['observations_per_s']:.0f} observations/s")
+    for stage, timing in result.get("stages", {}).items():
+        print(f"  {stage:<10} {timing['count']:>9} calls {timing['us_per_call']:>9.1f} us/call {timing['seconds']:>8.3f} s")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Reading and writing files of FirstMileMessage payloads
+#
+# Three formats are understood:
+# * JSON sequences as found in standard/tests: a JSON array of Metadata and Data objects (a Metadata object has
+#   "node"/"parameterDefinitions", a Data object has "observations"), or several such arrays, one per line.
+# * binary captures: serialized FirstMileMessage payloads, each prefixed with its length as a protobuf varint
+#   (the usual "length-delimited" stream format).
+# * archive directories written by archive.py, which also carry the topic and receive time of each payload.
+
+import json
+import os
+
+from protospy import firstmile_pb2 as pb2
+from google.protobuf.json_format import ParseDict
+
+
+def _fix_nulls(item):
+    # the test sequences write an Empty as null ("device": {"node": null}), which ParseDict would drop
+    for pdef in item.get("parameterDefinitions") or []:
+        for param in pdef.get("parameters") or []:
+            device = param.get("device")
+            if isinstance(device, dict) and "node" in device and device["node"] is None:
+                device["node"] = {}
+    for obs in item.get("observations") or []:
+        for val in obs.get("values") or []:
+            if isinstance(val, dict) and "emptyValue" in val and val["emptyValue"] is None:
+                val["emptyValue"] = {}
+    return item
+
+
+def message_from_json(item):
+    """pb2.FirstMileMessage from one Metadata or Data object of a JSON sequence."""
+    item = _fix_nulls(item)
+    if "observations" in item:
+        return pb2.FirstMileMessage(data=ParseDict(item, pb2.Data(), ignore_unknown_fields=True))
+    return pb2.FirstMileMessage(metadata=ParseDict(item, pb2.Metadata(), ignore_unknown_fields=True))
+
+
+def load_json_sequence(path):
+    """List of pb2.FirstMileMessage, in file order."""
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        sequences = [json.loads(text)]
+    except json.JSONDecodeError:
+        # one JSON array per line
+        sequences = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    messages = []
+    for sequence in sequences:
+        for item in sequence if isinstance(sequence, list) else [sequence]:
+            messages.append(message_from_json(item))
+    return messages
+
+
+def varint_bytes(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_delimited(f, payload):
+    f.write(varint_bytes(len(payload)))
+    f.write(payload)
+
+
+def read_delimited(path):
+    """Yield the raw payloads of a length-delimited capture file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos < len(data):
+        try:
+            length, pos = decode_varint(data, pos)
+        except IndexError:
+            return  # truncated tail
+        if pos + length > len(data):
+            return  # truncated tail
+        yield data[pos:pos + length]
+        pos += length
+
+
+def load_payloads(path):
+    """Yield (topic or None, receive time ns or None, payload bytes) from any supported file or directory."""
+    if os.path.isdir(path):
+        from archive import ArchiveReader
+        for received_ns, topic, payload, _ in ArchiveReader(path).scan():
+            yield topic, received_ns, payload
+    elif path.endswith(".json"):
+        for message in load_json_sequence(path):
+            yield None, None, message.SerializeToString()
+    else:
+        for payload in read_delimited(path):
+            yield None, None, payload
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# NO CHECKED-IN PROTOBUF GENCODE
+# source: firstmile_packed.proto
+# Protobuf Python Version: 7.35.1
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import runtime_version as _runtime_version
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+_runtime_version.ValidateProtobufRuntimeVersion(
+    _runtime_version.Domain.PUBLIC,
+    7,
+    35,
+    1,
+    '',
+    'firstmile_packed.proto'
+)
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x16\x66irstmile_packed.proto\x12\x1fwmo.firstmile.poc1.experimental\"\xfd\x01\n\x0cPackedColumn\x12\x38\n\x04kind\x18\x01 \x01(\x0e\x32*.wmo.firstmile.poc1.experimental.ValueKind\x12\x13\n\x0b\x66loatValues\x18\x02 \x03(\x02\x12\x14\n\x0c\x64oubleValues\x18\x03 \x03(\x01\x12\x11\n\tintValues\x18\x04 \x03(\x11\x12\x19\n\x11unsignedIntValues\x18\x05 \x03(\r\x12\x13\n\x0bint64Values\x18\x06 \x03(\x12\x12\x1b\n\x13unsignedInt64Values\x18\x07 \x03(\x04\x12\x14\n\x0cstringValues\x18\x08 \x03(\t\x12\x12\n\nboolValues\x18\t \x03(\x08\"\xcc\x01\n\x0bPackedBlock\x12\x1d\n\x15parameterDefinitionId\x18\x01 \x01(\r\x12\x15\n\rtimeUnitNanos\x18\x02 \x01(\x04\x12\x10\n\x08\x62\x61seTime\x18\x03 \x01(\x12\x12\x12\n\ntimeDeltas\x18\x04 \x03(\x12\x12>\n\x07\x63olumns\x18\x05 \x03(\x0b\x32-.wmo.firstmile.poc1.experimental.PackedColumn\x12\x11\n\tpositions\x18\x06 \x03(\r\x12\x0e\n\x06noTime\x18\x07 \x01(\x08\"J\n\nPackedData\x12<\n\x06\x62locks\x18\x01 \x03(\x0b\x32,.wmo.firstmile.poc1.experimental.PackedBlock*\x99\x01\n\tValueKind\x12\x1a\n\x16VALUE_KIND_UNSPECIFIED\x10\x00\x12\t\n\x05\x46LOAT\x10\x01\x12\n\n\x06\x44OUBLE\x10\x02\x12\x07\n\x03INT\x10\x03\x12\x10\n\x0cUNSIGNED_INT\x10\x04\x12\t\n\x05INT64\x10\x05\x12\x12\n\x0eUNSIGNED_INT64\x10\x06\x12\n\n\x06STRING\x10\x07\x12\x08\n\x04\x42OOL\x10\x08\x12\t\n\x05\x45MPTY\x10\tB2\n\x1fwmo.firstmile.poc1.experimentalB\x0f\x46irstmilePackedb\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'firstmile_packed_pb2', _globals)
+if not _descriptor._USE_C_DESCRIPTORS:
+  _globals['DESCRIPTOR']._loaded_options = None
+  _globals['DESCRIPTOR']._serialized_options = b'\n\037wmo.firstmile.poc1.experimentalB\017FirstmilePacked'
+  _globals['_VALUEKIND']._serialized_start=599
+  _globals['_VALUEKIND']._serialized_end=752
+  _globals['_PACKEDCOLUMN']._serialized_start=60
+  _globals['_PACKEDCOLUMN']._serialized_end=313
+  _globals['_PACKEDBLOCK']._serialized_start=316
+  _globals['_PACKEDBLOCK']._serialized_end=520
+  _globals['_PACKEDDATA']._serialized_start=522
+  _globals['_PACKEDDATA']._serialized_end=596
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# NO CHECKED-IN PROTOBUF GENCODE
+# source: firstmile.proto
+# Protobuf Python Version: 7.35.1
+"""Generated protocol buffer code."""
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import runtime_version as _runtime_version
+from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+_runtime_version.ValidateProtobufRuntimeVersion(
+    _runtime_version.Domain.PUBLIC,
+    7,
+    35,
+    1,
+    '',
+    'firstmile.proto'
+)
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+from google.protobuf import empty_pb2 as google_dot_protobuf_dot_empty__pb2
+from google.protobuf import timestamp_pb2 as google_dot_protobuf_dot_timestamp__pb2
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0f\x66irstmile.proto\x12\x12wmo.firstmile.poc1\x1a\x1bgoogle/protobuf/empty.proto\x1a\x1fgoogle/protobuf/timestamp.proto\"S\n\tDeviceRef\x12&\n\x04node\x18\x01 \x01(\x0b\x32\x16.google.protobuf.EmptyH\x00\x12\x14\n\nobserverId\x18\x02 \x01(\rH\x00\x42\x08\n\x06target\"\xa8\x02\n\tParameter\x12\x10\n\x08longName\x18\x01 \x01(\t\x12\x0c\n\x04unit\x18\x02 \x01(\t\x12G\n\rstandardNames\x18\x03 \x03(\x0b\x32\x30.wmo.firstmile.poc1.Parameter.StandardNamesEntry\x12-\n\x06\x64\x65vice\x18\x04 \x01(\x0b\x32\x1d.wmo.firstmile.poc1.DeviceRef\x12\x32\n\ncellMethod\x18\x05 \x01(\x0e\x32\x1e.wmo.firstmile.poc1.CellMethod\x12\x19\n\x11\x63\x65llPeriodSeconds\x18\x06 \x01(\r\x1a\x34\n\x12StandardNamesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\"i\n\x13ParameterDefinition\x12\n\n\x02id\x18\x01 \x01(\r\x12\x13\n\x0b\x64\x65scription\x18\x02 \x01(\t\x12\x31\n\nparameters\x18\x03 \x03(\x0b\x32\x1d.wmo.firstmile.poc1.Parameter\"\xfa\x01\n\x05Value\x12\x14\n\nfloatValue\x18\x01 \x01(\x02H\x00\x12\x15\n\x0b\x64oubleValue\x18\x02 \x01(\x01H\x00\x12\x12\n\x08intValue\x18\x03 \x01(\x05H\x00\x12\x1a\n\x10unsignedIntValue\x18\x04 \x01(\rH\x00\x12\x14\n\nint64Value\x18\x05 \x01(\x03H\x00\x12\x1c\n\x12unsignedInt64Value\x18\x06 \x01(\x04H\x00\x12\x15\n\x0bstringValue\x18\x07 \x01(\tH\x00\x12\x13\n\tboolValue\x18\x08 \x01(\x08H\x00\x12,\n\nemptyValue\x18\t \x01(\x0b\x32\x16.google.protobuf.EmptyH\x00\x42\x06\n\x04kind\"\x81\x01\n\x0bObservation\x12\x1d\n\x15parameterDefinitionId\x18\x01 \x01(\r\x12(\n\x04time\x18\x02 \x01(\x0b\x32\x1a.google.protobuf.Timestamp\x12)\n\x06values\x18\x03 \x03(\x0b\x32\x19.wmo.firstmile.poc1.Value\"\xa9\x01\n\x08Location\x12\x15\n\x08latitude\x18\x01 \x01(\x01H\x00\x88\x01\x01\x12\x16\n\tlongitude\x18\x02 \x01(\x01H\x01\x88\x01\x01\x12\x13\n\x0bheightMeter\x18\x03 \x01(\x01\x12>\n\x10referenceSurface\x18\x04 \x01(\x0e\x32$.wmo.firstmile.poc1.ReferenceSurfaceB\x0b\n\t_latitudeB\x0c\n\n_longitude\"\xce\x01\n\x04Node\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x33\n\x08location\x18\x02 \x01(\x0b\x32\x1c.wmo.firstmile.poc1.LocationH\x00\x88\x01\x01\x12\x10\n\x03url\x18\x03 \x01(\tH\x01\x88\x01\x01\x12\x19\n\x0cserialNumber\x18\x04 \x01(\tH\x02\x88\x01\x01\x12\x1c\n\x0f\x66irmwareVersion\x18\x05 \x01(\tH\x03\x88\x01\x01\x42\x0b\n\t_locationB\x06\n\x04_urlB\x0f\n\r_serialNumberB\x12\n\x10_firmwareVersion\"\xe4\x01\n\x0eObserverDevice\x12\n\n\x02id\x18\x01 \x01(\r\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x33\n\x08location\x18\x03 \x01(\x0b\x32\x1c.wmo.firstmile.poc1.LocationH\x00\x88\x01\x01\x12\x10\n\x03url\x18\x04 \x01(\tH\x01\x88\x01\x01\x12\x19\n\x0cserialNumber\x18\x05 \x01(\tH\x02\x88\x01\x01\x12\x1c\n\x0f\x66irmwareVersion\x18\x06 \x01(\tH\x03\x88\x01\x01\x42\x0b\n\t_locationB\x06\n\x04_urlB\x0f\n\r_serialNumberB\x12\n\x10_firmwareVersion\"=\n\x04\x44\x61ta\x12\x35\n\x0cobservations\x18\x01 \x03(\x0b\x32\x1f.wmo.firstmile.poc1.Observation\"\xa5\x02\n\x08Metadata\x12&\n\x04node\x18\x01 \x01(\x0b\x32\x18.wmo.firstmile.poc1.Node\x12\x35\n\tobservers\x18\x02 \x03(\x0b\x32\".wmo.firstmile.poc1.ObserverDevice\x12\x45\n\x14parameterDefinitions\x18\x03 \x03(\x0b\x32\'.wmo.firstmile.poc1.ParameterDefinition\x12@\n\nnamespaces\x18\x04 \x03(\x0b\x32,.wmo.firstmile.poc1.Metadata.NamespacesEntry\x1a\x31\n\x0fNamespacesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\"y\n\x10\x46irstMileMessage\x12\x30\n\x08metadata\x18\x01 \x01(\x0b\x32\x1c.wmo.firstmile.poc1.MetadataH\x00\x12(\n\x04\x64\x61ta\x18\x02 \x01(\x0b\x32\x18.wmo.firstmile.poc1.DataH\x00\x42\t\n\x07\x63ontent*\xcc\x02\n\nCellMethod\x12\x1b\n\x17\x43\x45LL_METHOD_UNSPECIFIED\x10\x00\x12\t\n\x05POINT\x10\x01\x12\x07\n\x03SUM\x10\x02\x12\x0b\n\x07MAXIMUM\x10\x03\x12\x1a\n\x16MAXIMUM_ABSOLUTE_VALUE\x10\x04\x12\n\n\x06MEDIAN\x10\x05\x12\r\n\tMID_RANGE\x10\x06\x12\x0b\n\x07MINIMUM\x10\x07\x12\x1a\n\x16MINIMUM_ABSOLUTE_VALUE\x10\x08\x12\x08\n\x04MEAN\x10\t\x12\x17\n\x13MEAN_ABSOLUTE_VALUE\x10\n\x12\x18\n\x14MEAN_OF_UPPER_DECILE\x10\x0b\x12\x08\n\x04MODE\x10\x0c\x12\t\n\x05RANGE\x10\r\x12\x14\n\x10ROOT_MEAN_SQUARE\x10\x0e\x12\x16\n\x12STANDARD_DEVIATION\x10\x0f\x12\x12\n\x0eSUM_OF_SQUARES\x10\x10\x12\x0c\n\x08VARIANCE\x10\x11*\x81\x01\n\x10ReferenceSurface\x12!\n\x1dREFERENCE_SURFACE_UNSPECIFIED\x10\x00\x12\x07\n\x03MSL\x10\x01\x12\t\n\x05GEOID\x10\x02\x12\x06\n\x02GL\x10\x03\x12\x17\n\x13REFERENCE_ELLIPSOID\x10\x04\x12\x15\n\x11PRESSURE_1000_HPA\x10\x05\x42\x1f\n\x12wmo.firstmile.poc1B\tFirstmileb\x06proto3')
+
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'firstmile_pb2', _globals)
+if not _descriptor._USE_C_DESCRIPTORS:
+  _globals['DESCRIPTOR']._loaded_options = None
+  _globals['DESCRIPTOR']._serialized_options = b'\n\022wmo.firstmile.poc1B\tFirstmile'
+  _globals['_PARAMETER_STANDARDNAMESENTRY']._loaded_options = None
+  _globals['_PARAMETER_STANDARDNAMESENTRY']._serialized_options = b'8\001'
+  _globals['_METADATA_NAMESPACESENTRY']._loaded_options = None
+  _globals['_METADATA_NAMESPACESENTRY']._serialized_options = b'8\001'
+  _globals['_CELLMETHOD']._serialized_start=2072
+  _globals['_CELLMETHOD']._serialized_end=2404
+  _globals['_REFERENCESURFACE']._serialized_start=2407
+  _globals['_REFERENCESURFACE']._serialized_end=2536
+  _globals['_DEVICEREF']._serialized_start=101
+  _globals['_DEVICEREF']._serialized_end=184
+  _globals['_PARAMETER']._serialized_start=187
+  _globals['_PARAMETER']._serialized_end=483
+  _globals['_PARAMETER_STANDARDNAMESENTRY']._serialized_start=431
+  _globals['_PARAMETER_STANDARDNAMESENTRY']._serialized_end=483
+  _globals['_PARAMETERDEFINITION']._serialized_start=485
+  _globals['_PARAMETERDEFINITION']._serialized_end=590
+  _globals['_VALUE']._serialized_start=593
+  _globals['_VALUE']._serialized_end=843
+  _globals['_OBSERVATION']._serialized_start=846
+  _globals['_OBSERVATION']._serialized_end=975
+  _globals['_LOCATION']._serialized_start=978
+  _globals['_LOCATION']._serialized_end=1147
+  _globals['_NODE']._serialized_start=1150
+  _globals['_NODE']._serialized_end=1356
+  _globals['_OBSERVERDEVICE']._serialized_start=1359
+  _globals['_OBSERVERDEVICE']._serialized_end=1587
+  _globals['_DATA']._serialized_start=1589
+  _globals['_DATA']._serialized_end=1650
+  _globals['_METADATA']._serialized_start=1653
+  _globals['_METADATA']._serialized_end=1946
+  _globals['_METADATA_NAMESPACESENTRY']._serialized_start=1897
+  _globals['_METADATA_NAMESPACESENTRY']._serialized_end=1946
+  _globals['_FIRSTMILEMESSAGE']._serialized_start=1948
+  _globals['_FIRSTMILEMESSAGE']._serialized_end=2069
+# @@protoc_insertion_point(module_scope)
@@ -0,0 +1,447 @@
+# HTTP/JSON query API of the receiver
+#
+# Serves the station state of the ingest worker (ingest.IngestWorker or sharded_ingest.ShardedIngest) to other
+# systems, on its own port (--api-port) next to the Dash pages or in the headless ingest mode:
+#
+#   GET /api/stations                             station summaries, ?limit=&cursor=&updated_since=
+#   GET /api/stations/{vendor}/{nodeid}           summary of one station
+#   GET /api/stations/{vendor}/{nodeid}/metadata  Metadata in force, as JSON
+#   GET /api/stations/{vendor}/{nodeid}/series/{parameterDefinitionId}/{index}
+#                                                 stored points, ?kind=&start=&end=&limit=&cursor=
+#                                                 or at most ?points= of them for a plot, &method=lttb|minmax
+#   GET /api/map/stations                         station and observer locations, ?bbox=west,south,east,north
+#   GET /api/map/tracks                           positions of moving stations, ?bbox=&start=&end=&points=
+#   GET /api/map/tiles/{zoom}                     location and position counts per Web Mercator tile,
+#                                                 ?bbox=&start=&end=
+#
+# A station summary holds the last-seen time, message/observation/warning/quarantine counts, the metadata version
+# and the latest value of every series. It is built once per station revision (ingest.Station.revision) and
+# cached, so a client polling thousands of stations only costs the rebuild of the stations that changed.
+# Every response carries an ETag derived from the revisions or series sequence numbers it is built from; a request
+# whose If-None-Match matches is answered 304 Not Modified before any body is built.
+# Lists are paginated with an opaque cursor, the station key of the last summary or the (time, sequence number)
+# of the last point, so that the pages stay consistent while new data arrives. Times are RFC 3339 in UTC.
+# With points=, a series is decimated to that many points of the range instead (decimation.py), in one response.
+# The map endpoints answer from the spatial index of the ingest worker (spatial_index.py); a track with more
+# positions than points= is sampled evenly.
+#
+# curl http://localhost:8051/api/stations
+# curl "http://localhost:8051/api/stations/geolux/AWS123/series/1/0?start=2024-05-01T00:00:00Z&limit=1000"
+
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+from google.protobuf.timestamp_pb2 import Timestamp
+
+from decimation import METHODS, reduce, select
+from metrics import REGISTRY
+from spatial_index import parse_bbox
+
+DEFAULT_STATIONS_LIMIT = 1000
+DEFAULT_POINTS_LIMIT = 10000
+MAX_LIMIT = 100000
+MAX_ZOOM = 24
+GZIP_MIN_BYTES = 1400  # about one TCP segment, smaller bodies are not worth compressing
+# part of every ETag: the revisions start from 0 again when the receiver restarts
+INSTANCE = os.urandom(4).hex()
+
+ROUTES = [
+    ("stations", re.compile(r"/api/stations/?")),
+    ("station", re.compile(r"/api/stations/([^/]+/[^/]+)/?")),
+    ("metadata", re.compile(r"/api/stations/([^/]+/[^/]+)/metadata/?")),
+    ("series", re.compile(r"/api/stations/([^/]+/[^/]+)/series/(\d+)/(\d+)/?")),
+    ("map_stations", re.compile(r"/api/map/stations/?")),
+    ("map_tracks", re.compile(r"/api/map/tracks/?")),
+    ("map_tiles", re.compile(r"/api/map/tiles/(\d+)/?")),
+]
+
+API_REQUESTS = REGISTRY.counter("firstmile_api_requests_total", "Query API requests", ["endpoint", "status"])
+API_SECONDS = REGISTRY.histogram("firstmile_api_request_seconds", "Query API response time", ["endpoint"])
+
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_time(value):
+    """RFC 3339 time to epoch nanoseconds."""
+    ts = Timestamp()
+    try:
+        ts.FromJsonString(value)
+    except ValueError:
+        raise QueryError(400, f"Not an RFC 3339 time: {value}")
+    return ts.seconds * 1_000_000_000 + ts.nanos
+
+
+def format_times(times_ns):
+    return np.datetime_as_string(np.asarray(times_ns, dtype="datetime64[ns]"), unit="auto", timezone="UTC")
+
+
+def format_time(time_ns):
+    return str(format_times(time_ns)) if time_ns is not None else None
+
+
+def json_value(value):
+    """Stored value to JSON: NumPy scalars to Python, NaN (emptyValue, missing float) to null."""
+    if isinstance(value, np.floating):
+        # str() is the shortest decimal that reads back as the same float32: 17.37, not 17.3700008392334
+        return float(str(value)) if np.isfinite(value) else None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def json_values(values):
+    if values.dtype == np.float32:
+        # shortest decimal that reads back as the same float32: 17.37, not 17.3700008392334
+        values = values.astype(str).astype(np.float64)
+    if values.dtype.kind == "f":
+        finite = np.isfinite(values)
+        if not finite.all():
+            return [v if ok else None for v, ok in zip(values.tolist(), finite.tolist())]
+    return values.tolist()
+
+
+def etag(*parts):
+    return '"' + hashlib.blake2b(repr((INSTANCE,) + parts).encode("utf-8"), digest_size=12).hexdigest() + '"'
+
+
+def build_summary(station):
+    """JSON summary of an ingest.Station, called with the ingest lock held."""
+    metadata = station.metadata
+    vendor, nodeid = station.key.split("/", 1)
+    latest = []
+    last_times = []
+    for key in station.series.keys():
+        buf = station.series.buffers[key]
+        last = buf.last()
+        if last is None:
+            continue
+        param_id, index, kind = key
+        descriptor = metadata.descriptor(param_id, index) if metadata is not None else None
+        latest.append({
+            "parameterDefinitionId": param_id,
+            "index": index,
+            "kind": kind,
+            "longName": descriptor.long_name if descriptor is not None else None,
+            "unit": descriptor.unit if descriptor is not None else None,
+            "time": None,
+            "value": json_value(last[1]),
+            "points": len(buf),
+        })
+        last_times.append(last[0])
+    for entry, text in zip(latest, format_times(last_times).tolist()):
+        entry["time"] = text
+    return {
+        "station": station.key,
+        "vendor": vendor,
+        "nodeid": nodeid,
+        "lastSeen": format_time(station.last_seen_ns),
+        "messages": station.n_messages,
+        "observations": station.n_observations,
+        "warnings": station.n_warnings,
+        "quarantined": station.validator.n_quarantined,
+        "metadata": {"version": metadata.version, "hash": metadata.hash} if metadata is not None else None,
+        "latest": latest,
+    }
+
+
+def encode(body):
+    return json.dumps(body, separators=(",", ":")).encode("utf-8")
+
+
+class QueryAPI:
+    """Answers the API requests from the stations of an ingest worker, with JSON bodies or their encoded bytes;
+    summaries are cached encoded, per revision, so that a list of them is only joined."""
+
+    def __init__(self, ingest):
+        self.ingest = ingest
+        self._summaries = {}  # station key -> (revision, encoded summary)
+        self._keys = []  # sorted station keys, stations are never removed
+        self._lock = threading.Lock()
+
+    def sorted_keys(self):
+        stations = self.ingest.stations
+        with self._lock:
+            if len(self._keys) != len(stations):
+                self._keys = sorted(list(stations))
+            return self._keys
+
+    def summary(self, station):
+        """Encoded summary of a station, called with the ingest lock held."""
+        cached = self._summaries.get(station.key)
+        if cached is not None and cached[0] == station.revision:
+            return cached[1]
+        summary = encode(build_summary(station))
+        self._summaries[station.key] = (station.revision, summary)
+        return summary
+
+    def stations(self, query, if_none_match):
+        limit = int_parameter(query, "limit", DEFAULT_STATIONS_LIMIT)
+        after = query.get("cursor")
+        since = parse_time(query["updated_since"]) if "updated_since" in query else None
+        keys = self.sorted_keys()
+        start = bisect.bisect_right(keys, after) if after is not None else 0
+
+        with self.ingest.lock:
+            page = []
+            for key in keys[start:]:
+                station = self.ingest.stations[key]
+                if since is not None and (station.last_seen_ns is None or station.last_seen_ns < since):
+                    continue
+                if len(page) == limit:
+                    break
+                page.append(station)
+            more = len(page) == limit and page[-1].key != keys[-1]
+            tag = etag("stations", sorted(query.items()), [(s.key, s.revision) for s in page], more)
+            if tag == if_none_match:
+                return None, tag
+            summaries = [self.summary(station) for station in page]
+        return (b'{"stations":[' + b",".join(summaries) + b'],"next":' + encode(page[-1].key if more else None)
+                + b"}"), tag
+
+    def station(self, key, if_none_match):
+        with self.ingest.lock:
+            station = self.ingest.stations.get(key)
+            if station is None:
+                raise QueryError(404, f"No station {key}")
+            tag = etag("station", key, station.revision)
+            if tag == if_none_match:
+                return None, tag
+            return self.summary(station), tag
+
+    def metadata(self, key, if_none_match):
+        with self.ingest.lock:
+            station = self.ingest.stations.get(key)
+            index = station.metadata if station is not None else None
+        if index is None:
+            raise QueryError(404, f"No metadata for station {key}")
+        # content hash: the same metadata has the same tag across restarts
+        tag = f'"{index.hash}"'
+        if tag == if_none_match:
+            return None, tag
+        return {"station": key, "version": index.version, "hash": index.hash, "metadata": index.as_dict()}, tag
+
+    def series(self, key, param_id, index, query, if_none_match):
+        kind = query.get("kind")
+        start = parse_time(query["start"]) if "start" in query else None
+        end = parse_time(query["end"]) if "end" in query else None
+        limit = int_parameter(query, "limit", DEFAULT_POINTS_LIMIT)
+        after = parse_cursor(query["cursor"]) if "cursor" in query else None
+        points = int_parameter(query, "points", None) if "points" in query else None
+        method = query.get("method", METHODS[0])
+        if method not in METHODS:
+            raise QueryError(400, f"method must be one of {', '.join(METHODS)}")
+        if points is not None and after is not None:
+            raise QueryError(400, "A decimated series has a single page, points and cursor cannot be combined")
+
+        with self.ingest.lock:
+            station = self.ingest.stations.get(key)
+            if station is None:
+                raise QueryError(404, f"No station {key}")
+            matches = [k for k in station.series.keys() if k[0] == param_id and k[1] == index
+                       and (kind is None or k[2] == kind)]
+            if not matches:
+                raise QueryError(404, f"No series {param_id}/{index} of station {key}")
+            series_key = matches[0]
+            buf = station.series.buffers[series_key]
+            tag = etag("series", key, series_key, buf.total, sorted(query.items()))
+            if tag == if_none_match:
+                return None, tag
+            if points is not None:
+                candidates = select(buf, start, end, points)
+            else:
+                times, values = buf.arrays()
+            total = buf.total
+            descriptor = station.metadata.descriptor(param_id, index) if station.metadata is not None else None
+
+        description = {
+            "station": key,
+            "parameterDefinitionId": param_id,
+            "index": index,
+            "kind": series_key[2],
+            "longName": descriptor.long_name if descriptor is not None else None,
+            "unit": descriptor.unit if descriptor is not None else None,
+        }
+        if points is not None:
+            times, values = reduce(*candidates, points, method)
+            return dict(description, times=format_times(times).tolist(), values=json_values(values), next=None), tag
+
+        # the buffer is in arrival order: select the range, order by time, then page after the cursor
+        seqs = np.arange(total - len(times), total)
+        selected = np.ones(len(times), dtype=bool)
+        if start is not None:
+            selected &= times >= start
+        if end is not None:
+            selected &= times < end
+        if after is not None:
+            selected &= (times > after[0]) | ((times == after[0]) & (seqs > after[1]))
+        times, values, seqs = times[selected], values[selected], seqs[selected]
+        order = np.lexsort((seqs, times))
+        more = len(order) > limit
+        order = order[:limit]
+        times, values, seqs = times[order], values[order], seqs[order]
+        return dict(description, times=format_times(times).tolist(), values=json_values(values),
+                    next=f"{times[-1]}.{seqs[-1]}" if more else None), tag
+
+    def _spatial(self):
+        spatial = getattr(self.ingest, "spatial", None)
+        if spatial is None:
+            raise QueryError(404, "The receiver keeps no spatial index")
+        return spatial
+
+    def map_stations(self, query, if_none_match):
+        bbox = bbox_parameter(query)
+        spatial = self._spatial()
+        with self.ingest.lock:
+            tag = etag("map_stations", spatial.revision, sorted(query.items()))
+            if tag == if_none_match:
+                return None, tag
+            found = spatial.stations(bbox)
+        return {"stations": [{"station": key, "observer": observer, "latitude": latitude, "longitude": longitude,
+                              "height": height}
+                             for key, observer, latitude, longitude, height in found]}, tag
+
+    def map_tracks(self, query, if_none_match):
+        bbox = bbox_parameter(query)
+        start = parse_time(query["start"]) if "start" in query else None
+        end = parse_time(query["end"]) if "end" in query else None
+        points = int_parameter(query, "points", DEFAULT_POINTS_LIMIT)
+        spatial = self._spatial()
+        with self.ingest.lock:
+            tag = etag("map_tracks", spatial.revision, sorted(query.items()))
+            if tag == if_none_match:
+                return None, tag
+            tracks = spatial.points(bbox, start, end)
+        body = []
+        for key in sorted(tracks):
+            times, latitudes, longitudes = tracks[key]
+            n = len(times)
+            if n > points:
+                picked = np.unique(np.linspace(0, n - 1, points).astype(np.int64))
+                times, latitudes, longitudes = times[picked], latitudes[picked], longitudes[picked]
+            body.append({"station": key, "points": n, "times": format_times(times).tolist(),
+                         # about 1 cm, a float32 position cast to float64 would print as -37.650001525878906
+                         "latitudes": np.round(latitudes, 7).tolist(), "longitudes": np.round(longitudes, 7).tolist()})
+        return {"tracks": body}, tag
+
+    def map_tiles(self, zoom, query, if_none_match):
+        if zoom > MAX_ZOOM:
+            raise QueryError(400, f"zoom must be between 0 and {MAX_ZOOM}")
+        bbox = bbox_parameter(query)
+        start = parse_time(query["start"]) if "start" in query else None
+        end = parse_time(query["end"]) if "end" in query else None
+        spatial = self._spatial()
+        with self.ingest.lock:
+            tag = etag("map_tiles", zoom, spatial.revision, sorted(query.items()))
+            if tag == if_none_match:
+                return None, tag
+            counts = spatial.overview(zoom, bbox, start, end)
+        return {"zoom": zoom, "tiles": [{"x": x, "y": y, "stations": n_stations, "points": n_points}
+                                        for (x, y), (n_stations, n_points) in sorted(counts.items())]}, tag
+
+
+def int_parameter(query, name, default):
+    try:
+        value = int(query.get(name, default))
+    except ValueError:
+        raise QueryError(400, f"{name} must be an integer")
+    if not 0 < value <= MAX_LIMIT:
+        raise QueryError(400, f"{name} must be between 1 and {MAX_LIMIT}")
+    return value
+
+
+def bbox_parameter(query):
+    if "bbox" not in query:
+        return None
+    try:
+        return parse_bbox(query["bbox"])
+    except ValueError:
+        raise QueryError(400, f"bbox must be west,south,east,north in degrees: {query['bbox']}")
+
+
+def parse_cursor(value):
+    try:
+        time_ns, seq = value.split(".")
+        return int(time_ns), int(seq)
+    except ValueError:
+        raise QueryError(400, f"Invalid cursor: {value}")
+
+
+class _APIHandler(BaseHTTPRequestHandler):
+    api = None
+
+    def do_GET(self):
+        started = time.perf_counter()
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        # the last value of a repeated parameter wins
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if_none_match = self.headers.get("If-None-Match")
+        endpoint, match = next(((name, pattern.fullmatch(path)) for name, pattern in ROUTES if pattern.fullmatch(path)),
+                               ("unknown", None))
+        try:
+            if match is None:
+                raise QueryError(404, f"Unknown path {path}")
+            if endpoint == "stations":
+                body, tag = self.api.stations(query, if_none_match)
+            elif endpoint == "station":
+                body, tag = self.api.station(match.group(1), if_none_match)
+            elif endpoint == "metadata":
+                body, tag = self.api.metadata(match.group(1), if_none_match)
+            elif endpoint == "map_stations":
+                body, tag = self.api.map_stations(query, if_none_match)
+            elif endpoint == "map_tracks":
+                body, tag = self.api.map_tracks(query, if_none_match)
+            elif endpoint == "map_tiles":
+                body, tag = self.api.map_tiles(int(match.group(1)), query, if_none_match)
+            else:
+                body, tag = self.api.series(match.group(1), int(match.group(2)), int(match.group(3)), query,
+                                            if_none_match)
+        except QueryError as e:
+            status = self.respond(e.status, {"error": str(e)})
+        else:
+            status = self.respond(304 if body is None else 200, body, tag)
+        API_REQUESTS.labels(endpoint, str(status)).inc()
+        API_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+    def respond(self, status, body, tag=None):
+        self.send_response(status)
+        if tag is not None:
+            self.send_header("ETag", tag)
+            # clients may keep the response, but have to revalidate it with If-None-Match
+            self.send_header("Cache-Control", "no-cache")
+        if body is not None:
+            data = body if isinstance(body, bytes) else encode(body)
+            if len(data) >= GZIP_MIN_BYTES and "gzip" in self.headers.get("Accept-Encoding", ""):
+                data = gzip.compress(data, compresslevel=5)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.end_headers()
+        return status
+
+    def log_message(self, format, *args):
+        pass  # a line per poll would drown the receiver's own output
+
+
+def start_api_server(ingest, port, host="0.0.0.0"):
+    """Serve the query API of an ingest worker on http://host:port/api/ from a daemon thread."""
+    handler = type("APIHandler", (_APIHandler,), {"api": QueryAPI(ingest)})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="query-api-http", daemon=True).start()
+    return server
@@ -0,0 +1,329 @@
+# Reorder, deduplication and pending-metadata buffer of the receiver
+#
+# Between validation and the series store every station has a buffer (StationBuffer) that turns what the node sent
+# into a clean stream of observations:
+#
+#   pending metadata  Data received before the station's first Metadata (standard/tests/resilience/
+#                     misaligned_metadata) is held as received and applied when the Metadata arrives, instead of
+#                     being stored without one
+#   deduplication     observations already accepted, by (parameterDefinitionId, time), are dropped: QoS 1
+#                     redeliveries, data re-sent after a reconnection. The accepted times are kept per definition
+#                     in a sorted array('q'), 8 bytes per observation, exact, appended to in place as time goes on
+#                     and expired by slicing, for at least dedup_horizon seconds of observation time
+#   reordering        with window > 0, accepted points are held until the station's watermark (its latest
+#                     observation time minus the window) passes them and are then stored in time order. Points not
+#                     after what was already stored for their definition are late and are not stored. A station
+#                     that has sent nothing for the window (of receive time) is flushed
+#
+# Only the ring buffers of series_store.py are reordered; the Parquet export gets every accepted observation once,
+# when it is received, and the archive every payload.
+# Receive time is the received_ns of the messages, the archived one when restoring, so a restore behaves as the
+# live ingest did.
+#
+# The buffers of all stations share max_bytes, and each is limited to max_station_bytes (pending messages count
+# with their serialized size, held points and accepted times with their array size). Over a limit the station
+# (for the global limit, the largest one) is evicted from: its oldest pending messages are dropped first, then its
+# held points are stored early, then the older half of its accepted times is forgotten.
+
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+
+import numpy as np
+
+from metrics import REGISTRY
+from series_store import VALUE_DTYPES
+
+NS_PER_SECOND = 1_000_000_000
+DEFAULT_DEDUP_HORIZON = 3600.0
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_STATION_BYTES = 16 * 1024 * 1024
+IDLE_CHECK_NS = NS_PER_SECOND  # stations with held points are checked for idleness at most this often
+
+PendingMessage = namedtuple("PendingMessage", ["topic", "data", "received_ns", "nbytes"])
+
+DUPLICATES = REGISTRY.counter("firstmile_duplicate_observations_total", "Observations dropped as already accepted")
+LATE = REGISTRY.counter("firstmile_late_observations_total", "Observations received too late to be stored in order")
+PENDING = REGISTRY.counter("firstmile_pending_messages_total", "Data messages held until their station's Metadata")
+EVICTIONS = REGISTRY.counter("firstmile_buffer_evictions_total", "Buffer evictions over the memory limits", ["what"])
+BUFFER_BYTES = REGISTRY.gauge("firstmile_buffer_bytes", "Memory of the pending, reorder and dedup buffers")
+
+
+def add_times(known, times):
+    """Add the increasing times of a series to the sorted array('q') of the accepted times of its definition."""
+    if not known or times[0] > known[-1]:
+        known.extend(times)
+        return
+    missing = [t for t in times if not contains(known, t)]
+    if not missing:
+        return
+    if missing[0] > known[-1]:
+        known.extend(missing)
+        return
+    merged = np.concatenate([np.frombuffer(known, dtype=np.int64), np.asarray(missing, dtype=np.int64)])
+    merged.sort(kind="mergesort")
+    del known[:]
+    known.frombytes(merged.tobytes())
+
+
+def contains(known, t):
+    i = bisect_left(known, t)
+    return i < len(known) and known[i] == t
+
+
+class StationBuffer:
+    """Pending messages, accepted times and held points of one station."""
+
+    def __init__(self, key):
+        self.key = key
+        self.pending = deque()  # PendingMessage, oldest first
+        self.pending_bytes = 0
+        self.seen = {}  # parameterDefinitionId -> sorted array('q') of accepted observation times
+        self.held = {}  # series key -> [(times, values)] waiting for the watermark
+        self.latest = None  # latest accepted observation time
+        self.stored = {}  # parameterDefinitionId -> latest time stored (with reordering)
+        self.last_received = None  # receive time of the last accepted message
+        self.nbytes = 0
+        self.n_duplicates = 0
+        self.n_late = 0
+        self.n_evicted = 0
+
+    def measure(self):
+        return (self.pending_bytes + 8 * sum(map(len, self.seen.values()))
+                + sum(times.nbytes + values.nbytes for chunks in self.held.values() for times, values in chunks))
+
+
+class ReorderBuffers:
+    """StationBuffer of every station under common memory limits; see the top of this file.
+
+    Points ready to be stored are collected in `ready` as (station key, columns), in order, for the ingest
+    worker to append to the station's series."""
+
+    def __init__(self, stats=None, window=0.0, dedup_horizon=DEFAULT_DEDUP_HORIZON, max_bytes=DEFAULT_MAX_BYTES,
+                 max_station_bytes=DEFAULT_MAX_STATION_BYTES):
+        self.stats = stats  # optional ingest.IngestStats, counts duplicates, late and evicted
+        self.window_ns = int(window * NS_PER_SECOND)
+        self.horizon_ns = int(dedup_horizon * NS_PER_SECOND)
+        self.max_bytes = max_bytes
+        self.max_station_bytes = max_station_bytes
+        self.stations = {}
+        self.holding = set()  # keys of the stations with held points
+        self.ready = []
+        self.nbytes = 0
+        self._idle_checked = None
+
+    def station(self, key):
+        buf = self.stations.get(key)
+        if buf is None:
+            buf = self.stations[key] = StationBuffer(key)
+        return buf
+
+    def _count(self, name, amount=1):
+        if self.stats is not None:
+            setattr(self.stats, name, getattr(self.stats, name) + amount)
+
+    def _account(self, buf):
+        nbytes = buf.measure()
+        self.nbytes += nbytes - buf.nbytes
+        buf.nbytes = nbytes
+        while buf.nbytes > self.max_station_bytes and self._evict(buf):
+            pass
+        while self.nbytes > self.max_bytes:
+            if not self._evict(max(self.stations.values(), key=lambda b: b.nbytes)):
+                break
+        BUFFER_BYTES.set(self.nbytes)
+
+    def _evict(self, buf):
+        """Free some memory of a station; returns False if it holds nothing that can be freed."""
+        if buf.pending:
+            dropped = buf.pending.popleft()
+            buf.pending_bytes -= dropped.nbytes
+            buf.n_evicted += 1
+            self._count("evicted")
+            EVICTIONS.labels("pending").inc()
+        elif buf.held:
+            self._emit(buf, None)
+            EVICTIONS.labels("held").inc()
+        else:
+            param_id = max(buf.seen, key=lambda p: len(buf.seen[p]), default=None)
+            if param_id is None or not buf.seen[param_id]:
+                return False
+            known = buf.seen[param_id]
+            del known[:max(1, len(known) // 2)]
+            EVICTIONS.labels("accepted_times").inc()
+        nbytes = buf.measure()
+        self.nbytes += nbytes - buf.nbytes
+        buf.nbytes = nbytes
+        return True
+
+    def hold_pending(self, key, topic, data, received_ns):
+        """Keep a Data message of a station without Metadata; returns True for the first of a run."""
+        buf = self.station(key)
+        first = not buf.pending
+        message = PendingMessage(topic, data, received_ns, data.ByteSize())
+        buf.pending.append(message)
+        buf.pending_bytes += message.nbytes
+        PENDING.inc()
+        self._account(buf)
+        return first
+
+    def release_pending(self, key):
+        """Pending messages of a station, in the order received, removed to be applied against its Metadata."""
+        buf = self.stations.get(key)
+        if buf is None or not buf.pending:
+            return []
+        pending = list(buf.pending)
+        buf.pending.clear()
+        buf.pending_bytes = 0
+        self._account(buf)
+        return pending
+
+    def n_pending(self, key):
+        buf = self.stations.get(key)
+        return len(buf.pending) if buf is not None else 0
+
+    def deduplicate(self, key, columns):
+        """Decoded columns without the observations already accepted, and the number of those observations."""
+        buf = self.stations.get(key)
+        if buf is None or not buf.seen:
+            return columns, 0
+        seen = buf.seen
+        result = {}
+        duplicates = {}
+        last_id = last_times = None
+        for series_key, (times, values) in columns.items():
+            param_id = series_key[0]
+            # the series of a definition follow each other and mostly have the same times
+            if param_id != last_id or times != last_times:
+                last_id, last_times = param_id, times
+                kept = None
+                known = seen.get(param_id)
+                # the times of a valid message increase (non_monotonic is an error), the first is the smallest
+                if known and times[0] <= known[-1]:
+                    times_ns = np.asarray(times, dtype=np.int64)
+                    known = np.frombuffer(known, dtype=np.int64)
+                    found = known[np.minimum(np.searchsorted(known, times_ns), len(known) - 1)] == times_ns
+                    n = int(found.sum())
+                    if n:
+                        # an observation is a point in each series of its definition, counted once
+                        duplicates.setdefault(param_id, set()).update(times_ns[found].tolist())
+                        kept = (~found).tolist()
+            if kept is None:
+                result[series_key] = (times, values)
+            elif n < len(times):
+                result[series_key] = ([t for t, k in zip(times, kept) if k], [v for v, k in zip(values, kept) if k])
+        if not duplicates:
+            return columns, 0
+        n = sum(map(len, duplicates.values()))
+        buf.n_duplicates += n
+        self._count("duplicates", n)
+        DUPLICATES.inc(n)
+        return result, n
+
+    def accept(self, key, columns, received_ns=None):
+        """Record validated columns; their points, and the held points they release, are appended to ready."""
+        buf = self.station(key)
+        horizon = self.horizon_ns
+        seen = buf.seen
+        last_id = last_times = None
+        for (param_id, _, _), (times, _) in columns.items():
+            # the series of a definition follow each other and mostly have the same times
+            if param_id == last_id and times == last_times:
+                continue
+            last_id, last_times = param_id, times
+            known = seen.get(param_id)
+            if known is None:
+                known = seen[param_id] = array("q")
+            add_times(known, times)
+        for known in seen.values():
+            newest = known[-1] if known else None
+            if newest is None:
+                continue
+            if newest - known[0] > 2 * horizon:
+                # expired in bulk, at most twice the horizon is kept
+                del known[:bisect_left(known, newest - horizon)]
+            if buf.latest is None or newest > buf.latest:
+                buf.latest = newest
+        if received_ns is not None:
+            buf.last_received = received_ns
+
+        if not self.window_ns:
+            self.ready.append((key, columns))
+            self._account(buf)
+            return
+
+        late = {}
+        for series_key, (times, values) in columns.items():
+            param_id = series_key[0]
+            times = np.asarray(times, dtype=np.int64)
+            values = np.asarray(values, dtype=VALUE_DTYPES[series_key[2]])
+            stored = buf.stored.get(param_id)
+            if stored is not None and times.min() <= stored:
+                on_time = times > stored
+                late.setdefault(param_id, set()).update(times[~on_time].tolist())
+                times, values = times[on_time], values[on_time]
+                if not len(times):
+                    continue
+            buf.held.setdefault(series_key, []).append((times, values))
+        n_late = sum(map(len, late.values()))
+        if n_late:
+            buf.n_late += n_late
+            self._count("late", n_late)
+            LATE.inc(n_late)
+        if buf.held:
+            self.holding.add(key)
+            self._emit(buf, buf.latest - self.window_ns)
+        self._account(buf)
+        if received_ns is not None:
+            self.flush_idle(received_ns)
+
+    def _emit(self, buf, watermark):
+        """Move the held points up to the watermark (all with None) to ready, in time order per series."""
+        columns = {}
+        for series_key, chunks in list(buf.held.items()):
+            if len(chunks) == 1:
+                times, values = chunks[0]
+            else:
+                times = np.concatenate([c[0] for c in chunks])
+                values = np.concatenate([c[1] for c in chunks])
+            order = np.argsort(times, kind="stable")
+            times, values = times[order], values[order]
+            cut = len(times) if watermark is None else int(np.searchsorted(times, watermark, side="right"))
+            if cut:
+                columns[series_key] = (times[:cut], values[:cut])
+                param_id, last = series_key[0], int(times[cut - 1])
+                if last > buf.stored.get(param_id, last - 1):
+                    buf.stored[param_id] = last
+            if cut < len(times):
+                buf.held[series_key] = [(times[cut:], values[cut:])]
+            else:
+                del buf.held[series_key]
+        if columns:
+            self.ready.append((buf.key, columns))
+        if not buf.held:
+            self.holding.discard(buf.key)
+
+    def flush(self, key):
+        """Move all held points of a station to ready, e.g. before its Metadata changes."""
+        buf = self.stations.get(key)
+        if buf is not None and buf.held:
+            self._emit(buf, None)
+            self._account(buf)
+
+    def flush_idle(self, now_ns):
+        """Flush the stations that have not sent anything for the window."""
+        if not self.holding or (self._idle_checked is not None and now_ns - self._idle_checked < IDLE_CHECK_NS):
+            return
+        self._idle_checked = now_ns
+        for key in list(self.holding):
+            buf = self.stations[key]
+            if buf.last_received is None or now_ns - buf.last_received >= self.window_ns:
+                self.flush(key)
+
+    def flush_all(self):
+        for key in list(self.holding):
+            self.flush(key)
+
+    def take_ready(self):
+        ready, self.ready = self.ready, []
+        return ready
@@ -0,0 +1,37 @@
+# Schema bindings: the JSON files that describe a node's Metadata
+#
+# A binding directory, as standard/examples/example_schema_binding, holds:
+#   node.json         the Node
+#   observer.json     {"bindings": [ObserverDevice, ...]}            (optional)
+#   parameters.json   {"bindings": [ParameterDefinition, ...]}
+#   namespaces.json   {"bindings": [{"key": ..., "value": ...}, ...]} (optional)
+
+import json
+import os
+
+from google.protobuf.json_format import Parse, ParseDict
+from protospy import firstmile_pb2 as pb2
+
+DEFAULT_BINDING = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "../../standard/examples/example_schema_binding")
+
+
+def read_bindings(path, schema):
+    """Protobuf messages of a {"bindings": [...]} file, none if the file does not exist."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [ParseDict(binding, schema()) for binding in json.load(f)["bindings"]]
+
+
+def load_metadata(directory=DEFAULT_BINDING):
+    """pb2.Metadata of a binding directory."""
+    metadata = pb2.Metadata()
+    with open(os.path.join(directory, "node.json"), "r", encoding="utf-8") as f:
+        Parse(f.read(), metadata.node)
+    metadata.observers.extend(read_bindings(os.path.join(directory, "observer.json"), pb2.ObserverDevice))
+    metadata.parameterDefinitions.extend(read_bindings(os.path.join(directory, "parameters.json"),
+                                                       pb2.ParameterDefinition))
+    metadata.namespaces.update({ns.key: ns.value for ns in read_bindings(os.path.join(directory, "namespaces.json"),
+                                                                         pb2.Metadata.NamespacesEntry)})
+    return metadata
@@ -0,0 +1,266 @@
+# Columnar observation storage for the receiver
+#
+# Every station keeps one ring buffer per series, a series being identified by
+# (parameterDefinitionId, value index, Value kind). A ring buffer holds two NumPy arrays, epoch nanosecond
+# timestamps and values in the native dtype of the Value kind, so a stored point costs 12-16 bytes instead
+# of a dict per observation. Appends are O(1): the arrays grow geometrically up to the configured capacity,
+# after which the oldest points are overwritten in place.
+# Points are tagged with the metadata version in force when they were received. Versions change rarely, so
+# the tags are kept run-length encoded, (first sequence number, version), rather than as a third array.
+# Numeric series also keep a min/max pyramid for plotting (Summaries): level k has a bucket per
+# SUMMARY_FACTOR**(k + 1) consecutive points, with their time span and the times and values of their minimum and
+# maximum. Buckets are summarised SUMMARY_BATCH at a time as the points arrive, in one vectorised step, into ring
+# buffers that cover the points stored; decimation.py picks the level that matches the width of a plot.
+
+import numpy as np
+
+# NumPy dtype used to store each Value kind of the oneof
+VALUE_DTYPES = {
+    "floatValue": np.float32,
+    "doubleValue": np.float64,
+    "intValue": np.int32,
+    "unsignedIntValue": np.uint32,
+    "int64Value": np.int64,
+    "unsignedInt64Value": np.uint64,
+    "stringValue": object,
+    "boolValue": np.bool_,
+    "emptyValue": np.float64,  # stored as NaN, the point only marks that an observation was made
+}
+
+DEFAULT_CAPACITY = 100000
+INITIAL_SIZE = 256
+
+SUMMARY_FACTOR = 16
+SUMMARY_BATCH = 1024
+NEVER = 2**63
+SUMMARY_DTYPE = np.dtype([("tmax", np.int64), ("t_low", np.int64), ("low", np.float64), ("t_high", np.int64),
+                          ("high", np.float64)])
+UNSUMMARISED_KINDS = ("stringValue", "emptyValue")
+
+
+class RingBuffer:
+    """Fixed-capacity time/value buffer with O(1) append."""
+
+    __slots__ = ("capacity", "times", "values", "total", "runs", "summaries", "summarise_at")
+
+    def __init__(self, dtype, capacity=DEFAULT_CAPACITY, summarise=False):
+        self.capacity = capacity
+        size = min(capacity, INITIAL_SIZE)
+        self.times = np.empty(size, dtype=np.int64)
+        self.values = np.empty(size, dtype=dtype)
+        # number of points ever appended, also serves as a sequence number for incremental readers
+        self.total = 0
+        self.runs = []
+        # buffers smaller than a batch (a small --max-obs, the headless sharded parent's) are not summarised,
+        # decimating their raw points is cheap enough
+        self.summaries = Summaries(capacity) if summarise and capacity >= SUMMARY_FACTOR * SUMMARY_BATCH else None
+        # number of points at which the next batch is complete, a single comparison on the append path
+        self.summarise_at = SUMMARY_FACTOR * SUMMARY_BATCH if self.summaries is not None else NEVER
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def _grow(self):
+        size = min(self.capacity, len(self.times) * 2)
+        self.times = np.resize(self.times, size)
+        self.values = np.resize(self.values, size)
+
+    def _tag(self, version):
+        if not self.runs or self.runs[-1][1] != version:
+            self.runs.append((self.total, version))
+            # forget runs whose points have all been overwritten
+            oldest = self.total - self.capacity
+            while len(self.runs) > 1 and self.runs[1][0] <= oldest:
+                self.runs.pop(0)
+
+    def append(self, time_ns, value, version=0):
+        self._tag(version)
+        if self.total < self.capacity:
+            if self.total == len(self.times):
+                self._grow()
+            i = self.total
+        else:
+            i = self.total % self.capacity
+        self.times[i] = time_ns
+        self.values[i] = value
+        self.total += 1
+        if self.total >= self.summarise_at:
+            self.summarise_at = self.summaries.update(self)
+
+    def extend(self, times, values, version=0):
+        n = len(times)
+        if n > self.capacity:
+            times, values = times[-self.capacity:], values[-self.capacity:]
+            self.total += n - self.capacity
+            n = self.capacity
+        self._tag(version)
+        while len(self.times) < self.capacity and self.total + n > len(self.times):
+            self._grow()
+        start = self.total % self.capacity if self.total >= self.capacity else self.total
+        first = min(n, len(self.times) - start)
+        self.times[start:start + first] = times[:first]
+        self.values[start:start + first] = values[:first]
+        if first < n:
+            self.times[:n - first] = times[first:]
+            self.values[:n - first] = values[first:]
+        self.total += n
+        if self.total >= self.summarise_at:
+            self.summarise_at = self.summaries.update(self)
+
+    def _order(self, count):
+        """Physical indices of the newest `count` points in chronological order."""
+        if self.total <= self.capacity:
+            return slice(self.total - count, self.total)
+        end = self.total % self.capacity
+        return np.arange(end - count, end) % self.capacity
+
+    def arrays(self):
+        """Copies of the stored (times, values) in arrival order."""
+        idx = self._order(len(self))
+        return self.times[idx].copy(), self.values[idx].copy()
+
+    def versions(self):
+        """Metadata version of each stored point, aligned with arrays()."""
+        if not self.runs:
+            return np.zeros(0, dtype=np.uint32)
+        seqs = np.arange(self.total - len(self), self.total)
+        starts = np.array([r[0] for r in self.runs])
+        tags = np.array([r[1] for r in self.runs], dtype=np.uint32)
+        return tags[np.maximum(np.searchsorted(starts, seqs, side="right") - 1, 0)]
+
+    def between(self, first, stop):
+        """Copies of the points with sequence numbers in [first, stop) that are still stored."""
+        first = max(first, self.total - len(self))
+        stop = min(stop, self.total)
+        if stop <= first:
+            return self.times[:0].copy(), self.values[:0].copy()
+        # at most two slices, cheaper than indexing with an arange modulo the capacity
+        i = first % self.capacity if self.total > self.capacity else first
+        j = i + stop - first
+        if j <= len(self.times):
+            return self.times[i:j].copy(), self.values[i:j].copy()
+        j -= self.capacity
+        return (np.concatenate((self.times[i:], self.times[:j])),
+                np.concatenate((self.values[i:], self.values[:j])))
+
+    def since(self, seq):
+        """Points appended after sequence number `seq` (capped to what is still stored) and the new sequence."""
+        count = min(self.total - seq, len(self)) if seq < self.total else 0
+        idx = self._order(count)
+        return self.times[idx].copy(), self.values[idx].copy(), self.total
+
+    def last(self):
+        if not self.total:
+            return None
+        i = (self.total - 1) % self.capacity
+        return int(self.times[i]), self.values[i]
+
+    @property
+    def nbytes(self):
+        summaries = self.summaries.nbytes if self.summaries is not None else 0
+        return self.times.nbytes + self.values.nbytes + summaries
+
+
+def summarise(tmin, tmax, t_low, low, t_high, high):
+    """(bucket tmin, SUMMARY_DTYPE buckets) of rows of SUMMARY_FACTOR items; NaN values are left out."""
+    rows = np.arange(len(tmin))
+    i_low = np.where(np.isnan(low), np.inf, low).argmin(axis=1)
+    i_high = np.where(np.isnan(high), -np.inf, high).argmax(axis=1)
+    buckets = np.empty(len(tmin), dtype=SUMMARY_DTYPE)
+    buckets["tmax"] = tmax.max(axis=1)
+    buckets["t_low"] = t_low[rows, i_low]
+    buckets["low"] = low[rows, i_low]
+    buckets["t_high"] = t_high[rows, i_high]
+    buckets["high"] = high[rows, i_high]
+    return tmin.min(axis=1), buckets
+
+
+class Summaries:
+    """Min/max pyramid of the points of a RingBuffer, see the top of this file.
+
+    Bucket j of level k covers the points with sequence numbers [j * spans[k], (j + 1) * spans[k]); the levels
+    are RingBuffers of SUMMARY_DTYPE buckets with the earliest time of each bucket as its time."""
+
+    __slots__ = ("levels", "spans")
+
+    def __init__(self, capacity):
+        self.levels = []
+        self.spans = []
+        span = SUMMARY_FACTOR
+        while capacity // span >= SUMMARY_FACTOR:
+            self.levels.append(RingBuffer(SUMMARY_DTYPE, capacity // span + 2))
+            self.spans.append(span)
+            span *= SUMMARY_FACTOR
+
+    def update(self, buf):
+        """Summarise the complete buckets of every level, returns the number of points of the next batch."""
+        source = buf
+        for level in self.levels:
+            first = level.total * SUMMARY_FACTOR
+            oldest = source.total - len(source)
+            if first < oldest:
+                # the source was overwritten before it was summarised (an extend larger than the buffer): the
+                # buckets of the lost items are left empty
+                missing = -(-(oldest - first) // SUMMARY_FACTOR)
+                empty = np.zeros(min(missing, level.capacity), dtype=SUMMARY_DTYPE)
+                empty["low"] = empty["high"] = np.nan
+                if missing > level.capacity:
+                    level.total += missing - level.capacity
+                level.extend(np.zeros(len(empty), dtype=np.int64), empty)
+                first = level.total * SUMMARY_FACTOR
+            n = (source.total - first) // SUMMARY_FACTOR
+            if not n:
+                break
+            times, values = source.between(first, first + n * SUMMARY_FACTOR)
+            times = times.reshape(n, SUMMARY_FACTOR)
+            if source is buf:
+                values = values.astype(np.float64).reshape(n, SUMMARY_FACTOR)
+                tmin, buckets = summarise(times, times, times, values, times, values)
+            else:
+                values = values.reshape(n, SUMMARY_FACTOR)
+                tmin, buckets = summarise(times, values["tmax"], values["t_low"], values["low"], values["t_high"],
+                                          values["high"])
+            level.extend(tmin, buckets)
+            source = level
+        return (self.levels[0].total + SUMMARY_BATCH) * SUMMARY_FACTOR
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+
+class StationSeries:
+    """All series of one station, keyed by (parameterDefinitionId, value index, Value kind)."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.buffers = {}
+
+    def buffer(self, key):
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = self.buffers[key] = RingBuffer(VALUE_DTYPES[key[2]], self.capacity,
+                                                 summarise=key[2] not in UNSUMMARISED_KINDS)
+        return buf
+
+    def append(self, parameter_definition_id, index, kind, time_ns, value, version=0):
+        self.buffer((parameter_definition_id, index, kind)).append(time_ns, value, version)
+
+    def extend(self, columns, version=0):
+        """Append decoded columns, {series key: (times_ns, values)}, one vectorised copy per series."""
+        for key, (times, values) in columns.items():
+            buf = self.buffer(key)
+            if len(times) == 1:
+                buf.append(times[0], values[0], version)
+            else:
+                buf.extend(np.asarray(times, dtype=np.int64), np.asarray(values, dtype=buf.values.dtype), version)
+
+    def keys(self):
+        return sorted(self.buffers)
+
+    def __len__(self):
+        return sum(len(buf) for buf in self.buffers.values())
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for buf in self.buffers.values())
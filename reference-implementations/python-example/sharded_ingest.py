@@ -0,0 +1,363 @@
+# Multi-process ingest for the receiver
+#
+# Parsing and decoding protobuf payloads is CPU-bound and, in one process, limited to one core by the GIL.
+# ShardedIngest spreads it over N worker processes: stations are hash-partitioned on their vendor/nodeid key
+# (crc32 % N), so every station is always handled by the same worker and its messages stay in order.
+#
+#   MQTT thread --submit()--> per-shard batches of raw payloads --> worker process: IngestWorker.process()
+#                                                                      (decompress, parse, decode, archive)
+#   UI <-- stations (parent mirror) <-- apply thread <-- periodic station deltas --+
+#
+# Every worker owns the full state of its stations in an ordinary IngestWorker. The parent only dispatches raw
+# payloads and keeps a mirror of the station state for the UI, refreshed from deltas the workers send every
+# SYNC_INTERVAL seconds while they have new data (or on drain()): metadata changes, counters, new warnings and,
+# per series, the points appended since the previous delta, packed into one NumPy array per dtype. The cost in the
+# parent therefore grows with the number of stations and the sync rate, not with the message rate, and the
+# Dash pages read `stations`/`lock` exactly as with the single-process IngestWorker.
+# The mirror keeps a second copy of the series in the parent; headless (mirror=False), the workers only send the
+# newest point of every series, which the parent keeps for the query API (query_api.py). With an archive, every worker writes its own
+# archive in a shard-NN subdirectory (and restores from it with --restore); Parquet exports of all workers go
+# to the same dataset, in files named after the shard.
+# The spatial index (spatial_index.py) is kept by the parent only, from the mirrored metadata and points; headless,
+# the tracks therefore only have the newest position of every delta.
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from ingest import ERRORS, IngestStats, IngestWorker, Station, count_received, parse_topic
+from metadata_index import MetadataIndex
+from metrics import REGISTRY
+from protospy import firstmile_pb2 as pb2
+from series_store import DEFAULT_CAPACITY
+from spatial_index import SpatialIndex
+
+BATCH_SIZE = 64        # messages per hand-over to a worker
+FLUSH_INTERVAL = 0.01  # seconds a partial batch may wait in the parent
+SYNC_INTERVAL = 0.2    # seconds between two deltas of a worker
+SYNC = "sync"          # inbox marker asking for a delta right away
+WORKER_STATS = ("processed", "parse_errors", "unknown_topics", "compressed", "done")
+
+
+def shard_of(key, shards):
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def shard_archive_dir(directory, shard):
+    return os.path.join(directory, f"shard-{shard:02d}")
+
+
+def series_chunks(buf, seq):
+    """Points appended to a RingBuffer after sequence number seq, as [(times, values, version)] views."""
+    count = min(buf.total - seq, len(buf))
+    idx = buf._order(count)
+    times, values = buf.times[idx], buf.values[idx]
+    first = buf.total - count
+    chunks = []
+    for i, (start, version) in enumerate(buf.runs):
+        end = buf.runs[i + 1][0] if i + 1 < len(buf.runs) else buf.total
+        start = max(start, first)
+        if start < end:
+            chunks.append((times[start - first:end - first], values[start - first:end - first], version))
+    return chunks
+
+
+class StationDeltas:
+    """Worker side: tracks what the parent has already been sent for each station."""
+
+    def __init__(self, worker, latest_only=False):
+        self.worker = worker
+        self.latest_only = latest_only  # only send the newest point of every series
+        self.dirty = set()
+        self.cursors = {}  # (station key, series key) -> sequence number sent
+        self.sent = {}  # station key -> (metadata version, n_warnings) sent
+
+    def collect(self):
+        """(station deltas, points): the points of all series are packed into one array per dtype, as pickling
+        thousands of small NumPy arrays would cost more than the ingest itself."""
+        deltas = []
+        entries = []  # (station key, series key, version, number of points)
+        times, values = [], {}
+        with self.worker.lock:
+            for key in self.dirty:
+                station = self.worker.stations.get(key)
+                if station is None:
+                    continue
+                version, n_warnings = self.sent.get(key, (0, 0))
+                metadata = station.metadata
+                deltas.append({
+                    "key": key,
+                    "metadata": (metadata.version, metadata.hash, metadata.message.SerializeToString())
+                    if metadata is not None and metadata.version != version else None,
+                    "warnings": list(station.warnings)[-min(station.n_warnings - n_warnings, len(station.warnings)):]
+                    if station.n_warnings > n_warnings else [],
+                    "counters": (station.n_warnings, station.n_messages, station.n_observations, station.last_seen_ns),
+                    "validation": (station.validator.n_quarantined, dict(station.validator.counts)),
+                })
+                for series_key, buf in station.series.buffers.items():
+                    cursor = (key, series_key)
+                    seq = self.cursors.get(cursor, 0)
+                    if self.latest_only:
+                        seq = max(seq, buf.total - 1)
+                    if buf.total == seq:
+                        continue
+                    for chunk_times, chunk_values, chunk_version in series_chunks(buf, seq):
+                        entries.append((key, series_key, chunk_version, len(chunk_times)))
+                        times.append(chunk_times)
+                        values.setdefault(series_key[2], []).append(chunk_values)
+                    self.cursors[cursor] = buf.total
+                self.sent[key] = (metadata.version if metadata is not None else 0, station.n_warnings)
+        self.dirty.clear()
+        points = (entries, np.concatenate(times) if times else None,
+                  {kind: np.concatenate(arrays) for kind, arrays in values.items()})
+        return deltas, points
+
+
+def shard_main(shard, inbox, results, capacity, decoder, zstd_dicts, archive_dir, archive_options, restore,
+               export_dir, export_options, strict_order, buffer_options, mirror):
+    """Worker process: applies the payloads of its stations to an IngestWorker and sends deltas to the parent."""
+    from archive import ArchiveReader, ArchiveWriter
+    from compression import Decompressor, load_dictionary
+
+    # the worker's metrics reach the parent's /metrics through the deltas
+    REGISTRY.reset()
+    worker = IngestWorker(capacity=capacity, decoder=decoder, strict_order=strict_order, buffer_options=buffer_options,
+                          decompressor=Decompressor([load_dictionary(path) for path in zstd_dicts]), spatial=False)
+    deltas = StationDeltas(worker, latest_only=not mirror)
+    done = 0
+
+    def sync(kind="sync"):
+        stats = worker.stats.as_dict()
+        stats.update(compressed=worker.compressed(), done=done)
+        results.put((kind, shard, stats, deltas.collect(), REGISTRY.snapshot()))
+
+    if archive_dir:
+        directory = shard_archive_dir(archive_dir, shard)
+        if restore and os.path.isdir(directory):
+            worker.restore(ArchiveReader(directory))
+            deltas.dirty.update(worker.stations)
+        worker.archive = ArchiveWriter(directory, **archive_options)
+    if export_dir:
+        from parquet_export import ParquetExporter
+        worker.exporter = ParquetExporter(export_dir, name=f"s{shard:02d}-{time.time_ns():x}", **export_options)
+    sync()
+
+    last_sync = time.monotonic()
+    while True:
+        try:
+            batch = inbox.get(timeout=SYNC_INTERVAL)
+        except queue.Empty:
+            batch = []
+            deltas.dirty.update(worker.flush_idle())
+            if worker.archive is not None:
+                worker.archive.sync_if_due()
+            if worker.exporter is not None:
+                worker.exporter.flush_if_due()
+        if batch is None:
+            break
+        for key, topic, payload, received_ns in batch if batch != SYNC else []:
+            worker.process(topic, payload, received_ns)
+            deltas.dirty.add(key)
+        done += len(batch) if batch != SYNC else 0
+        if batch == SYNC or (deltas.dirty and time.monotonic() - last_sync >= SYNC_INTERVAL):
+            sync()
+            last_sync = time.monotonic()
+
+    deltas.dirty.update(worker.flush())
+    if worker.archive is not None:
+        worker.archive.close()
+    if worker.exporter is not None:
+        worker.exporter.close()
+    sync("stopped")
+
+
+class ShardedIngest:
+    """Same interface as ingest.IngestWorker towards the MQTT callback and the UI, with N worker processes."""
+
+    def __init__(self, shards, max_queue=10000, put_timeout=1.0, capacity=DEFAULT_CAPACITY, decoder="fast",
+                 zstd_dicts=(), archive_dir=None, archive_options=None, restore=False, export_dir=None,
+                 export_options=None, strict_order=False, buffer_options=None, mirror=True):
+        self.shards = shards
+        # without mirror, the parent only keeps the newest point of every series
+        self.capacity = capacity if mirror else 1
+        self.put_timeout = put_timeout
+        self.stats = IngestStats()
+        self.timings = None
+        self.stations = {}  # mirror of the workers' stations, read by the UI; without series unless mirror
+        self.spatial = SpatialIndex(self.capacity)
+        self.lock = threading.Lock()
+
+        # fork: the workers only need the modules already imported, not a fresh interpreter running the UI script
+        context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        self._results = context.Queue()
+        self._inboxes = [context.Queue(maxsize=max(1, max_queue // BATCH_SIZE)) for _ in range(shards)]
+        self._processes = [
+            context.Process(target=shard_main, name=f"ingest-shard-{i}", daemon=True,
+                            args=(i, self._inboxes[i], self._results, capacity, decoder, list(zstd_dicts),
+                                  archive_dir, archive_options or {}, restore, export_dir, export_options or {},
+                                  strict_order, buffer_options or {}, mirror))
+            for i in range(shards)
+        ]
+        self._batches = [[] for _ in range(shards)]
+        self._batch_started = [0.0] * shards
+        self._submit_lock = threading.Lock()
+        self._shard_stats = {}
+        self._submitted = 0
+        self._done = threading.Condition()
+        self._running = False
+        self._apply_thread = threading.Thread(target=self._apply_deltas, name="ingest-apply", daemon=True)
+        self._flush_thread = threading.Thread(target=self._flush_periodically, name="ingest-flush", daemon=True)
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._running = True
+        self._apply_thread.start()
+        self._flush_thread.start()
+
+    def submit(self, topic, payload):
+        """Called from the MQTT network thread; returns False if the message had to be dropped."""
+        self.stats.received += 1
+        count_received(topic, payload)
+        parsed = parse_topic(topic)
+        # messages on unknown topics go to shard 0, which counts them
+        shard = shard_of(parsed[3], self.shards) if parsed is not None else 0
+        with self._submit_lock:
+            batch = self._batches[shard]
+            if not batch:
+                self._batch_started[shard] = time.monotonic()
+            batch.append((parsed[3] if parsed is not None else None, topic, payload, time.time_ns()))
+            if len(batch) < BATCH_SIZE:
+                return True
+            return self._flush(shard)
+
+    def _flush(self, shard):
+        batch = self._batches[shard]
+        self._batches[shard] = []
+        try:
+            self._inboxes[shard].put(batch, timeout=self.put_timeout)
+        except queue.Full:
+            self.stats.dropped += len(batch)
+            ERRORS.labels("dropped").inc(len(batch))
+            return False
+        with self._done:
+            self._submitted += len(batch)
+        return True
+
+    def _flush_periodically(self):
+        while self._running:
+            time.sleep(FLUSH_INTERVAL)
+            with self._submit_lock:
+                now = time.monotonic()
+                for shard, batch in enumerate(self._batches):
+                    if batch and now - self._batch_started[shard] >= FLUSH_INTERVAL:
+                        self._flush(shard)
+
+    def _apply_deltas(self):
+        stopped = 0
+        while stopped < self.shards:
+            kind, shard, stats, (deltas, points), metrics = self._results.get()
+            REGISTRY.merge(f"shard-{shard}", metrics)
+            for delta in deltas:
+                self._apply(delta)
+            self._apply_points(*points)
+            with self._done:
+                self._shard_stats[shard] = stats
+                for name in ("processed", "parse_errors", "unknown_topics", "quarantined", "duplicates", "late",
+                             "evicted"):
+                    setattr(self.stats, name, sum(s[name] for s in self._shard_stats.values()))
+                self._done.notify_all()
+            if kind == "stopped":
+                stopped += 1
+
+    def _apply(self, delta):
+        key = delta["key"]
+        index = None
+        if delta["metadata"] is not None:
+            # indexing happens outside the lock
+            version, digest, payload = delta["metadata"]
+            index = MetadataIndex(pb2.Metadata.FromString(payload), version=version, digest=digest)
+        with self.lock:
+            station = self.station(key)
+            if index is not None:
+                station.metadata = index
+                self.spatial.set_metadata(key, index)
+            station.warnings.extend(delta["warnings"])
+            station.n_warnings, station.n_messages, station.n_observations, station.last_seen_ns = delta["counters"]
+            station.validator.n_quarantined, counts = delta["validation"]
+            station.validator.counts = Counter(counts)
+            station.revision += 1
+
+    def _apply_points(self, entries, times, values):
+        offset = 0
+        offsets = dict.fromkeys(values, 0)
+        located = {}  # station key -> {series key: (times, values)} of the stations with position parameters
+        with self.lock:
+            for key, series_key, version, n in entries:
+                kind = series_key[2]
+                start = offsets[kind]
+                station = self.station(key)
+                station.revision += 1
+                buf = station.series.buffer(series_key)
+                if n == 1:
+                    buf.append(times[offset], values[kind][start], version)
+                else:
+                    buf.extend(times[offset:offset + n], values[kind][start:start + n], version)
+                if self.spatial.positions.get(key):
+                    columns = located.setdefault(key, {})
+                    chunk = (times[offset:offset + n], values[kind][start:start + n])
+                    previous = columns.get(series_key)
+                    columns[series_key] = chunk if previous is None else tuple(
+                        np.concatenate(pair) for pair in zip(previous, chunk))
+                offset += n
+                offsets[kind] = start + n
+            for key, columns in located.items():
+                self.spatial.add(key, columns)
+
+    def queue_depth(self):
+        try:
+            depth = sum(inbox.qsize() for inbox in self._inboxes) * BATCH_SIZE
+        except NotImplementedError:  # macOS
+            depth = 0
+        if depth > self.stats.max_depth:
+            self.stats.max_depth = depth
+        return depth
+
+    def compressed(self):
+        with self._done:
+            return sum(s["compressed"] for s in self._shard_stats.values())
+
+    def drain(self):
+        """Block until every submitted message has been processed and mirrored."""
+        with self._submit_lock:
+            for shard in range(self.shards):
+                if self._batches[shard]:
+                    self._flush(shard)
+                self._inboxes[shard].put(SYNC)
+        with self._done:
+            self._done.wait_for(lambda: sum(s["done"] for s in self._shard_stats.values()) >= self._submitted)
+
+    def stop(self):
+        self.drain()
+        self._running = False
+        for inbox in self._inboxes:
+            inbox.put(None)
+        self._apply_thread.join()
+        for process in self._processes:
+            process.join()
+
+    def station(self, key):
+        station = self.stations.get(key)
+        if station is None:
+            station = self.stations[key] = Station(key, self.capacity)
+        return station
+
+    def memory_usage(self):
+        with self.lock:
+            return sum(station.series.nbytes for station in self.stations.values())
@@ -0,0 +1,281 @@
+# Spatial index of station locations and trajectory points
+#
+# Fixed stations are located by the Location of their Node and ObserverDevices (Metadata); moving platforms
+# (AMDAR aircraft, ozone sondes, ...) report their position as observation values, the parameters with the
+# standard name (or long name) latitude and longitude of a ParameterDefinition. SpatialIndex keeps both in a grid
+# of Web Mercator tiles at INDEX_ZOOM (about 150 km wide at the equator), maintained with the ingest lock held as
+# Metadata is applied and points are stored (ingest.IngestWorker):
+# - a location is kept in the tile it falls in;
+# - the positions of a station are appended to its track, a RingBuffer of (latitude, longitude) with the capacity
+#   of the series, and each tile keeps the runs of consecutive track sequence numbers that fell in it,
+#   [first, stop, earliest time, latest time]. A run grows while the track stays in the tile; runs whose points
+#   have been overwritten are dropped as the track wraps, so the index is bounded like the series.
+# A bounding box and time window query visits the tiles of the box and reads the runs of the window only, and the
+# overview at a zoom level up to INDEX_ZOOM adds up the runs of the tiles it contains (tiles nest), so neither
+# scans the stored observations.
+# Bounding boxes are (west, south, east, north) in degrees; west > east crosses the antimeridian.
+
+from collections import deque
+
+import numpy as np
+
+from series_store import DEFAULT_CAPACITY, RingBuffer
+
+INDEX_ZOOM = 8
+MAX_LATITUDE = 85.0511287798  # the Web Mercator square, positions beyond are kept in its edge tiles
+POSITION_DTYPE = np.dtype([("latitude", np.float64), ("longitude", np.float64)])
+POSITION_NAMES = {"latitude": ("latitude", "lat"), "longitude": ("longitude", "lon", "long")}
+NUMERIC_KINDS = ("floatValue", "doubleValue", "intValue", "unsignedIntValue", "int64Value", "unsignedInt64Value")
+
+
+def tile_xy(latitude, longitude, zoom):
+    """Web Mercator (slippy map) tile column and row of positions, as integer arrays."""
+    n = 2 ** zoom
+    latitude = np.radians(np.minimum(np.maximum(latitude, -MAX_LATITUDE), MAX_LATITUDE))
+    # both are positive, truncating is flooring
+    x = ((np.asarray(longitude, dtype=np.float64) + 180.0) * (n / 360.0)).astype(np.int64)
+    y = ((1.0 - np.arcsinh(np.tan(latitude)) / np.pi) * (n / 2.0)).astype(np.int64)
+    return np.minimum(x, n - 1), np.minimum(y, n - 1)
+
+
+def tile_center(x, y, zoom):
+    """(latitude, longitude) of the center of a tile."""
+    n = 2 ** zoom
+    return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 0.5) / n))))), (x + 0.5) / n * 360.0 - 180.0
+
+
+def parse_bbox(text):
+    """"west,south,east,north" to a bounding box; raises ValueError."""
+    west, south, east, north = (float(v) for v in text.split(","))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError(f"Invalid bounding box: {text}")
+    return west, south, east, north
+
+
+def in_bbox(latitude, longitude, bbox):
+    """Mask of the positions inside a bounding box, None being the whole world."""
+    if bbox is None:
+        return np.ones(np.shape(latitude), dtype=bool)
+    west, south, east, north = bbox
+    inside = (latitude >= south) & (latitude <= north)
+    if west <= east:
+        return inside & (longitude >= west) & (longitude <= east)
+    return inside & ((longitude >= west) | (longitude <= east))
+
+
+def bbox_tiles(bbox, zoom):
+    """Columns and rows of the tiles that intersect a bounding box, the columns as a list of ranges."""
+    n = 2 ** zoom
+    if bbox is None:
+        return [range(n)], range(n)
+    west, south, east, north = bbox
+    (x0, x1), (y0, y1) = tile_xy([north, south], [west, east], zoom)
+    columns = [range(x0, x1 + 1)] if west <= east else [range(x0, n), range(0, x1 + 1)]
+    return columns, range(y0, y1 + 1)
+
+
+def position_parameters(index):
+    """[(parameterDefinitionId, latitude index, longitude index)] of the ParameterDefinitions with a position."""
+    pairs = []
+    for pdid, pdef in index.definitions.items():
+        found = {}
+        for i in range(len(pdef.parameters)):
+            descriptor = index.descriptor(pdid, i)
+            names = {name.lower() for name in descriptor.standard_names.values()}
+            names.add(descriptor.long_name.lower())
+            for coordinate, aliases in POSITION_NAMES.items():
+                if coordinate not in found and names.intersection(aliases):
+                    found[coordinate] = i
+        if len(found) == 2:
+            pairs.append((pdid, found["latitude"], found["longitude"]))
+    return pairs
+
+
+def node_locations(message):
+    """{observer id, None for the node: (latitude, longitude, heightMeter)} of a Metadata message."""
+    locations = {}
+    for device_id, device in [(None, message.node)] + [(obs.id, obs) for obs in message.observers]:
+        if device.HasField("location"):
+            location = device.location
+            if (location.HasField("latitude") and location.HasField("longitude")
+                    and abs(location.latitude) <= 90 and abs(location.longitude) <= 180):
+                locations[device_id] = (location.latitude, location.longitude, location.heightMeter)
+    return locations
+
+
+def column(columns, pdid, index):
+    for kind in NUMERIC_KINDS:
+        found = columns.get((pdid, index, kind))
+        if found is not None:
+            return np.asarray(found[0], dtype=np.int64), np.asarray(found[1], dtype=np.float64)
+    return None
+
+
+class SpatialIndex:
+    """Station locations and track runs per INDEX_ZOOM tile, see the top of this file. Every method is called
+    with the ingest lock held."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.locations = {}  # (station key, observer id or None) -> (latitude, longitude, height)
+        self.location_tiles = {}  # tile -> set of (station key, observer id)
+        self.devices = {}  # station key -> observer ids (None for the node) of its locations
+        self.positions = {}  # station key -> position_parameters() of its metadata
+        self.tracks = {}  # station key -> RingBuffer of POSITION_DTYPE
+        self.tiles = {}  # tile -> {station key: [runs in sequence order]}
+        self.runs = {}  # station key -> deque of (tile, run) in sequence order
+        # incremented on every change, for the ETags of the query API
+        self.revision = 0
+
+    def set_metadata(self, key, index):
+        """Locate a station from the Metadata in force, a MetadataIndex."""
+        for device_id in self.devices.pop(key, ()):
+            self._remove_location((key, device_id))
+        located = node_locations(index.message)
+        self.devices[key] = list(located)
+        for device_id, location in located.items():
+            self.locations[(key, device_id)] = location
+            x, y = tile_xy(location[0], location[1], INDEX_ZOOM)
+            self.location_tiles.setdefault((int(x), int(y)), set()).add((key, device_id))
+        self.positions[key] = position_parameters(index)
+        self.revision += 1
+
+    def _remove_location(self, location_key):
+        latitude, longitude, _ = self.locations.pop(location_key)
+        x, y = tile_xy(latitude, longitude, INDEX_ZOOM)
+        tile = (int(x), int(y))
+        self.location_tiles[tile].discard(location_key)
+        if not self.location_tiles[tile]:
+            del self.location_tiles[tile]
+
+    def add(self, key, columns):
+        """Index the positions among stored columns, {series key: (times_ns, values)}."""
+        for pdid, lat_index, lon_index in self.positions.get(key, ()):
+            latitude, longitude = column(columns, pdid, lat_index), column(columns, pdid, lon_index)
+            if latitude is None or longitude is None:
+                continue
+            times, latitude = latitude
+            lon_times, longitude = longitude
+            if len(times) != len(lon_times) or (times != lon_times).any():
+                # an observation without one of the two values: pair them by time
+                times, lat_at, lon_at = np.intersect1d(times, lon_times, assume_unique=False, return_indices=True)
+                latitude, longitude = latitude[lat_at], longitude[lon_at]
+            valid = (np.abs(latitude) <= 90) & (np.abs(longitude) <= 180)
+            if not valid.all():
+                times, latitude, longitude = times[valid], latitude[valid], longitude[valid]
+            if len(times):
+                self._append(key, times, latitude, longitude)
+
+    def _append(self, key, times, latitude, longitude):
+        track = self.tracks.get(key)
+        if track is None:
+            track = self.tracks[key] = RingBuffer(POSITION_DTYPE, self.capacity)
+            self.runs[key] = deque()
+        first = track.total
+        positions = np.empty(len(times), dtype=POSITION_DTYPE)
+        positions["latitude"] = latitude
+        positions["longitude"] = longitude
+        track.extend(times, positions)
+
+        runs = self.runs[key]
+        xs, ys = tile_xy(latitude, longitude, INDEX_ZOOM)
+        changes = np.flatnonzero((xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])) + 1
+        for start, stop in zip([0, *changes.tolist()], [*changes.tolist(), len(times)]):
+            tile = (int(xs[start]), int(ys[start]))
+            earliest, latest = int(times[start:stop].min()), int(times[start:stop].max())
+            last = runs[-1] if runs else None
+            if last is not None and last[0] == tile and last[1][1] == first + start:
+                run = last[1]
+                run[1] = first + stop
+                run[2] = min(run[2], earliest)
+                run[3] = max(run[3], latest)
+            else:
+                run = [first + start, first + stop, earliest, latest]
+                self.tiles.setdefault(tile, {}).setdefault(key, []).append(run)
+                runs.append((tile, run))
+
+        # runs whose points have all been overwritten are the oldest ones, of the station and of their tile
+        oldest = track.total - len(track)
+        while runs and runs[0][1][1] <= oldest:
+            tile, _ = runs.popleft()
+            station_runs = self.tiles[tile][key]
+            station_runs.pop(0)
+            if not station_runs:
+                del self.tiles[tile][key]
+                if not self.tiles[tile]:
+                    del self.tiles[tile]
+        self.revision += 1
+
+    def _tiles_in(self, tiles, bbox):
+        """Keys of `tiles` that intersect a bounding box, without visiting the empty tiles of a large box."""
+        columns, rows = bbox_tiles(bbox, INDEX_ZOOM)
+        if sum(len(c) for c in columns) * len(rows) > len(tiles):
+            return [t for t in tiles if any(t[0] in c for c in columns) and t[1] in rows]
+        return [(x, y) for c in columns for x in c for y in rows if (x, y) in tiles]
+
+    def stations(self, bbox=None):
+        """[(station key, observer id or None, latitude, longitude, height)] of the locations in a bounding box."""
+        found = []
+        for tile in self._tiles_in(self.location_tiles, bbox):
+            for location_key in self.location_tiles[tile]:
+                latitude, longitude, height = self.locations[location_key]
+                if in_bbox(latitude, longitude, bbox):
+                    found.append(location_key + (latitude, longitude, height))
+        return sorted(found, key=lambda f: (f[0], -1 if f[1] is None else f[1]))
+
+    def _window_runs(self, bbox, start, end):
+        """(tile, station key, run) of the runs in a bounding box and time window with points still stored."""
+        for tile in self._tiles_in(self.tiles, bbox):
+            for key, runs in self.tiles[tile].items():
+                oldest = self.tracks[key].total - len(self.tracks[key])
+                for run in runs:
+                    if run[1] > oldest and (start is None or run[3] >= start) and (end is None or run[2] < end):
+                        yield tile, key, run
+
+    def points(self, bbox=None, start=None, end=None):
+        """{station key: (times, latitudes, longitudes)} of the track points in a bounding box and [start, end),
+        in time order."""
+        parts = {}
+        for tile, key, run in self._window_runs(bbox, start, end):
+            times, positions = self.tracks[key].between(run[0], run[1])
+            selected = in_bbox(positions["latitude"], positions["longitude"], bbox)
+            if start is not None:
+                selected &= times >= start
+            if end is not None:
+                selected &= times < end
+            parts.setdefault(key, []).append((times[selected], positions[selected]))
+        tracks = {}
+        for key, chunks in parts.items():
+            times = np.concatenate([c[0] for c in chunks])
+            positions = np.concatenate([c[1] for c in chunks])
+            order = np.argsort(times, kind="stable")
+            if len(order):
+                tracks[key] = (times[order], positions["latitude"][order], positions["longitude"][order])
+        return tracks
+
+    def overview(self, zoom, bbox=None, start=None, end=None):
+        """{(x, y): [locations, track points]} of the non-empty tiles of a zoom level in a bounding box (up to
+        INDEX_ZOOM, the track points of the index tiles that intersect it) and time window."""
+        counts = {}
+        for _, _, latitude, longitude, _ in self.stations(bbox):
+            x, y = tile_xy(latitude, longitude, zoom)
+            counts.setdefault((int(x), int(y)), [0, 0])[0] += 1
+        if zoom > INDEX_ZOOM:
+            for times, latitudes, longitudes in self.points(bbox, start, end).values():
+                xs, ys = tile_xy(latitudes, longitudes, zoom)
+                for (x, y), n in zip(*np.unique(np.stack((xs, ys), axis=1), axis=0, return_counts=True)):
+                    counts.setdefault((int(x), int(y)), [0, 0])[1] += int(n)
+            return counts
+        shift = INDEX_ZOOM - zoom
+        for tile, key, run in self._window_runs(bbox, start, end):
+            track = self.tracks[key]
+            first = max(run[0], track.total - len(track))
+            if (start is None or run[2] >= start) and (end is None or run[3] < end):
+                n = run[1] - first
+            else:
+                # a run across an end of the window: count its points in the window
+                times, _ = track.between(first, run[1])
+                n = int(np.count_nonzero((start is None or times >= start) & (end is None or times < end)))
+            if n:
+                counts.setdefault((tile[0] >> shift, tile[1] >> shift), [0, 0])[1] += n
+        return counts
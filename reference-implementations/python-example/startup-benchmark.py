@@ -0,0 +1,121 @@
+# Startup benchmark of the receiver
+#
+# Measures, each in a fresh interpreter, the wall time and peak memory (RSS) it takes to import data-receiver.py
+# and create its ingest worker, for the headless ingest command and for the dashboard (which also imports
+# dashboard.py), and lists which of the heavy optional packages got loaded.
+#
+# It fails (exit status 1) when the ingest command loads one of the UI/analysis packages (Dash, Plotly, Flask,
+# pandas, pyarrow) or exceeds --max-seconds or --max-rss-mb, so an import added at module level in one of the
+# ingest modules shows up as a regression; --importtime prints the slowest imports of a run to find it:
+# python3 startup-benchmark.py
+# python3 startup-benchmark.py --importtime --output startup.json
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ["dash", "plotly", "flask", "pandas", "pyarrow", "zstandard", "numpy"]
+HEADLESS_FORBIDDEN = ["dash", "plotly", "flask", "pandas", "pyarrow"]
+COMMAND_ARGS = ["--broker", "localhost", "--topic", "firstmile/#"]
+
+
+def run_child(command):
+    """Import the receiver and create its ingest worker the way __main__ does, without connecting."""
+    import importlib.util
+    import resource
+
+    started = time.perf_counter()
+    spec = importlib.util.spec_from_file_location("data_receiver", "data-receiver.py")
+    receiver = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(receiver)
+    args = receiver.parse_args([command] + COMMAND_ARGS)
+    receiver.create_ingest(args)
+    if command == "dashboard":
+        import dashboard  # noqa: F401
+    elapsed = time.perf_counter() - started
+
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kilobytes on Linux, bytes on macOS
+    return {
+        "command": command,
+        "seconds": elapsed,
+        "rss_mb": rss_kb / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "modules": [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+def slowest_imports(command, count=10):
+    """(cumulative us, module) of the slowest imports of one run, from python -X importtime."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", __file__, "--child", command],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2]))
+    # top-level imports only (nested ones are indented), their cumulative time includes what they import
+    top = [(us, name.strip()) for us, name in rows if not name.startswith("  ")]
+    return sorted(top, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receiver import time and memory benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per command")
+    parser.add_argument("--max-seconds", type=float, default=1.0, help="Median startup time allowed for the ingest command")
+    parser.add_argument("--max-rss-mb", type=float, default=80.0, help="Peak memory allowed for the ingest command")
+    parser.add_argument("--importtime", action="store_true", help="Print the slowest imports of every command")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--child", choices=["ingest", "dashboard"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(run_child(args.child), sys.stdout)
+        return
+
+    # the receiver imports its sibling modules and protospy relative to this directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for command in ["ingest", "dashboard"]:
+        runs = []
+        for _ in range(args.repeat):
+            proc = subprocess.run([sys.executable, __file__, "--child", command], stdout=subprocess.PIPE, check=True)
+            runs.append(json.loads(proc.stdout))
+        results[command] = {
+            "median_seconds": statistics.median(run["seconds"] for run in runs),
+            "max_rss_mb": max(run["rss_mb"] for run in runs),
+            "modules": runs[-1]["modules"],
+        }
+
+    print(f"{'command':<10} {'median s':>9} {'RSS MB':>7}  modules loaded")
+    for command, result in results.items():
+        print(f"{command:<10} {result['median_seconds']:>9.3f} {result['max_rss_mb']:>7.0f}  "
+              f"{', '.join(result['modules']) or '-'}")
+        if args.importtime:
+            for us, name in slowest_imports(command):
+                print(f"{'':<10} {us / 1e6:>9.3f}          {name}")
+
+    headless = results["ingest"]
+    failures = []
+    loaded = [name for name in headless["modules"] if name in HEADLESS_FORBIDDEN]
+    if loaded:
+        failures.append(f"the ingest command imports {', '.join(loaded)}")
+    if headless["median_seconds"] > args.max_seconds:
+        failures.append(f"the ingest command takes {headless['median_seconds']:.3f} s to start, "
+                        f"more than {args.max_seconds} s")
+    if headless["max_rss_mb"] > args.max_rss_mb:
+        failures.append(f"the ingest command uses {headless['max_rss_mb']:.0f} MB, more than {args.max_rss_mb} MB")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "results": results,
+                       "failures": failures}, f, indent=2)
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Schema-aware validation of incoming Data messages
+#
+# A Data message is only meaningful together with the Metadata of its station, so the checks are compiled once
+# per Metadata version into a plan per parameterDefinitionId (number of parameters, observers that do not
+# resolve) and run against the decoded columns of decoding.decode_data(), i.e. once per series of a message
+# rather than once per value; the checks that only depend on which series a message has are cached per layout:
+#
+#   unknown_definition   parameterDefinitionId not defined in the Metadata                      error
+#   too_many_values      value index beyond the parameters of the definition                    error
+#   kind_mismatch        value kind differs from the one this series had so far (emptyValue     error
+#                        always passes); the kinds are learned anew when a ParameterDefinition
+#                        changes, other Metadata changes keep them
+#   non_monotonic        times of one definition do not increase strictly within the message    error
+#   out_of_order         times not after the last accepted time of the definition               warning
+#                        (error with strict_order: AMDAR sends one trajectory per message and
+#                        nodes may re-send data after a reconnection)
+#   short_values         fewer values than parameters in some observations (emptyValue counts)  warning
+#   unresolved_observer  a parameter's device.observerId is not among the observers             warning
+#
+# Messages with errors are quarantined instead of being stored: they are kept per station, counted per check,
+# and retried when the station's Metadata changes (the data-before-metadata case of
+# standard/tests/resilience/misaligned_metadata). Warnings are only counted.
+#
+# Run the checks over recorded payloads, e.g. the resilience test cases:
+# python3 validation.py ../../standard/tests/resilience/misaligned_metadata/resilience2.json
+# python3 validation.py ../../standard/tests/resilience/completeness/information_completeness.json
+
+import argparse
+from collections import Counter, deque, namedtuple
+
+ERRORS = ("unknown_definition", "too_many_values", "kind_mismatch", "non_monotonic")
+WARNINGS = ("out_of_order", "short_values", "unresolved_observer")
+MAX_QUARANTINE = 100
+
+DefinitionPlan = namedtuple("DefinitionPlan", ["n_parameters", "unresolved_observers"])
+Issue = namedtuple("Issue", ["check", "parameter_definition_id", "detail"])
+QuarantinedMessage = namedtuple("QuarantinedMessage", ["topic", "data", "received_ns", "issues"])
+
+
+def compile_plans(index):
+    """{parameterDefinitionId: DefinitionPlan} for a metadata_index.MetadataIndex."""
+    plans = {}
+    for param_id, pdef in index.definitions.items():
+        unresolved = tuple(sorted({p.device.observerId for p in pdef.parameters
+                                   if p.device.WhichOneof("target") == "observerId"
+                                   and p.device.observerId not in index.observers}))
+        plans[param_id] = DefinitionPlan(len(pdef.parameters), unresolved)
+    return plans
+
+
+def increasing(times):
+    return all(a < b for a, b in zip(times, times[1:]))
+
+
+class StationValidator:
+    """Validation state of one station: check plans of the metadata in force, learned kinds, last times."""
+
+    def __init__(self, strict_order=False):
+        self.errors = set(ERRORS) | ({"out_of_order"} if strict_order else set())
+        self.version = None
+        self.definitions = {}  # parameterDefinitionId -> ParameterDefinition of the metadata in force
+        self.plans = {}
+        self.kinds = {}  # (parameterDefinitionId, value index) -> Value kind
+        self.layouts = {}  # series keys of an accepted message -> their structural issues (warnings)
+        self._pending = None
+        self.last_times = {}  # parameterDefinitionId -> last accepted time ns
+        self.counts = Counter()  # check -> number of messages it failed
+        self.quarantine = deque(maxlen=MAX_QUARANTINE)
+        self.n_quarantined = 0
+
+    def set_metadata(self, index):
+        """Compile the plans of a new metadata version; returns the metadata-level issues."""
+        if index.version == self.version:
+            return []
+        self.version = index.version
+        self.plans = compile_plans(index)
+        # a faulty message right after a Metadata change must not set the kinds: the kinds of the definitions
+        # that did not change are kept
+        self.kinds = {(param_id, i): kind for (param_id, i), kind in self.kinds.items()
+                      if param_id in index.definitions and index.definitions[param_id] == self.definitions.get(param_id)}
+        self.definitions = dict(index.definitions)
+        self.layouts = {}
+        issues = [Issue("unresolved_observer", param_id, f"observerId {', '.join(map(str, plan.unresolved_observers))}")
+                  for param_id, plan in self.plans.items() if plan.unresolved_observers]
+        for issue in issues:
+            self.counts[issue.check] += 1
+        return issues
+
+    def check(self, columns):
+        """Issues of decoded columns, {(parameterDefinitionId, value index, kind): (times_ns, values)}."""
+        # the structural checks only depend on the set of series of the message, which is the same message
+        # after message: their result is kept per layout once a message with that layout has been accepted
+        layout = tuple(columns)
+        issues = self.layouts.get(layout)
+        issues = list(issues) if issues is not None else self._check_layout(layout)
+
+        last_times = self.last_times
+        counts = {}
+        spans = {}
+        for (param_id, index, _), (times, _) in columns.items():
+            n = len(times)
+            if n > 1 and not increasing(times):
+                issues.append(Issue("non_monotonic", param_id, f"value {index}"))
+            # the rows of a value are spread over one column per kind (emptyValue cells have their own)
+            counts[param_id, index] = counts.get((param_id, index), 0) + n
+            span = spans.get(param_id)
+            if span is None:
+                spans[param_id] = (times[0], times[-1])
+            elif times[0] < span[0] or times[-1] > span[1]:
+                spans[param_id] = (min(times[0], span[0]), max(times[-1], span[1]))
+        rows = {}
+        short = set()
+        for (param_id, _), n in counts.items():
+            if rows.setdefault(param_id, n) != n:
+                short.add(param_id)
+        issues += [Issue("short_values", param_id, "observations with fewer values") for param_id in sorted(short)]
+        for param_id, (first, _) in spans.items():
+            last = last_times.get(param_id)
+            if last is not None and first <= last:
+                issues.append(Issue("out_of_order", param_id, "not after the last accepted observation"))
+        self._pending = (layout, spans)
+        return issues
+
+    def _check_layout(self, layout):
+        issues = []
+        indices = {}
+        for param_id, index, kind in layout:
+            plan = self.plans.get(param_id)
+            if plan is None:
+                if param_id not in indices:
+                    issues.append(Issue("unknown_definition", param_id, "not in the Metadata"))
+                indices[param_id] = None
+                continue
+            indices.setdefault(param_id, set()).add(index)
+            if index >= plan.n_parameters:
+                issues.append(Issue("too_many_values", param_id,
+                                    f"value {index}, the definition has {plan.n_parameters} parameters"))
+            if kind != "emptyValue":
+                expected = self.kinds.get((param_id, index), kind)
+                if expected != kind:
+                    issues.append(Issue("kind_mismatch", param_id, f"value {index} is {kind}, was {expected}"))
+        for param_id, found in indices.items():
+            if found is not None and len(found) < self.plans[param_id].n_parameters:
+                issues.append(Issue("short_values", param_id, f"{self.plans[param_id].n_parameters} parameters"))
+        return issues
+
+    def is_error(self, issues):
+        return any(issue.check in self.errors for issue in issues)
+
+    def count(self, issues):
+        for check in {issue.check for issue in issues}:
+            self.counts[check] += 1
+
+    def accept(self, columns):
+        """Record the kinds and last times of the columns just checked, which passed."""
+        layout, spans = self._pending
+        if layout not in self.layouts:
+            for param_id, index, kind in layout:
+                if kind != "emptyValue":
+                    self.kinds.setdefault((param_id, index), kind)
+            # only warnings remain for an accepted layout, and the kinds it was checked against cannot change
+            self.layouts[layout] = self._check_layout(layout)
+        last_times = self.last_times
+        for param_id, (_, end) in spans.items():
+            if end > last_times.get(param_id, end - 1):
+                last_times[param_id] = end
+
+    def hold(self, topic, data, received_ns, issues, retry=False):
+        """Quarantine a message; a retried message that fails again is not counted twice."""
+        self.quarantine.append(QuarantinedMessage(topic, data, received_ns, issues))
+        if not retry:
+            self.n_quarantined += 1
+
+    def release(self):
+        """Quarantined messages, removed for a retry against new metadata."""
+        held = list(self.quarantine)
+        self.quarantine.clear()
+        return held
+
+
+def describe(issues):
+    return "; ".join(f"{issue.check} (parameterDefinitionId {issue.parameter_definition_id}: {issue.detail})"
+                     for issue in issues)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate recorded payloads against their Metadata")
+    parser.add_argument("inputs", nargs="+", help="JSON payload sequences, length-delimited files or archives")
+    parser.add_argument("--strict-order", action="store_true", help="Quarantine data older than the data already accepted")
+    parser.add_argument("--verbose", action="store_true", help="Print every quarantined message")
+    args = parser.parse_args()
+
+    from ingest import IngestWorker
+    from payload_files import load_payloads
+
+    for path in args.inputs:
+        ingest = IngestWorker(strict_order=args.strict_order)
+        for topic, received_ns, payload in load_payloads(path):
+            ingest.process(topic or "firstmile/poc1/test/node", payload, received_ns, archive=False)
+        print(path)
+        for key, station in ingest.stations.items():
+            validator = station.validator
+            print(f"  {key}: {station.n_messages} messages, {validator.n_quarantined} quarantined, "
+                  f"{len(validator.quarantine)} still in quarantine, {ingest.buffers.n_pending(key)} waiting for "
+                  f"Metadata, checks failed: {dict(validator.counts)}")
+            if args.verbose:
+                for held in validator.quarantine:
+                    print(f"    {len(held.data.observations)} observations: {describe(held.issues)}")
+
+
+if __name__ == "__main__":
+    main()